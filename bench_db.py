@@ -0,0 +1,337 @@
+"""Микробенчмарки методов Database на синтетической базе продового размера.
+
+Запуск:
+    python bench_db.py                      # 1M пользователей, 50M игр, ...
+    python bench_db.py --scale 0.01 --out bench.json
+
+База строится один раз и переиспользуется (--rebuild пересоздаёт её).
+Результат — JSON с min/median/p95/mean по каждому методу, чтобы сравнивать
+прогоны до и после изменений хранилища.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import string
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BASE_ROWS = {
+    "users": 1_000_000,
+    "games": 50_000_000,
+    "payments": 1_000_000,
+    "withdrawals": 100_000,
+    "promocodes": 10_000,
+}
+
+GAME_TYPES = ["flip", "roulette", "slots", "mines", "dice_num", "dice_even_odd",
+              "football", "basketball", "darts", "bowling"]
+CHUNK = 100_000
+BULK_BATCH = 1000
+PROMO_BATCH = 500
+PROMO_BURST = 5000
+PROMO_BULK = 100_000
+BULK_CREATOR = -1
+
+
+def scaled_rows(scale):
+    return {table: max(1, int(count * scale)) for table, count in BASE_ROWS.items()}
+
+
+def random_time(rnd, now, days=365):
+    return (now - timedelta(seconds=rnd.randrange(days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def skewed_user(rnd, users):
+    """Активные пользователи играют чаще: квадрат равномерного смещает к малым id"""
+    return 1 + int(users * rnd.random() ** 2)
+
+
+def chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def populate(bot, path, rows, seed=1):
+    """Заполняет схему бота синтетическими данными быстрыми PRAGMA"""
+    rnd = random.Random(seed)
+    now = datetime.now()
+    conn = sqlite3.connect(path)
+    # Центы считает та же функция, что и бот: ROUND(x * 100) расходится с ней на двоичных хвостах
+    conn.create_function('cents', 1, bot.to_cents, deterministic=True)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -200000")
+    n_users = rows["users"]
+
+    def users():
+        for uid in range(1, n_users + 1):
+            cents = rnd.randrange(5000)
+            yield (uid, f"user{uid}", f"User {uid}", cents / 100, cents,
+                   rnd.randrange(5), str(rnd.randrange(10 ** 9)), random_time(rnd, now))
+
+    def games():
+        for _ in range(rows["games"]):
+            bet = round(rnd.uniform(0.1, 20), 2)
+            win = round(bet * 1.7, 2) if rnd.random() < 0.4 else 0.0
+            yield (skewed_user(rnd, n_users), rnd.choice(GAME_TYPES), bet,
+                   1.7 if win else 0.0, win, "", random_time(rnd, now))
+
+    def payments():
+        for _ in range(rows["payments"]):
+            yield (skewed_user(rnd, n_users), round(rnd.uniform(0.2, 250), 2), "crypto",
+                   str(rnd.randrange(10 ** 9)), "completed" if rnd.random() < 0.8 else "pending",
+                   random_time(rnd, now))
+
+    def withdrawals():
+        for _ in range(rows["withdrawals"]):
+            status = rnd.choices(["pending", "approved", "completed", "rejected"], [10, 5, 75, 10])[0]
+            created = random_time(rnd, now)
+            yield (skewed_user(rnd, n_users), round(rnd.uniform(2, 100), 2), "crypto",
+                   str(rnd.randrange(10 ** 9)), status, created if status != "pending" else None, created)
+
+    def promocodes():
+        seen = set()
+        while len(seen) < rows["promocodes"]:
+            code = "".join(rnd.choices(string.ascii_uppercase + string.digits, k=8))
+            if code in seen:
+                continue
+            seen.add(code)
+            yield (code, round(rnd.uniform(0.1, 10), 2), (now + timedelta(days=30)).date().isoformat(),
+                   rnd.choice([0, 100, 1000]), 1)
+
+    statements = [
+        ("users", users(), "INSERT OR REPLACE INTO users (user_id, username, first_name, balance, balance_cents, referrals, crypto_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"),
+        ("games", games(), "INSERT INTO games (user_id, game_type, bet, multiplier, win, result, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)"),
+        ("payments", payments(), "INSERT INTO payments (user_id, amount, method, invoice_id, status, created_at) VALUES (?, ?, ?, ?, ?, ?)"),
+        ("withdrawals", withdrawals(), "INSERT INTO withdrawals (user_id, amount, method, wallet, status, processed_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)"),
+        ("promocodes", promocodes(), "INSERT OR IGNORE INTO promocodes (code, amount, expires_at, max_uses, created_by) VALUES (?, ?, ?, ?, ?)"),
+    ]
+    for table, generator, sql in statements:
+        t0 = time.perf_counter()
+        for chunk in chunks(generator):
+            conn.executemany(sql, chunk)
+            conn.commit()
+        print(f"  {table}: {rows[table]:,} строк за {time.perf_counter() - t0:.1f} c", file=sys.stderr)
+    # Журнал по объёму как у живой базы: ставка и выигрыш на каждую игру, а начальная
+    # проводка добивает сумму пользователя до его баланса
+    t0 = time.perf_counter()
+    conn.execute("""
+        INSERT INTO ledger (user_id, amount_cents, reason, created_at)
+        SELECT user_id, amount, reason, created_at FROM (
+            SELECT id, 0 AS leg, user_id, -cents(bet) AS amount, 'bet' AS reason, created_at
+            FROM games
+            UNION ALL
+            SELECT id, 1, user_id, cents(win), 'win', created_at FROM games WHERE win > 0
+        ) ORDER BY id, leg
+    """)
+    conn.execute("""
+        INSERT INTO ledger (user_id, amount_cents, reason)
+        SELECT u.user_id, u.balance_cents - COALESCE(g.total, 0), 'opening'
+        FROM users u LEFT JOIN (SELECT user_id, SUM(amount_cents) AS total FROM ledger GROUP BY user_id) g
+             ON g.user_id = u.user_id
+        WHERE u.balance_cents != COALESCE(g.total, 0)
+    """)
+    ledger_rows = conn.execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+    print(f"  ledger: {ledger_rows:,} строк за {time.perf_counter() - t0:.1f} c", file=sys.stderr)
+    # Холды pending-заявок; у части пользователей заявки больше баланса — как у заявок старше холдов
+    conn.execute("""
+        UPDATE users SET held_cents = COALESCE((
+            SELECT SUM(cents(amount)) FROM withdrawals w
+            WHERE w.user_id = users.user_id AND w.status = 'pending'), 0)
+    """)
+    conn.execute("UPDATE users SET available_cents = balance_cents - held_cents")
+    # Платежи и заявки выше — история до журнала, сверка начинает с новых
+    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('ledger_since', ?)", (json.dumps({
+        table: conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        for table in ("payments", "withdrawals")}),))
+    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('bench_rows', ?)", (json.dumps(rows),))
+    conn.commit()
+    conn.close()
+
+
+def built_rows(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        conn = sqlite3.connect(path)
+        row = conn.execute("SELECT value FROM settings WHERE key = 'bench_rows'").fetchone()
+        conn.close()
+        return json.loads(row[0]) if row else None
+    except sqlite3.Error:
+        return None
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    p95 = durations[min(len(durations) - 1, int(0.95 * (len(durations) - 1) + 0.5))]
+    mean = statistics.fmean(durations)
+    return {
+        "calls": len(durations),
+        "min_ms": round(durations[0] * 1000, 4),
+        "median_ms": round(statistics.median(durations) * 1000, 4),
+        "p95_ms": round(p95 * 1000, 4),
+        "mean_ms": round(mean * 1000, 4),
+        "ops_per_s": round(1 / mean, 1) if mean else None,
+    }
+
+
+def timed(fn, args_iter):
+    durations = []
+    for args in args_iter:
+        t0 = time.perf_counter()
+        fn(*args)
+        durations.append(time.perf_counter() - t0)
+    return summarize(durations)
+
+
+def fresh_withdrawals(db, rnd, users, status, count=BULK_BATCH):
+    """Вставляет пачку заявок вне замера и возвращает её диапазон id; pending — с холдом, как create_withdrawal"""
+    owners = [rnd.randint(1, users) for _ in range(count)]
+    db.conn.executemany(
+        "INSERT INTO withdrawals (user_id, amount, method, wallet, status) VALUES (?, 0.01, 'crypto', NULL, ?)",
+        ((user_id, status) for user_id in owners))
+    if status == 'pending':
+        db.conn.executemany("UPDATE users SET held_cents = held_cents + 1, available_cents = available_cents - 1 "
+                            "WHERE user_id = ?", ((user_id,) for user_id in owners))
+    db.conn.commit()
+    last = db.conn.execute("SELECT MAX(id) FROM withdrawals").fetchone()[0]
+    return last - count + 1, last
+
+
+def one_by_one(method):
+    """Та же пачка, но отдельной транзакцией на каждую заявку — как по одной кнопке"""
+    return lambda first, last, admin_id: [method(wid, wid, admin_id) for wid in range(first, last + 1)]
+
+
+def promo_burst(bot, db, rnd, users, count=PROMO_BURST):
+    """count одновременных активаций свежего кода с лимитом на 80% — как после рассылки"""
+    code = db.generate_promocode(0.01, 1, int(count * 0.8), 1)
+    redeemer = bot.PromoRedeemer(db)
+
+    async def burst():
+        return await asyncio.gather(*(redeemer.redeem(rnd.randint(1, users), code) for _ in range(count)))
+    results = asyncio.run(burst())
+    issued = db.conn.execute("SELECT used_count, max_uses FROM promocodes WHERE code = ?", (code,)).fetchone()
+    assert issued[0] <= issued[1] and issued[0] == sum(r['success'] for r in results), "перевыдача промокода"
+
+
+def bulk_promocodes(db, runs, count=PROMO_BULK):
+    """Аргументы generate_promocodes; пачка прошлого прогона удаляется вне замера"""
+    for _ in range(runs):
+        yield count, 0.01, 1, 1, BULK_CREATOR
+        db.conn.execute("DELETE FROM promocodes WHERE created_by = ?", (BULK_CREATOR,))
+        db.conn.commit()
+
+
+def run_benchmarks(bot, rows, repeat, heavy_repeat, only=None):
+    db = bot.db
+    rnd = random.Random(7)
+    users = rows["users"]
+    user = lambda: rnd.randint(1, users)
+    codes = [r[0] for r in db.conn.execute("SELECT code FROM promocodes WHERE max_uses = 0 OR max_uses > used_count LIMIT 1000")]
+    cases = {
+        "get_user": lambda: timed(db.get_user, ((user(),) for _ in range(repeat))),
+        "update_balance": lambda: timed(db.update_balance, ((user(), 0.01, 'adjustment') for _ in range(repeat))),
+        "replay_balance": lambda: timed(db.replay_balance, ((user(),) for _ in range(repeat))),
+        "snapshot_balances": lambda: timed(db.snapshot_balances, ((bot.SNAPSHOT_BATCH,) for _ in range(heavy_repeat))),
+        "get_user_stats": lambda: timed(db.get_user_stats, ((user(),) for _ in range(repeat))),
+        "get_daily_stats": lambda: timed(db.get_daily_stats, (() for _ in range(heavy_repeat))),
+        "get_weekly_stats": lambda: timed(db.get_weekly_stats, (() for _ in range(heavy_repeat))),
+        "get_monthly_stats": lambda: timed(db.get_monthly_stats, (() for _ in range(heavy_repeat))),
+        "get_pending_withdrawals": lambda: timed(db.get_pending_withdrawals, (() for _ in range(heavy_repeat))),
+        "get_pending_withdrawals_page": lambda: timed(db.get_pending_withdrawals_page,
+                                                      ((None, None) for _ in range(repeat))),
+        "get_users_page": lambda: timed(db.get_users_page, ((user(),) for _ in range(repeat))),
+        "count_pending_withdrawals": lambda: timed(db.count_pending_withdrawals, (() for _ in range(repeat))),
+        "activate_promocode": lambda: timed(db.activate_promocode,
+                                            ((user(), rnd.choice(codes)) for _ in range(repeat))),
+        "redeem_promocodes_500": lambda: timed(db.redeem_promocodes, (
+            ([(user(), code, 0.01) for code in rnd.choices(codes, k=PROMO_BATCH)],) for _ in range(heavy_repeat))),
+        "promo_burst_5000": lambda: timed(promo_burst, ((bot, db, rnd, users) for _ in range(heavy_repeat))),
+        "generate_promocodes_100k": lambda: timed(db.generate_promocodes, bulk_promocodes(db, heavy_repeat)),
+        "promocodes_csv_100k": lambda: timed(bot.promocodes_csv, (
+            ([f"{i:08d}" for i in range(PROMO_BULK)], 0.01, "2030-01-01", 1) for _ in range(heavy_repeat))),
+        "check_integrity": lambda: timed(bot.check_integrity, ((db.path,) for _ in range(heavy_repeat))),
+        "get_users_csv": lambda: timed(db.get_users_csv, (() for _ in range(heavy_repeat))),
+        "check_rate_limit": lambda: timed(db.check_rate_limit, ((user(),) for _ in range(repeat))),
+        "approve_withdrawals_1000": lambda: timed(
+            db.approve_withdrawals, ((*fresh_withdrawals(db, rnd, users, 'pending'), 1) for _ in range(heavy_repeat))),
+        "approve_withdrawals_1000_single": lambda: timed(
+            one_by_one(db.approve_withdrawals),
+            ((*fresh_withdrawals(db, rnd, users, 'pending'), 1) for _ in range(heavy_repeat))),
+        "complete_withdrawals_1000": lambda: timed(
+            db.complete_withdrawals, ((*fresh_withdrawals(db, rnd, users, 'approved'), 1) for _ in range(heavy_repeat))),
+    }
+    results = {}
+    for name, case in cases.items():
+        if only and name not in only:
+            continue
+        print(f"  {name}...", file=sys.stderr)
+        results[name] = case()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Database на синтетических данных")
+    parser.add_argument("--scale", type=float, default=1.0, help="доля от продового объёма (1.0 = 1M пользователей, 50M игр)")
+    parser.add_argument("--db", help="путь к синтетической базе (по умолчанию во временной папке)")
+    parser.add_argument("--rebuild", action="store_true", help="пересоздать базу")
+    parser.add_argument("--repeat", type=int, default=1000, help="вызовов для точечных методов")
+    parser.add_argument("--heavy-repeat", type=int, default=5, help="вызовов для агрегатов и выгрузок")
+    parser.add_argument("--only", nargs="*", help="запустить только эти методы")
+    parser.add_argument("--out", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    rows = scaled_rows(args.scale)
+    path = args.db or os.path.join(tempfile.gettempdir(), f"sakura_bench_{args.scale:g}.db")
+    build_s = 0.0
+    if args.rebuild or built_rows(path) != rows:
+        if os.path.exists(path):
+            os.remove(path)
+        print(f"Строим {path}...", file=sys.stderr)
+        t0 = time.perf_counter()
+        os.environ["DB_PATH"] = path
+        import bot
+        populate(bot, path, rows)
+        build_s = time.perf_counter() - t0
+    else:
+        os.environ["DB_PATH"] = path
+        import bot
+
+    print("Замеры...", file=sys.stderr)
+    results = run_benchmarks(bot, rows, args.repeat, args.heavy_repeat, args.only)
+    report = {
+        "meta": {
+            "scale": args.scale,
+            "rows": rows,
+            "db_path": path,
+            "db_size_mb": round(os.path.getsize(path) / 2 ** 20, 1),
+            "build_s": round(build_s, 1),
+            "sqlite": sqlite3.sqlite_version,
+            "python": platform.python_version(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
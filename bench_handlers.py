@@ -0,0 +1,253 @@
+"""Микробенчмарки обработчиков: start, button_handler и handle_message без сети.
+
+Запуск:
+    python bench_handlers.py
+    python bench_handlers.py --iterations 500 --only casino_menu admin_panel --out handlers.json
+
+Обновления собираются настоящими объектами PTB (Update.de_json) и проходят
+через настоящий ExtBot, у которого вместо HTTP стоит запрос-заглушка: так
+в замер попадают разбор callback_data, сборка клавиатур, форматирование
+текста, edit_message и сериализация запросов, но не сеть. По каждому
+сценарию выводится CPU-время на вызов и память по tracemalloc.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ADMIN_ID = 1
+PLAYER_ID = 1001
+
+
+def setup_env():
+    tmpdir = tempfile.mkdtemp(prefix="sakura_bench_handlers_")
+    os.environ["DB_PATH"] = os.path.join(tmpdir, "bench.db")
+    os.environ["ADMIN_IDS"] = str(ADMIN_ID)
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+
+setup_env()
+
+import bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, CallbackContext, ExtBot  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+
+# ======================== БОТ БЕЗ СЕТИ ========================
+class NoopRequest(BaseRequest):
+    """Отвечает на любой метод Bot API готовым JSON, ничего не отправляя"""
+
+    def __init__(self):
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self._message_id += 1
+        if api_method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Sakura", "username": "Sakura_Gamerobot"}
+        elif api_method.startswith("send") or api_method.startswith("edit"):
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", PLAYER_ID), "type": "private"},
+                "text": str(params.get("text", "")),
+            }
+            if api_method == "sendDice":
+                result["dice"] = {"emoji": params.get("emoji", "🎲"), "value": 4}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def user_payload(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def message_dict(user_id, text):
+    msg = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user_payload(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": 1, "message": msg}
+
+
+def callback_dict(user_id, data):
+    return {
+        "update_id": 1,
+        "callback_query": {
+            "id": "1",
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "text": "menu"},
+        },
+    }
+
+
+# ======================== СЦЕНАРИИ ========================
+def prepare_game(user_data):
+    user_data.update(game_type='flip', game_choice='1', game_data={'bet': 0.1})
+
+
+def prepare_mines(user_data):
+    user_data['mines_game'] = bot.MinesGame(0.1, 3, [0.9, 0.9, 0.9], None)
+
+
+def prepare_bet(user_data):
+    user_data.update(awaiting='bet_amount', game_type='flip', game_choice='1')
+    bot.db.cursor.execute("UPDATE users SET last_game_time = '0' WHERE user_id = ?", (PLAYER_ID,))
+
+
+def prepare_awaiting(state):
+    return lambda user_data: user_data.update(awaiting=state)
+
+
+# (имя, обработчик, user_id, обновление, подготовка user_data)
+CALLBACKS = [
+    "main_menu", "profile", "rules", "casino_menu", "game_flip", "game_roulette", "game_slots",
+    "game_dice_classic", "dice_number_menu", "dice_even_odd_menu", "game_football", "game_basketball",
+    "game_darts", "game_bowling", "flip_choice_1", "roulette_choice_3", "dice_num_4", "slots_choice_1",
+    "football_goal", "game_mines", "mines_set_3", "case_menu", "referral", "deposit_menu",
+    "withdraw_menu", "withdraw_settings", "noop",
+]
+ADMIN_CALLBACKS = [
+    "admin_panel", "admin_game_settings", "admin_instant_mode", "admin_rtp", "game_setting_slots",
+    "admin_stats_daily", "admin_stats_weekly", "admin_stats_monthly", "admin_withdrawals",
+    "admin_promocodes", "admin_bans", "admin_users", "admin_images",
+]
+
+
+def build_cases():
+    cases = [("start", bot.start, PLAYER_ID, message_dict(PLAYER_ID, "/start"), None)]
+    for data in CALLBACKS:
+        cases.append((data, bot.button_handler, PLAYER_ID, callback_dict(PLAYER_ID, data), None))
+    for data in ADMIN_CALLBACKS:
+        cases.append((data, bot.button_handler, ADMIN_ID, callback_dict(ADMIN_ID, data), None))
+    cases += [
+        ("game_confirm", bot.button_handler, PLAYER_ID, callback_dict(PLAYER_ID, "game_confirm"), prepare_game),
+        ("mines_open_0", bot.button_handler, PLAYER_ID, callback_dict(PLAYER_ID, "mines_open_0"), prepare_mines),
+        ("msg:bet_amount", bot.handle_message, PLAYER_ID, message_dict(PLAYER_ID, "0.5"), prepare_bet),
+        ("msg:promocode", bot.handle_message, PLAYER_ID, message_dict(PLAYER_ID, "NOSUCHCODE"),
+         prepare_awaiting('promocode')),
+        ("msg:no_state", bot.handle_message, PLAYER_ID, message_dict(PLAYER_ID, "hello"), None),
+    ]
+    return cases
+
+
+async def call_once(application, handler, user_id, update_dict, prepare):
+    update = Update.de_json(update_dict, application.bot)
+    context = CallbackContext.from_update(update, application)
+    user_data = application.user_data[user_id]
+    user_data.clear()
+    if prepare:
+        prepare(user_data)
+    if update.message and update.message.text and update.message.text.startswith("/"):
+        context.args = update.message.text.split()[1:]
+    try:
+        await handler(update, context)
+    except Exception as e:
+        # В проде исключение уйдёт в error_handler; в замере фиксируем его
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+async def measure(application, case, iterations, trace):
+    name, handler, user_id, update_dict, prepare = case
+    # Прогрев: кэши SQLite и ленивые импорты не должны попадать в замер
+    error = await call_once(application, handler, user_id, update_dict, prepare)
+    cpu = []
+    for _ in range(iterations):
+        t0 = time.process_time_ns()
+        await call_once(application, handler, user_id, update_dict, prepare)
+        cpu.append(time.process_time_ns() - t0)
+    result = {
+        "cpu_us_median": round(statistics.median(cpu) / 1000, 1),
+        "cpu_us_mean": round(statistics.fmean(cpu) / 1000, 1),
+    }
+    if error:
+        result["error"] = error
+    if trace:
+        peaks, blocks = [], []
+        tracemalloc.start()
+        for _ in range(max(1, iterations // 10)):
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            await call_once(application, handler, user_id, update_dict, prepare)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            peaks.append(peak - base)
+            blocks.append(sum(max(0, s.count_diff) for s in after.compare_to(before, "lineno")))
+        tracemalloc.stop()
+        result["alloc_peak_kb"] = round(statistics.median(peaks) / 1024, 1)
+        result["alloc_new_blocks"] = int(statistics.median(blocks))
+    return result
+
+
+async def main_async(args):
+    logging.disable(logging.CRITICAL)
+    # Планировщик без ограничений: в замер входит его накладной расход, но не ожидание токенов
+    scheduler = bot.OutboundScheduler(global_rate=1e9, chat_rate=1e9, chat_burst=1e9, bulk_reserve=0)
+    ext_bot = ExtBot(os.environ["BOT_TOKEN"], request=NoopRequest(), get_updates_request=NoopRequest(),
+                     rate_limiter=scheduler)
+    application = Application.builder().bot(ext_bot).build()
+    await application.initialize()
+    bot.db.create_user(PLAYER_ID, "player", "Player")
+    bot.db.update_balance(PLAYER_ID, 1_000_000, 'adjustment')
+    bot.db.create_user(ADMIN_ID, "admin", "Admin")
+
+    results = {}
+    for case in build_cases():
+        if args.only and case[0] not in args.only:
+            continue
+        results[case[0]] = await measure(application, case, args.iterations, not args.no_trace)
+    await application.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки обработчиков без сети")
+    parser.add_argument("--iterations", type=int, default=200, help="вызовов на сценарий")
+    parser.add_argument("--only", nargs="*", help="только эти сценарии")
+    parser.add_argument("--no-trace", action="store_true", help="без замера памяти tracemalloc")
+    parser.add_argument("--out", help="сохранить JSON в файл")
+    args = parser.parse_args()
+    results = asyncio.run(main_async(args))
+
+    print(f"{'сценарий':<24}{'CPU мкс (med)':>15}{'CPU мкс (avg)':>15}{'пик КБ':>10}{'блоков':>9}", file=sys.stderr)
+    for name, r in sorted(results.items(), key=lambda kv: -kv[1]["cpu_us_median"]):
+        print(f"{name:<24}{r['cpu_us_median']:>15.1f}{r['cpu_us_mean']:>15.1f}"
+              f"{r.get('alloc_peak_kb', 0):>10.1f}{r.get('alloc_new_blocks', 0):>9}"
+              f"{'  ❌ ' + r['error'] if 'error' in r else ''}", file=sys.stderr)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import logging
+import logging.handlers
+import atexit
 import random
 import sqlite3
 import asyncio
@@ -9,7 +11,22 @@ import time
 import string
 import csv
 import io
+import re
+import bisect
+import functools
+import hashlib
+import hmac
+import secrets
+import threading
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+import gc
+import queue
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from typing import Dict, List, Optional, Any
 import signal
 import sys
@@ -17,10 +34,11 @@ import sys
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, PreCheckoutQuery
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    ContextTypes, MessageHandler, filters, PreCheckoutQueryHandler
+    ContextTypes, MessageHandler, filters, PreCheckoutQueryHandler, TypeHandler, BaseRateLimiter
 )
 from telegram.constants import ParseMode
-from telegram.error import TelegramError, Conflict
+from telegram.request import HTTPXRequest
+from telegram.error import TelegramError, Conflict, RetryAfter, Forbidden
 
 # ======================== РЕГИСТРАЦИЯ АДАПТЕРА ДЛЯ SQLITE ========================
 def adapt_datetime(dt):
@@ -47,7 +65,7 @@ sqlite3.register_converter("DATE", convert_datetime)
 # ======================== НАСТРОЙКА ========================
 TELEGRAM_TOKEN = os.environ.get("BOT_TOKEN", "")
 CRYPTOBOT_API_KEY = os.environ.get("CRYPTOBOT_API_KEY", "")
-CRYPTOBOT_API_URL = "https://pay.crypt.bot/api"
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")
 
 ADMIN_IDS = [int(id) for id in os.environ.get("ADMIN_IDS", "5697184715").split(",")]
 
@@ -64,8 +82,219 @@ RTP_FACTOR = 0.92
 
 MAX_BET_ABSOLUTE = 1000.0
 RATE_LIMIT_SECONDS = 6
+ADMIN_PAGE_SIZE = 8
+DB_WAL = os.environ.get("DB_WAL", "1") == "1"
+GAMES_HOT_DAYS = int(os.environ.get("GAMES_HOT_DAYS", "90"))
+ARCHIVE_MAX_ATTACHED = 8  # SQLite по умолчанию разрешает не больше 10 ATTACH
+PROMO_BULK_MAX = 100_000
+PROMO_BULK_CHUNK = 1000  # кодов пачки на одну транзакцию
+PROMO_BULK_PAUSE = 0.02  # сек между пачками фоновой генерации
+LEDGER_REASONS = ('bet', 'win', 'deposit', 'withdrawal', 'bonus', 'referral', 'promo', 'case',
+                  'refund', 'adjustment', 'opening')
+# 32 символа без похожих I/O/0/1: байт & 31 выбирает символ равномерно
+PROMO_CODE_TABLE = bytes(b"ABCDEFGHJKLMNPQRSTUVWXYZ23456789"[i % 32] for i in range(256))
+
+# ======================== МЕТРИКИ ========================
+# Счётчики, гистограммы и gauge в текстовом формате Prometheus.
+# Отдаются на METRICS_LISTEN:METRICS_PORT/metrics (METRICS_PORT=0 — выключено).
+# Запись в метрику — словарь + bisect под локом, без аллокаций на горячем пути.
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = []
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """(суффикс, значения меток, доп. метка, значение)"""
+        for values, child in list(self._children.items()):
+            yield "", values, "", child.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labelnames, values, extra)} {value:g}")
+        return "\n".join(lines)
+
+class _ValueChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self, lock):
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _ValueChild(self._lock)
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def _new_child(self):
+        return _ValueChild(self._lock)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _samples(self):
+        if self.collect:
+            # Значение считается в момент опроса, а не на каждом событии
+            try:
+                self.set(self.collect())
+            except Exception as e:
+                logger.warning("Метрика %s не посчиталась: %s", self.name, e)
+        yield from super()._samples()
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets, lock):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = lock
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets, self._lock)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            with self._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield "_bucket", values, f'le="{le}"', cumulative
+            yield "_sum", values, "", total
+            yield "_count", values, "", count
+
+def render_metrics():
+    return "\n".join(m.render() for m in METRICS) + "\n"
+
+def timed(child):
+    """Декоратор: время вызова функции в гистограмму"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def instrument_methods(cls, histogram, *labels):
+    """Оборачивает все публичные методы класса замером времени"""
+    for name, func in list(vars(cls).items()):
+        if callable(func) and not name.startswith("_"):
+            setattr(cls, name, timed(histogram.labels(*labels, name))(func))
+    return cls
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Время обработки обновления", ("route",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Необработанные исключения в обработчиках", ("route",))
+DB_LATENCY = Histogram("bot_db_seconds", "Время вызова метода Database", ("method",))
+EXTERNAL_LATENCY = Histogram("bot_external_api_seconds", "Время запросов к внешним API", ("service", "method"))
+TELEGRAM_LATENCY = Histogram("bot_telegram_api_seconds", "Время запросов к Bot API", ("method",))
+TELEGRAM_ERRORS = Counter("bot_telegram_api_errors_total", "Ответы Bot API с ошибкой или сбоем сети", ("method",))
+GAME_BETS = Counter("bot_game_bets_total", "Сыгранные ставки", ("game",))
+GAME_WINS = Counter("bot_game_wins_total", "Выигрышные ставки", ("game",))
+GAME_VOLUME = Counter("bot_game_bet_dollars_total", "Сумма ставок, $", ("game",))
+GAME_PAYOUT = Counter("bot_game_payout_dollars_total", "Сумма выплаченных выигрышей, $", ("game",))
+# Считаются при опросе; источники подставляются в start_metrics
+MINES_ACTIVE = Gauge("bot_mines_games_active", "Незавершённые игры в мины")
+WITHDRAWALS_PENDING = Gauge("bot_withdrawals_pending", "Заявки на вывод в ожидании")
+UPDATES_QUEUED = Gauge("bot_updates_queued", "Обновления в очереди на обработку")
+
+def record_bet(game_type, bet, win):
+    GAME_BETS.labels(game_type).inc()
+    GAME_VOLUME.labels(game_type).inc(bet)
+    if win > 0:
+        GAME_WINS.labels(game_type).inc()
+        GAME_PAYOUT.labels(game_type).inc(win)
 
 # ======================== КУРС TON К ДОЛЛАРУ (РЕАЛЬНЫЙ) ========================
+@timed(EXTERNAL_LATENCY.labels("ton_price", "get_ton_price"))
 def get_ton_price():
     """Получает актуальный курс TON к USD через API"""
     try:
@@ -110,26 +339,119 @@ def get_dollar_to_ton():
 DOLLAR_PER_TON = get_ton_to_dollar()
 TON_PER_DOLLAR = get_dollar_to_ton()
 
-# ======================== УДАЛЕНИЕ ВЕБХУКА ПРИ ЗАПУСКЕ ========================
-try:
-    if TELEGRAM_TOKEN:
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/deleteWebhook",
-            json={"drop_pending_updates": True},
-            timeout=5
-        )
-        if response.status_code == 200:
-            print("✅ Вебхук очищен при загрузке")
-        else:
-            print(f"⚠️ Ошибка очистки вебхука: {response.text}")
-except Exception as e:
-    print(f"⚠️ Ошибка очистки вебхука: {e}")
+# ======================== ВЕБХУК ========================
+# Если задан WEBHOOK_URL, бот принимает обновления через встроенный HTTP-сервер
+# PTB (run_webhook), иначе работает через long polling.
+# Очередь необработанных обновлений при переключении режимов не сбрасывается.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+def get_webhook_secret():
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token.
+    Без WEBHOOK_SECRET выводится из токена, чтобы не меняться между деплоями"""
+    secret = os.environ.get("WEBHOOK_SECRET", "")
+    if secret:
+        return secret
+    return hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+
+# ======================== ЛОГИРОВАНИЕ ========================
+# Обработчики пишут записи в очередь, в stderr их выводит отдельный поток
+# QueueListener. Сообщение собирается из шаблона и аргументов только там,
+# поэтому в логгер передаются %-шаблоны, а не f-строки. Повторы одного
+# предупреждения/ошибки сверх LOG_BURST за LOG_DEDUP_WINDOW секунд
+# отбрасываются, число пропущенных дописывается к следующему прошедшему.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_BURST = int(os.environ.get("LOG_BURST", "5"))
+LOG_DEDUP_WINDOW = float(os.environ.get("LOG_DEDUP_WINDOW", "60"))
+LOG_ACCESS = os.environ.get("LOG_ACCESS", "1") == "1"
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('user_id', 'route', 'latency_ms', 'suppressed')
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        return f"{text} (+{suppressed} повторов пропущено)" if suppressed else text
+
+class DedupFilter(logging.Filter):
+    """Ограничивает повторы WARNING+ с одинаковым шаблоном и типом исключения"""
+
+    def __init__(self, burst=LOG_BURST, window=LOG_DEDUP_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.seen = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        exc_type = record.exc_info[0] if record.exc_info else None
+        key = (record.name, record.levelno, record.msg, exc_type)
+        now = record.created
+        entry = self.seen.get(key)
+        if entry is None or now - entry[0] > self.window:
+            if len(self.seen) > 10000:
+                self.seen.clear()
+            suppressed = entry[2] if entry else 0
+            self.seen[key] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        entry[1] += 1
+        if entry[1] <= self.burst:
+            return True
+        entry[2] += 1
+        return False
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке"""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(DedupFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к Bot API — это уже есть в метриках
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f"{__name__}.access")
 
 # ======================== CRYPTOBOT API ========================
 class CryptoBotAPI:
@@ -144,7 +466,7 @@ class CryptoBotAPI:
         try:
             url = f"{CRYPTOBOT_API_URL}/createInvoice"
             if amount_dollars < MIN_DEPOSIT_DOLLARS:
-                logger.warning(f"Сумма {amount_dollars}$ меньше минимальной")
+                logger.warning("Сумма %s$ меньше минимальной", amount_dollars)
                 return None
             
             # Используем актуальный курс
@@ -163,42 +485,270 @@ class CryptoBotAPI:
                 "paid_btn_url": f"https://t.me/{BOT_USERNAME}",
                 "payload": f"crypto_{int(amount_dollars*100)}_{int(time.time())}"
             }
-            logger.info(f"Создание счёта CryptoBot: {amount_dollars}$ = {ton_amount} TON (курс: {ton_price:.2f}$)")
+            logger.info("Создание счёта CryptoBot: %s$ = %s TON (курс: %.2f$)", amount_dollars, ton_amount, ton_price)
             response = requests.post(url, headers=self.headers, json=payload, timeout=10)
             if response.status_code == 200:
                 data = response.json()
                 if data.get('ok'):
                     return data['result']
                 else:
-                    logger.error(f"Ошибка CryptoBot: {data.get('error')}")
+                    logger.error("Ошибка CryptoBot: %s", data.get('error'))
             else:
-                logger.error(f"HTTP ошибка CryptoBot: {response.status_code}")
+                logger.error("HTTP ошибка CryptoBot: %s", response.status_code)
             return None
         except Exception as e:
-            logger.error(f"Ошибка CryptoBot API: {e}")
+            logger.error("Ошибка CryptoBot API: %s", e)
             return None
 
-    def transfer(self, user_id, amount, currency="TON"):
+    def transfer(self, user_id, amount, spend_id, currency="TON"):
+        """Перевод с идемпотентным spend_id. Возвращает (исход, данные):
+        'completed' — перевод создан, 'failed' — точно не прошёл,
+        'unknown' — ответа нет, исход выясняется через get_transfer"""
+        url = f"{CRYPTOBOT_API_URL}/transfer"
+        payload = {
+            "user_id": user_id,
+            "asset": currency,
+            "amount": str(amount),
+            "spend_id": spend_id
+        }
         try:
-            url = f"{CRYPTOBOT_API_URL}/transfer"
-            payload = {
-                "user_id": user_id,
-                "asset": currency,
-                "amount": str(amount),
-                "spend_id": f"withdraw_{user_id}_{int(time.time())}"
-            }
             response = requests.post(url, headers=self.headers, json=payload, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('ok', False)
-            return False
-        except Exception as e:
-            logger.error(f"Ошибка перевода CryptoBot: {e}")
-            return False
-
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Ошибка перевода CryptoBot %s: %s", spend_id, e)
+            return 'unknown', str(e)
+        if data.get('ok'):
+            return 'completed', data['result']
+        error = data.get('error')
+        name = str(error.get('name') if isinstance(error, dict) else error)
+        logger.error("CryptoBot отклонил перевод %s: %s", spend_id, name)
+        if response.status_code >= 500 or 'SPEND_ID' in name.upper():
+            # Повтор spend_id значит, что первый запрос мог пройти
+            return 'unknown', name
+        return 'failed', name
+
+    def get_transfer(self, spend_id):
+        """Перевод по spend_id или None, если его не было; при сбое — исключение"""
+        response = requests.get(f"{CRYPTOBOT_API_URL}/getTransfers", headers=self.headers,
+                                params={"spend_id": spend_id}, timeout=10)
+        data = response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"getTransfers: {data.get('error')}")
+        items = data['result'].get('items', [])
+        return items[0] if items else None
+
+instrument_methods(CryptoBotAPI, EXTERNAL_LATENCY, "cryptobot")
 crypto = CryptoBotAPI(CRYPTOBOT_API_KEY)
 
+# ======================== ЖУРНАЛ МЕДЛЕННЫХ ЗАПРОСОВ ========================
+# Соединение и курсоры Database засекают каждый execute/executemany/commit,
+# включая фиксацию на выходе из with self.conn.
+# SELECT основную работу делает при выборке строк, поэтому время fetch* и
+# итерации прибавляется к своему запросу, а в журнал он попадает, когда
+# строки кончились, курсор выполнил следующий запрос или закрыт.
+# Запросы дольше SLOW_QUERY_MS собираются по нормализованному SQL (литералы → ?)
+# вместе с формой параметров. EXPLAIN QUERY PLAN первого вхождения снимается
+# лениво, когда журнал читают (/slowqueries): запись в журнал базу не трогает,
+# её можно вызывать откуда угодно, хоть из сборщика мусора.
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "50"))
+SLOW_QUERY_LIMIT = 200
+
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_SPACES = re.compile(r"\s+")
+SQL_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+SLOW_QUERIES_TOTAL = Counter("bot_db_slow_queries_total", "Запросы SQLite дольше SLOW_QUERY_MS")
+
+def normalize_sql(sql):
+    return SQL_SPACES.sub(' ', SQL_LITERALS.sub('?', sql)).strip()
+
+def params_shape(params, many=False):
+    """Типы параметров без значений: в журнал не попадают суммы и id"""
+    if many:
+        params = list(params) if not isinstance(params, (list, tuple)) else params
+        first = params[0] if params else ()
+        return f"{len(params)}×{params_shape(first)}"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    return "(" + ", ".join(type(v).__name__ for v in params) + ")"
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, limit=SLOW_QUERY_LIMIT):
+        self.threshold = threshold_ms / 1000
+        self.limit = limit
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, sql, params, duration, many=False):
+        if duration < self.threshold:
+            return
+        SLOW_QUERIES_TOTAL.inc()
+        key = normalize_sql(sql)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if many:
+                    params = list(params) if not isinstance(params, (list, tuple)) else params
+                entry = self.entries[key] = {
+                    'sql': key, 'count': 0, 'total': 0.0, 'max': 0.0,
+                    'params': params_shape(params, many), 'plan': None, 'last_at': None,
+                    # Исходный запрос для EXPLAIN при чтении журнала
+                    'explain': (sql, next(iter(params), ()) if many else params),
+                }
+                while len(self.entries) > self.limit:
+                    # Вытесняем самый дешёвый запрос, а не самый старый
+                    del self.entries[min(self.entries, key=lambda k: self.entries[k]['total'])]
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['last_at'] = datetime.now()
+
+    @staticmethod
+    def explain(conn, sql, params):
+        if not sql.lstrip().upper().startswith(SQL_EXPLAINABLE):
+            return []
+        try:
+            # Мимо профилирующей обёртки, чтобы EXPLAIN не попадал в журнал
+            rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.Error as e:
+            return [f"EXPLAIN не удался: {e}"]
+
+    def top(self, n=10, conn=None):
+        """Самые дорогие запросы; с conn недостающие планы снимаются в потоке вызывающего"""
+        with self._lock:
+            entries = sorted((e for e in self.entries.values()), key=lambda e: e['total'], reverse=True)[:n]
+        if conn is not None:
+            for entry in entries:
+                if entry['plan'] is None:
+                    entry['plan'] = self.explain(conn, *entry['explain'])
+        with self._lock:
+            return [dict(e) for e in entries]
+
+    def reset(self):
+        with self._lock:
+            self.entries.clear()
+
+slow_queries = SlowQueryLog()
+
+class ProfiledCursor(sqlite3.Cursor):
+    _statement = None  # (sql, params, накопленное время) запроса, чьи строки ещё выбираются
+
+    def _finish(self):
+        if self._statement is not None:
+            sql, params, duration = self._statement
+            self._statement = None
+            slow_queries.record(sql, params, duration)
+
+    def _fetched(self, start, done):
+        sql, params, duration = self._statement
+        self._statement = (sql, params, duration + time.perf_counter() - start)
+        if done:
+            self._finish()
+
+    def execute(self, sql, params=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._statement = (sql, params, time.perf_counter() - start)
+            if self.description is None:
+                self._finish()
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        seq_of_params = list(seq_of_params)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            slow_queries.record(sql, seq_of_params, time.perf_counter() - start, many=True)
+
+    def fetchone(self):
+        if self._statement is None:
+            return super().fetchone()
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        if self._statement is None:
+            return super().fetchmany(size or self.arraysize)
+        start = time.perf_counter()
+        rows = super().fetchmany(size or self.arraysize)
+        self._fetched(start, not rows)
+        return rows
+
+    def fetchall(self):
+        if self._statement is None:
+            return super().fetchall()
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, True)
+        return rows
+
+    def __next__(self):
+        if self._statement is None:
+            return super().__next__()
+        start = time.perf_counter()
+        try:
+            return super().__next__()
+        except StopIteration:
+            self._fetched(start, True)
+            raise
+        finally:
+            if self._statement is not None:
+                self._fetched(start, False)
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Курсор conn.execute(...).fetchone() бросают, не дочитав: запрос пишется при сборке.
+        # Это только запись в память журнала, в базу отсюда не ходим
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+class ProfiledConnection(sqlite3.Connection):
+    """Соединение, у которого все запросы идут через ProfiledCursor"""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            slow_queries.record("COMMIT", (), time.perf_counter() - start)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # with self.conn фиксирует мимо commit(): засекаем здесь же, откат не считаем
+        if exc_type is not None:
+            return super().__exit__(exc_type, exc_value, traceback)
+        start = time.perf_counter()
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            slow_queries.record("COMMIT", (), time.perf_counter() - start)
+
 # ======================== БАЗА ДАННЫХ ========================
+def to_cents(amount):
+    """Доллары → целые центы по десятичной записи числа: 5.005 → 501, половина — от нуля.
+    ROUND(x * 100) в SQLite ошибается на двоичных хвостах, поэтому SQL зовёт эту же функцию как cents()"""
+    return int(Decimal(repr(amount)).scaleb(2).quantize(Decimal(1), ROUND_HALF_UP))
+
 class Database:
     def __init__(self):
         db_path = os.environ.get("DB_PATH", "sakura_game.db")
@@ -209,14 +759,27 @@ class Database:
             except:
                 pass
 
-        self.conn = sqlite3.connect(db_path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.path = db_path
+        self.archive_dir = os.environ.get("ARCHIVE_DIR") or os.path.join(os.path.dirname(db_path) or '.', 'archive')
+        self._archives = OrderedDict()  # псевдоним ATTACH → месяц, в порядке использования
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES,
+                                    factory=ProfiledConnection)
         self.conn.row_factory = sqlite3.Row
+        self.conn.create_function('cents', 1, to_cents, deterministic=True)
         self.cursor = self.conn.cursor()
+        # auto_vacuum действует только на новую базу: старую переведёт лишь ручной VACUUM
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if DB_WAL:
+            # Читатели не ждут писателя; контрольные точки делает задача обслуживания
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
         self._create_tables()
+        self._migrate()
         self._init_admin()
         self._load_images()
         self._init_promocodes()
         self._load_game_settings()
+        self._load_instant_games()
 
     def _create_tables(self):
         self.cursor.execute('''
@@ -309,9 +872,162 @@ class Database:
                 value TEXT
             )
         ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fair_seeds (
+                user_id INTEGER PRIMARY KEY,
+                server_seed TEXT,
+                client_seed TEXT,
+                nonce INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fair_revealed (
+                server_seed_hash TEXT PRIMARY KEY,
+                server_seed TEXT,
+                user_id INTEGER,
+                revealed_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fair_rounds (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                game_type TEXT,
+                server_seed_hash TEXT,
+                client_seed TEXT,
+                nonce INTEGER,
+                params TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                kind TEXT DEFAULT 'text',
+                ref_id INTEGER,
+                text TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                next_attempt_at REAL DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_due ON notifications (status, next_attempt_at)')
+        # Журнал движения денег в центах: только добавление, баланс users — кэш его суммы
+        reasons = ', '.join(f"'{r}'" for r in LEDGER_REASONS)
+        self.cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS ledger (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                reason TEXT NOT NULL CHECK (reason IN ({reasons})),
+                ref_id INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Покрывающий: баланс по журналу суммируется по индексу, без чтения строк таблицы
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_balance ON ledger (user_id, id, amount_cents)')
+        # Проводки со ссылкой на заявку, платёж, активацию; ставки и выигрыши без ref_id сюда не попадают
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_ref ON ledger (reason, ref_id) WHERE ref_id IS NOT NULL')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger
+            BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+        ''')
+        self.cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger
+            BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END
+        ''')
+        # Баланс пользователя на проводке ledger_id: восстановление читает только хвост после снимка
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ledger_snapshots (
+                user_id INTEGER PRIMARY KEY,
+                ledger_id INTEGER,
+                balance_cents INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Итоги по играм, уехавшим в архив: профиль и общая статистика не открывают архивы
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS games_archive_users (
+                user_id INTEGER PRIMARY KEY,
+                games INTEGER,
+                wins INTEGER,
+                losses INTEGER,
+                bet REAL,
+                win REAL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS games_archive_months (
+                month TEXT,
+                game_type TEXT,
+                games INTEGER,
+                bet REAL,
+                win REAL,
+                PRIMARY KEY (month, game_type)
+            )
+        ''')
         self.conn.commit()
         self._init_cases()
 
+    def _add_columns(self, table, columns):
+        existing = {row[1] for row in self.cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+        for name, decl in columns.items():
+            if name not in existing:
+                self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+
+    def _migrate(self):
+        """Колонки и индексы, появившиеся после создания базы"""
+        self._add_columns('withdrawals', {
+            'spend_id': 'TEXT',
+            'payout_amount': 'TEXT',
+            'transfer_id': 'TEXT',
+            'payout_error': 'TEXT',
+            'payout_attempts': 'INTEGER DEFAULT 0',
+        })
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, id)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_banned ON users (user_id) WHERE is_banned = 1')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, id)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_promocodes_expires ON promocodes (expires_at)')
+        # На большой базе строится один раз при первом запуске
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_created ON games (created_at)')
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_promocode_uses_user'").fetchone():
+            # Гонки старой активации могли оставить дубли — уникальный индекс их не примет
+            self.cursor.execute('''
+                DELETE FROM promocode_uses WHERE id NOT IN (SELECT MIN(id) FROM promocode_uses GROUP BY user_id, code)
+            ''')
+            self.cursor.execute('CREATE UNIQUE INDEX idx_promocode_uses_user ON promocode_uses (user_id, code)')
+        if not any(row[1] == 'balance_cents' for row in self.cursor.execute('PRAGMA table_info(users)').fetchall()):
+            # Переход на центы: текущий REAL-баланс становится начальной проводкой журнала
+            self.cursor.execute('ALTER TABLE users ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0')
+            self.cursor.execute('''
+                UPDATE users SET balance_cents = cents(balance), balance = cents(balance) / 100.0
+            ''')
+            self.cursor.execute('''
+                INSERT INTO ledger (user_id, amount_cents, reason)
+                SELECT user_id, balance_cents, 'opening' FROM users WHERE balance_cents != 0 ORDER BY user_id
+            ''')
+        self.cursor.execute('DROP INDEX IF EXISTS idx_ledger_user')  # заменён idx_ledger_balance
+        if not any(row[1] == 'held_cents' for row in self.cursor.execute('PRAGMA table_info(users)').fetchall()):
+            # Холды: pending-заявки держат свою сумму, ставить можно только available = balance − held
+            self.cursor.execute('ALTER TABLE users ADD COLUMN held_cents INTEGER NOT NULL DEFAULT 0')
+            self.cursor.execute('ALTER TABLE users ADD COLUMN available_cents INTEGER NOT NULL DEFAULT 0')
+            self.cursor.execute('''
+                UPDATE users SET held_cents = COALESCE((
+                    SELECT SUM(cents(amount)) FROM withdrawals w WHERE w.user_id = users.user_id AND w.status = 'pending'
+                ), 0)
+            ''')
+            self.cursor.execute('UPDATE users SET available_cents = balance_cents - held_cents')
+        if not self.conn.execute("SELECT 1 FROM settings WHERE key = 'ledger_since'").fetchone():
+            # Платежи и заявки до журнала вошли в начальные проводки: сверка проверяет только новые
+            since = {table: self.conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                     for table in ('payments', 'withdrawals')}
+            self.cursor.execute("INSERT INTO settings (key, value) VALUES ('ledger_since', ?)", (json.dumps(since),))
+        self.conn.commit()
+
     def _init_cases(self):
         self.cursor.execute('SELECT COUNT(*) FROM cases')
         if self.cursor.fetchone()[0] == 0:
@@ -389,6 +1105,21 @@ class Database:
                           ('game_settings', json.dumps(GAME_SETTINGS)))
         self.conn.commit()
 
+    def _load_instant_games(self):
+        global INSTANT_GAMES
+        self.cursor.execute('SELECT value FROM settings WHERE key = ?', ('instant_games',))
+        res = self.cursor.fetchone()
+        if res:
+            try:
+                INSTANT_GAMES = set(json.loads(res[0]))
+            except:
+                pass
+
+    def save_instant_games(self):
+        self.cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                          ('instant_games', json.dumps(sorted(INSTANT_GAMES))))
+        self.conn.commit()
+
     def get_user(self, user_id):
         self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         return self.cursor.fetchone()
@@ -401,12 +1132,92 @@ class Database:
         ''', (user_id, username, first_name, referred_by, is_admin))
         self.conn.commit()
         if referred_by and referred_by not in ADMIN_IDS:
-            self.cursor.execute('UPDATE users SET referrals = referrals + 1, balance = balance + 0.5 WHERE user_id = ?', (referred_by,))
-            self.conn.commit()
+            with self.conn:
+                self.conn.execute('UPDATE users SET referrals = referrals + 1 WHERE user_id = ?', (referred_by,))
+                self._post([(referred_by, 50, 'referral', user_id)])
+
+    # ---------- Деньги: проводка в ledger и кэш баланса в одной транзакции ----------
+    def _post(self, entries):
+        """entries: (user_id, центы, причина, ref_id). Транзакцию открывает и фиксирует вызывающий"""
+        entries = list(entries)
+        self.conn.executemany('''
+            INSERT INTO ledger (user_id, amount_cents, reason, ref_id)
+            SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)
+        ''', ((user_id, cents, reason, ref_id, user_id) for user_id, cents, reason, ref_id in entries))
+        self.conn.executemany('''
+            UPDATE users SET balance_cents = balance_cents + ?, balance = (balance_cents + ?) / 100.0,
+                available_cents = available_cents + ?
+            WHERE user_id = ?
+        ''', ((cents, cents, cents, user_id) for user_id, cents, _, _ in entries))
+
+    # ---------- Холды: pending-заявка держит сумму до решения по ней ----------
+    def _hold(self, user_id, cents):
+        """Резервирует cents из доступного остатка; False — не хватает"""
+        return self.conn.execute('''
+            UPDATE users SET held_cents = held_cents + ?, available_cents = available_cents - ?
+            WHERE user_id = ? AND available_cents >= ?
+        ''', (cents, cents, user_id, cents)).rowcount > 0
+
+    def _release(self, holds):
+        """holds: (user_id, центы) — заявка отклонена или истекла, деньги снова доступны"""
+        self.conn.executemany('''
+            UPDATE users SET held_cents = held_cents - ?, available_cents = available_cents + ? WHERE user_id = ?
+        ''', ((cents, cents, user_id) for user_id, cents in holds))
+
+    def _settle_hold(self, user_id, cents, withdrawal_id):
+        """Заявка уходит в выплату: холд снимается вместе со списанием, доступный остаток не меняется"""
+        if self.conn.execute('''
+            UPDATE users SET balance_cents = balance_cents - ?, balance = (balance_cents - ?) / 100.0,
+                held_cents = held_cents - ?, total_withdrawn = total_withdrawn + ? / 100.0
+            WHERE user_id = ? AND balance_cents >= ?
+        ''', (cents, cents, cents, cents, user_id, cents)).rowcount == 0:
+            return False
+        self.conn.execute('INSERT INTO ledger (user_id, amount_cents, reason, ref_id) VALUES (?, ?, ?, ?)',
+                          (user_id, -cents, 'withdrawal', withdrawal_id))
+        return True
 
-    def update_balance(self, user_id, amount):
-        self.cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-        self.conn.commit()
+    def update_balance(self, user_id, amount, reason, ref_id=None):
+        with self.conn:
+            self._post([(user_id, to_cents(amount), reason, ref_id)])
+
+    def replay_balance(self, user_id):
+        """Баланс в центах по журналу: последний снимок плюс проводки после него"""
+        row = self.conn.execute('SELECT ledger_id, balance_cents FROM ledger_snapshots WHERE user_id = ?',
+                                (user_id,)).fetchone()
+        after, base = (row[0], row[1]) if row else (0, 0)
+        return base + self.conn.execute('''
+            SELECT COALESCE(SUM(amount_cents), 0) FROM ledger WHERE user_id = ? AND id > ?
+        ''', (user_id, after)).fetchone()[0]
+
+    def snapshot_balances(self, limit):
+        """Продвигает снимки на следующие limit проводок. Возвращает число учтённых проводок"""
+        with self.conn:
+            row = self.conn.execute("SELECT value FROM settings WHERE key = 'ledger_snapshot_id'").fetchone()
+            after = int(row[0]) if row else 0
+            count, upto = self.conn.execute('''
+                SELECT COUNT(*), MAX(id) FROM (SELECT id FROM ledger WHERE id > ? ORDER BY id LIMIT ?)
+            ''', (after, limit)).fetchone()
+            if not count:
+                return 0
+            self.conn.execute('''
+                INSERT INTO ledger_snapshots (user_id, ledger_id, balance_cents)
+                SELECT user_id, ?, SUM(amount_cents) FROM ledger WHERE id > ? AND id <= ? GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET ledger_id = excluded.ledger_id,
+                    balance_cents = balance_cents + excluded.balance_cents, created_at = CURRENT_TIMESTAMP
+            ''', (upto, after, upto))
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('ledger_snapshot_id', ?)",
+                              (str(upto),))
+        return count
+
+    def integrity_checked_at(self):
+        """Unix-время последней плановой сверки балансов, 0 — не было"""
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'integrity_checked_at'").fetchone()
+        return float(row[0]) if row else 0.0
+
+    def save_integrity_checked(self, at):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('integrity_checked_at', ?)",
+                              (str(at),))
 
     def add_lost(self, user_id, amount):
         self.cursor.execute('UPDATE users SET total_lost = total_lost + ? WHERE user_id = ?', (amount, user_id))
@@ -435,23 +1246,16 @@ class Database:
         self.cursor.execute('SELECT * FROM cases')
         return self.cursor.fetchall()
 
-    def open_case(self, case_id, user_id):
+    def open_case(self, case_id, user_id, r=None):
         try:
             self.cursor.execute('SELECT * FROM cases WHERE id = ?', (case_id,))
             case = self.cursor.fetchone()
             if not case:
                 return None
             items = json.loads(case[3])
-            total = sum(item['chance'] for item in items)
-            r = random.uniform(0, total)
-            cur = 0
-            for item in items:
-                cur += item['chance']
-                if r <= cur:
-                    return item
-            return None
+            return pick_case_item(items, random.random() if r is None else r)
         except Exception as e:
-            logger.error(f"Ошибка открытия кейса: {e}")
+            logger.error("Ошибка открытия кейса: %s", e)
             return None
 
     def get_user_stats(self, user_id):
@@ -461,24 +1265,29 @@ class Database:
                    SUM(bet), SUM(win)
             FROM games WHERE user_id = ?
         ''', (user_id,))
-        return self.cursor.fetchone()
+        hot = self.cursor.fetchone()
+        archived = self.conn.execute('''
+            SELECT games, wins, losses, bet, win FROM games_archive_users WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+        if not archived:
+            return hot
+        return tuple(a if h is None else h + a for h, a in zip(hot, archived))
+
+    def daily_bonus_available(self, user_id):
+        today = datetime.now().date().isoformat()
+        self.cursor.execute('SELECT daily_bonus FROM users WHERE user_id = ?', (user_id,))
+        res = self.cursor.fetchone()
+        return not res or not res[0] or res[0] < today
 
-    def check_daily_bonus(self, user_id):
+    def check_daily_bonus(self, user_id, r=None):
         today = datetime.now().date().isoformat()
         self.cursor.execute('SELECT daily_bonus FROM users WHERE user_id = ?', (user_id,))
         res = self.cursor.fetchone()
         if not res or not res[0] or res[0] < today:
-            r = random.random()
-            if r < 0.5:
-                bonus = 0.05
-            elif r < 0.8:
-                bonus = 0.10
-            elif r < 0.95:
-                bonus = 0.20
-            else:
-                bonus = 0.50
-            self.cursor.execute('UPDATE users SET daily_bonus = ?, balance = balance + ? WHERE user_id = ?', (today, bonus, user_id))
-            self.conn.commit()
+            bonus = daily_bonus_amount(random.random() if r is None else r)
+            with self.conn:
+                self.conn.execute('UPDATE users SET daily_bonus = ? WHERE user_id = ?', (today, user_id))
+                self._post([(user_id, to_cents(bonus), 'bonus', None)])
             return bonus
         return 0.0
 
@@ -494,23 +1303,29 @@ class Database:
         self.cursor.execute('SELECT * FROM payments WHERE invoice_id = ?', (invoice_id,))
         payment = self.cursor.fetchone()
         if payment:
-            self.cursor.execute('UPDATE payments SET status = "completed" WHERE invoice_id = ?', (invoice_id,))
-            self.update_balance(payment[1], payment[2])
-            self.conn.commit()
+            with self.conn:
+                # Повторное подтверждение того же счёта не зачисляет второй раз
+                if self.conn.execute('''
+                    UPDATE payments SET status = 'completed' WHERE invoice_id = ? AND status != 'completed'
+                ''', (invoice_id,)).rowcount:
+                    self._post([(payment[1], to_cents(payment[2]), 'deposit', payment[0])])
             return True
         return False
 
     def create_withdrawal(self, user_id, amount, method, wallet):
-        self.cursor.execute('''
-            INSERT INTO withdrawals (user_id, amount, method, wallet)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, amount, method, wallet))
-        self.conn.commit()
-        return self.cursor.lastrowid
+        """Заявка вместе с холдом её суммы. None — доступного остатка не хватает"""
+        with self.conn:
+            if not self._hold(user_id, to_cents(amount)):
+                return None
+            return self.conn.execute('''
+                INSERT INTO withdrawals (user_id, amount, method, wallet)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, amount, method, wallet)).lastrowid
 
     def get_pending_withdrawals(self):
         self.cursor.execute('''
-            SELECT w.*, u.username, u.first_name
+            SELECT w.id, w.user_id, w.amount, w.method, w.wallet, w.status, w.created_at, u.username, u.first_name,
+                   w.payout_error
             FROM withdrawals w
             JOIN users u ON w.user_id = u.user_id
             WHERE w.status = 'pending'
@@ -518,42 +1333,244 @@ class Database:
         ''')
         return self.cursor.fetchall()
 
-    def approve_withdrawal(self, withdrawal_id, admin_id):
-        self.cursor.execute('''
-            SELECT user_id, amount FROM withdrawals WHERE id = ? AND status = 'pending'
+    # ---------- Пакетная обработка заявок: одна транзакция на весь диапазон ----------
+    def approve_withdrawals(self, first_id, last_id, admin_id):
+        """Одобряет pending-заявки с id в [first_id, last_id] и списывает баланс вместе с их холдами.
+        Заявки одного пользователя берутся по порядку, пока их нарастающая сумма
+        покрыта балансом (с холдами это так всегда, кроме заявок старше холдов).
+        Возвращает [(id, user_id, amount)] одобренных"""
+        with self.conn:
+            self.conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS bulk_withdrawals (
+                    id INTEGER PRIMARY KEY, user_id INTEGER, amount REAL, cents INTEGER)
+            ''')
+            self.conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS bulk_totals (user_id INTEGER PRIMARY KEY, total INTEGER)
+            ''')
+            self.conn.execute('DELETE FROM bulk_withdrawals')
+            self.conn.execute('DELETE FROM bulk_totals')
+            self.conn.execute('''
+                INSERT INTO bulk_withdrawals (id, user_id, amount, cents)
+                SELECT id, user_id, amount, cents FROM (
+                    SELECT id, user_id, amount, cents, balance_cents,
+                           SUM(cents) OVER (PARTITION BY user_id ORDER BY id) AS running
+                    FROM (
+                        SELECT w.id, w.user_id, w.amount, cents(w.amount) AS cents, u.balance_cents
+                        FROM withdrawals w JOIN users u ON u.user_id = w.user_id
+                        WHERE w.status = 'pending' AND w.id BETWEEN ? AND ?
+                    )
+                ) WHERE running <= balance_cents
+            ''', (first_id, last_id))
+            self.conn.execute('''
+                UPDATE withdrawals SET status = 'approved', admin_id = ?, processed_at = CURRENT_TIMESTAMP
+                WHERE id IN (SELECT id FROM bulk_withdrawals)
+            ''', (admin_id,))
+            self.conn.execute('''
+                INSERT INTO bulk_totals (user_id, total) SELECT user_id, SUM(cents) FROM bulk_withdrawals GROUP BY user_id
+            ''')
+            self.conn.execute('''
+                INSERT INTO ledger (user_id, amount_cents, reason, ref_id)
+                SELECT user_id, -cents, 'withdrawal', id FROM bulk_withdrawals ORDER BY id
+            ''')
+            self.conn.execute('''
+                UPDATE users SET
+                    balance_cents = balance_cents - (SELECT total FROM bulk_totals t WHERE t.user_id = users.user_id),
+                    balance = (balance_cents - (SELECT total FROM bulk_totals t WHERE t.user_id = users.user_id)) / 100.0,
+                    held_cents = held_cents - (SELECT total FROM bulk_totals t WHERE t.user_id = users.user_id),
+                    total_withdrawn = total_withdrawn + (SELECT total FROM bulk_totals t WHERE t.user_id = users.user_id) / 100.0
+                WHERE user_id IN (SELECT user_id FROM bulk_totals)
+            ''')
+            return self.conn.execute('SELECT id, user_id, amount FROM bulk_withdrawals ORDER BY id').fetchall()
+
+    def complete_withdrawals(self, first_id, last_id, admin_id):
+        """Отмечает выданными approved-заявки из диапазона. Возвращает [(id, user_id, amount)]"""
+        with self.conn:
+            rows = self.conn.execute('''
+                SELECT id, user_id, amount FROM withdrawals WHERE status = 'approved' AND id BETWEEN ? AND ? ORDER BY id
+            ''', (first_id, last_id)).fetchall()
+            self.conn.execute('''
+                UPDATE withdrawals SET status = 'completed', admin_id = ?, processed_at = CURRENT_TIMESTAMP
+                WHERE status = 'approved' AND id BETWEEN ? AND ?
+            ''', (admin_id, first_id, last_id))
+        return rows
+
+    def withdrawal_summary(self, status):
+        """(количество, сумма, максимальный id) заявок в статусе — по индексу (status, id)"""
+        return tuple(self.conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(amount), 0), MAX(id) FROM withdrawals WHERE status = ?
+        ''', (status,)).fetchone())
+
+    def reject_withdrawal(self, withdrawal_id, admin_id, reason):
+        with self.conn:
+            row = self.conn.execute('''
+                SELECT user_id, amount FROM withdrawals WHERE id = ? AND status = 'pending'
+            ''', (withdrawal_id,)).fetchone()
+            if not row:
+                return False
+            self.conn.execute('''
+                UPDATE withdrawals SET status = 'rejected', admin_id = ?, reject_reason = ?, processed_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (admin_id, reason, withdrawal_id))
+            self._release([(row[0], to_cents(row[1]))])
+        return True
+
+    # ---------- Автовыплаты: pending → paying → completed | unknown → review ----------
+    def count_auto_payouts(self, max_amount):
+        return self.conn.execute('''
+            SELECT COUNT(*) FROM withdrawals
+            WHERE status = 'pending' AND amount <= ? AND payout_error IS NULL
+        ''', (max_amount,)).fetchone()[0]
+
+    def claim_auto_payouts(self, max_amount, limit, ton_price):
+        """Переводит заявки в paying, списывая баланс, — всё одной транзакцией.
+        spend_id выводится из id заявки, сумма в TON фиксируется до перевода"""
+        rows = self.conn.execute('''
+            SELECT w.id, w.user_id, w.amount FROM withdrawals w
+            JOIN users u ON u.user_id = w.user_id
+            WHERE w.status = 'pending' AND w.amount <= ? AND w.payout_error IS NULL AND u.is_banned = 0
+            ORDER BY w.id LIMIT ?
+        ''', (max_amount, limit)).fetchall()
+        claimed = []
+        for wid, user_id, amount in rows:
+            if not self._settle_hold(user_id, to_cents(amount), wid):
+                self.conn.execute("UPDATE withdrawals SET payout_error = 'Недостаточно средств' WHERE id = ?", (wid,))
+                continue
+            spend_id = f"withdrawal_{wid}"
+            payout_amount = f"{amount / ton_price:.4f}"
+            self.conn.execute('''
+                UPDATE withdrawals SET status = 'paying', spend_id = ?, payout_amount = ?,
+                    payout_attempts = payout_attempts + 1
+                WHERE id = ? AND status = 'pending'
+            ''', (spend_id, payout_amount, wid))
+            claimed.append({'id': wid, 'user_id': user_id, 'amount': amount,
+                            'spend_id': spend_id, 'payout_amount': payout_amount, 'payout_attempts': 1})
+        self.conn.commit()
+        return claimed
+
+    def get_unsettled_payouts(self):
+        rows = self.conn.execute('''
+            SELECT id, user_id, amount, spend_id, payout_amount, payout_attempts, status
+            FROM withdrawals WHERE status IN ('paying', 'unknown') ORDER BY id
+        ''').fetchall()
+        return [dict(row) for row in rows]
+
+    def retry_payout(self, withdrawal_id):
+        self.conn.execute('''
+            UPDATE withdrawals SET status = 'paying', payout_attempts = payout_attempts + 1
+            WHERE id = ? AND status IN ('paying', 'unknown')
         ''', (withdrawal_id,))
-        w = self.cursor.fetchone()
-        if not w:
-            return False
-        user_id, amount = w
-        user = self.get_user(user_id)
-        if user[3] < amount:
-            return False
-        self.update_balance(user_id, -amount)
-        self.cursor.execute('''
-            UPDATE withdrawals SET status = 'approved', admin_id = ?, processed_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (admin_id, withdrawal_id))
         self.conn.commit()
-        self.cursor.execute('UPDATE users SET total_withdrawn = total_withdrawn + ? WHERE user_id = ?', (amount, user_id))
+
+    def complete_payout(self, withdrawal_id, transfer_id):
+        cur = self.conn.execute('''
+            UPDATE withdrawals SET status = 'completed', transfer_id = ?, payout_error = NULL,
+                processed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status IN ('paying', 'unknown')
+        ''', (str(transfer_id), withdrawal_id))
+        self.conn.commit()
+        return cur.rowcount > 0
+
+    def fail_payout(self, withdrawal_id, error):
+        """Перевод точно не прошёл: деньги назад под холд, заявка — в ручную очередь"""
+        row = self.conn.execute('''
+            SELECT user_id, amount FROM withdrawals WHERE id = ? AND status IN ('paying', 'unknown')
+        ''', (withdrawal_id,)).fetchone()
+        if not row:
+            return False
+        cents = to_cents(row[1])
+        self._post([(row[0], cents, 'refund', withdrawal_id)])
+        self.conn.execute('''
+            UPDATE users SET held_cents = held_cents + ?, available_cents = available_cents - ?,
+                total_withdrawn = total_withdrawn - ?
+            WHERE user_id = ?
+        ''', (cents, cents, row[1], row[0]))
+        self.conn.execute('''
+            UPDATE withdrawals SET status = 'pending', payout_error = ? WHERE id = ?
+        ''', (error, withdrawal_id))
         self.conn.commit()
         return True
 
-    def complete_withdrawal(self, withdrawal_id, admin_id):
-        self.cursor.execute('''
-            UPDATE withdrawals SET status = 'completed', admin_id = ?, processed_at = CURRENT_TIMESTAMP
-            WHERE id = ? AND status = 'approved'
-        ''', (admin_id, withdrawal_id))
+    def mark_payout_unknown(self, withdrawal_id, error):
+        self.conn.execute('''
+            UPDATE withdrawals SET status = 'unknown', payout_error = ? WHERE id = ? AND status = 'paying'
+        ''', (error, withdrawal_id))
         self.conn.commit()
-        return self.cursor.rowcount > 0
 
-    def reject_withdrawal(self, withdrawal_id, admin_id, reason):
-        self.cursor.execute('''
-            UPDATE withdrawals SET status = 'rejected', admin_id = ?, reject_reason = ?, processed_at = CURRENT_TIMESTAMP
-            WHERE id = ? AND status = 'pending'
-        ''', (admin_id, reason, withdrawal_id))
+    def send_payout_to_review(self, withdrawal_id):
+        """Попытки кончились, перевода в CryptoBot нет: сверка заявку больше не трогает, решает админ"""
+        cur = self.conn.execute('''
+            UPDATE withdrawals SET status = 'review' WHERE id = ? AND status = 'unknown'
+        ''', (withdrawal_id,))
+        self.conn.commit()
+        return cur.rowcount > 0
+
+    def get_payouts_in_review(self, limit):
+        return self.conn.execute('''
+            SELECT w.id, w.user_id, w.amount, w.spend_id, w.payout_attempts, w.payout_error, u.username
+            FROM withdrawals w JOIN users u ON u.user_id = w.user_id
+            WHERE w.status = 'review' ORDER BY w.id LIMIT ?
+        ''', (limit,)).fetchall()
+
+    def resolve_payout(self, withdrawal_id, admin_id, transferred):
+        """Решение админа по заявке на проверке: перевод был — completed, не было — деньги
+        возвращаются проводкой refund и заявка отклоняется. Возвращает (user_id, amount) или None"""
+        with self.conn:
+            row = self.conn.execute('''
+                SELECT user_id, amount FROM withdrawals WHERE id = ? AND status = 'review'
+            ''', (withdrawal_id,)).fetchone()
+            if not row:
+                return None
+            if transferred:
+                self.conn.execute('''
+                    UPDATE withdrawals SET status = 'completed', admin_id = ?, payout_error = NULL,
+                        processed_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (admin_id, withdrawal_id))
+            else:
+                self._post([(row[0], to_cents(row[1]), 'refund', withdrawal_id)])
+                self.conn.execute('UPDATE users SET total_withdrawn = total_withdrawn - ? WHERE user_id = ?',
+                                  (row[1], row[0]))
+                self.conn.execute('''
+                    UPDATE withdrawals SET status = 'rejected', admin_id = ?, reject_reason = ?,
+                        processed_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (admin_id, 'Автовыплата не прошла, средства возвращены', withdrawal_id))
+        return tuple(row)
+
+    # ---------- Очередь уведомлений ----------
+    def enqueue_notifications(self, rows):
+        """rows: (chat_id, kind, ref_id, text); отправит dispatch_notifications"""
+        self.conn.executemany('''
+            INSERT INTO notifications (chat_id, kind, ref_id, text) VALUES (?, ?, ?, ?)
+        ''', rows)
+        self.conn.commit()
+
+    def get_due_notifications(self, limit):
+        """Для уведомлений о заявках сразу подтягивает её текущий статус"""
+        rows = self.conn.execute('''
+            SELECT n.id, n.chat_id, n.kind, n.ref_id, n.text, n.attempts,
+                   w.status AS ref_status, w.amount AS ref_amount, u.username AS ref_username
+            FROM notifications n
+            LEFT JOIN withdrawals w ON n.kind = 'withdrawal' AND w.id = n.ref_id
+            LEFT JOIN users u ON u.user_id = w.user_id
+            WHERE n.status = 'pending' AND n.next_attempt_at <= ?
+            ORDER BY n.id LIMIT ?
+        ''', (time.time(), limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_notifications(self, ids):
+        self.conn.executemany('DELETE FROM notifications WHERE id = ?', ((i,) for i in ids))
         self.conn.commit()
-        return self.cursor.rowcount > 0
+
+    def defer_notifications(self, ids, delay, error, final):
+        self.conn.executemany('''
+            UPDATE notifications SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?, status = ?
+            WHERE id = ?
+        ''', ((error, time.time() + delay, 'failed' if final else 'pending', i) for i in ids))
+        self.conn.commit()
+
+    def count_queued_notifications(self):
+        return self.conn.execute("SELECT COUNT(*) FROM notifications WHERE status = 'pending'").fetchone()[0]
 
     def get_user_withdrawals(self, user_id):
         self.cursor.execute('''
@@ -574,6 +1591,35 @@ class Database:
         self.conn.commit()
         return code
 
+    def generate_promocodes(self, count, amount, days_valid, max_uses, created_by, length=8, conn=None):
+        """Пачка уникальных кодов, по PROMO_BULK_CHUNK на транзакцию. Возвращает (коды, expires_at).
+        conn — своё соединение фонового потока: общий курсор Database тогда не трогается"""
+        conn = conn or self.conn
+        expires_at = (datetime.now() + timedelta(days=days_valid)).date().isoformat()
+        # Повторы отсекаются по множеству в памяти, без обращения к индексу на каждый код
+        taken = {row[0] for row in conn.execute('SELECT code FROM promocodes')}
+        codes = []
+        while len(codes) < count:
+            raw = secrets.token_bytes(length * (count - len(codes))).translate(PROMO_CODE_TABLE).decode()
+            for i in range(0, len(raw), length):
+                code = raw[i:i + length]
+                if code not in taken:
+                    taken.add(code)
+                    codes.append(code)
+        # Между пачками блокировку записи берут обработчики; упавшая пачка оставит в базе
+        # только никому не выданные коды, их уберёт purge_promocodes по сроку
+        for start in range(0, len(codes), PROMO_BULK_CHUNK):
+            with conn:
+                conn.executemany('''
+                    INSERT INTO promocodes (code, amount, expires_at, max_uses, created_by)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', ((code, amount, expires_at, max_uses, created_by) for code in codes[start:start + PROMO_BULK_CHUNK]))
+            if conn is not self.conn:
+                # Без паузы поток сразу берёт блокировку снова, и ждущий её цикл бота
+                # засыпает в busy-ожидании SQLite на десятки миллисекунд подряд
+                time.sleep(PROMO_BULK_PAUSE)
+        return codes, expires_at
+
     def get_promocode_info(self, code):
         self.cursor.execute('SELECT * FROM promocodes WHERE code = ?', (code,))
         return self.cursor.fetchone()
@@ -581,33 +1627,46 @@ class Database:
     def activate_promocode(self, user_id, code):
         promo = self.get_promocode_info(code)
         if not promo:
-            return {'success': False, 'reason': '❌ Код не найден'}
+            return promo_result('not_found')
         if promo[3] and datetime.now().date().isoformat() > promo[3]:
-            return {'success': False, 'reason': '❌ Промокод истёк'}
-        if promo[4] > 0 and promo[5] >= promo[4]:
-            return {'success': False, 'reason': '❌ Промокод использован максимальное количество раз'}
-        self.cursor.execute('SELECT * FROM promocode_uses WHERE user_id = ? AND code = ?', (user_id, code))
-        if self.cursor.fetchone():
-            return {'success': False, 'reason': '❌ Вы уже активировали этот промокод'}
-        self.update_balance(user_id, promo[2])
-        self.cursor.execute('INSERT INTO promocode_uses (user_id, code) VALUES (?, ?)', (user_id, code))
-        self.cursor.execute('UPDATE promocodes SET used_count = used_count + 1 WHERE code = ?', (code,))
-        self.conn.commit()
-        return {'success': True, 'amount': promo[2]}
-
-    def get_all_promocodes(self):
-        self.cursor.execute('SELECT * FROM promocodes ORDER BY created_at DESC')
-        return self.cursor.fetchall()
+            return promo_result('expired')
+        return promo_result(self.redeem_promocodes([(user_id, code, promo[2])])[0], promo[2])
+
+    def redeem_promocodes(self, requests):
+        """Активирует пачку (user_id, code, amount) одной транзакцией. Исход каждой:
+        'ok', 'used' — уже активировал, 'exhausted' — лимит исчерпан или код истёк.
+        Лимит проверяет условный UPDATE, повтор — уникальный индекс, так что
+        активаций не бывает больше max_uses при любом числе параллельных запросов"""
+        today = datetime.now().date().isoformat()
+        outcomes = []
+        with self.conn:
+            for user_id, code, amount in requests:
+                cur = self.conn.execute('INSERT OR IGNORE INTO promocode_uses (user_id, code) VALUES (?, ?)',
+                                        (user_id, code))
+                if cur.rowcount == 0:
+                    outcomes.append('used')
+                    continue
+                use_id = cur.lastrowid
+                if self.conn.execute('''
+                    UPDATE promocodes SET used_count = used_count + 1
+                    WHERE code = ? AND (max_uses = 0 OR used_count < max_uses)
+                          AND (expires_at IS NULL OR expires_at >= ?)
+                ''', (code, today)).rowcount == 0:
+                    self.conn.execute('DELETE FROM promocode_uses WHERE id = ?', (use_id,))
+                    outcomes.append('exhausted')
+                    continue
+                self._post([(user_id, to_cents(amount), 'promo', use_id)])
+                outcomes.append('ok')
+        return outcomes
 
     def _get_most_popular_game(self, since):
-        self.cursor.execute('''
-            SELECT game_type, COUNT(*) as cnt FROM games
-            WHERE created_at >= ?
-            GROUP BY game_type
-            ORDER BY cnt DESC
-            LIMIT 1
-        ''', (since,))
-        row = self.cursor.fetchone()
+        counts = {}
+        for source in self._game_sources(since):
+            for game_type, cnt in self.conn.execute(f'''
+                SELECT game_type, COUNT(*) FROM {source} WHERE created_at >= ? GROUP BY game_type
+            ''', (since,)):
+                counts[game_type] = counts.get(game_type, 0) + cnt
+        row = max(counts.items(), key=lambda kv: kv[1]) if counts else None
         if row:
             names = {
                 'flip': '🪙 Орёл и решка',
@@ -628,8 +1687,7 @@ class Database:
         since = f"{today} 00:00:00"
         self.cursor.execute('SELECT COUNT(*) FROM users WHERE created_at >= ?', (since,))
         new_users = self.cursor.fetchone()[0]
-        self.cursor.execute('SELECT COUNT(*) FROM games WHERE created_at >= ?', (since,))
-        games = self.cursor.fetchone()[0]
+        games = self.count_games(since)
         self.cursor.execute('SELECT SUM(amount) FROM payments WHERE created_at >= ? AND status = "completed"', (since,))
         deposits = self.cursor.fetchone()[0] or 0.0
         self.cursor.execute('SELECT SUM(amount) FROM withdrawals WHERE processed_at >= ? AND status = "completed"', (since,))
@@ -649,8 +1707,7 @@ class Database:
         week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
         self.cursor.execute('SELECT COUNT(*) FROM users WHERE created_at >= ?', (week_ago,))
         new_users = self.cursor.fetchone()[0]
-        self.cursor.execute('SELECT COUNT(*) FROM games WHERE created_at >= ?', (week_ago,))
-        games = self.cursor.fetchone()[0]
+        games = self.count_games(week_ago)
         self.cursor.execute('SELECT SUM(amount) FROM payments WHERE created_at >= ? AND status = "completed"', (week_ago,))
         deposits = self.cursor.fetchone()[0] or 0.0
         self.cursor.execute('SELECT SUM(amount) FROM withdrawals WHERE processed_at >= ? AND status = "completed"', (week_ago,))
@@ -670,8 +1727,7 @@ class Database:
         month_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
         self.cursor.execute('SELECT COUNT(*) FROM users WHERE created_at >= ?', (month_ago,))
         new_users = self.cursor.fetchone()[0]
-        self.cursor.execute('SELECT COUNT(*) FROM games WHERE created_at >= ?', (month_ago,))
-        games = self.cursor.fetchone()[0]
+        games = self.count_games(month_ago)
         self.cursor.execute('SELECT SUM(amount) FROM payments WHERE created_at >= ? AND status = "completed"', (month_ago,))
         deposits = self.cursor.fetchone()[0] or 0.0
         self.cursor.execute('SELECT SUM(amount) FROM withdrawals WHERE processed_at >= ? AND status = "completed"', (month_ago,))
@@ -706,18 +1762,66 @@ class Database:
         self.conn.commit()
         return True
 
-    def get_banned_users(self):
-        self.cursor.execute('SELECT user_id, username, first_name FROM users WHERE is_banned = 1')
-        return self.cursor.fetchall()
+    # ---------- Постраничные списки для админки ----------
+    def _keyset_page(self, select, conditions, params, key, after=None, before=None,
+                     limit=ADMIN_PAGE_SIZE, descending=False):
+        """Страница по индексу key вместо OFFSET: after — следующая страница,
+        before — предыдущая. Возвращает (строки, есть_назад, есть_вперёд)"""
+        conditions = list(conditions)
+        params = list(params)
+        backwards = before is not None
+        if after is not None or backwards:
+            conditions.append(f"{key} {'<' if descending != backwards else '>'} ?")
+            params.append(before if backwards else after)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = 'DESC' if descending != backwards else 'ASC'
+        rows = self.conn.execute(f"{select}{where} ORDER BY {key} {order} LIMIT ?",
+                                 params + [limit + 1]).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+            return rows, more, True
+        return rows, after is not None, more
+
+    def get_pending_withdrawals_page(self, after=None, before=None):
+        return self._keyset_page('''
+            SELECT w.id, w.user_id, w.amount, w.method, w.wallet, w.status, w.created_at, u.username, u.first_name,
+                   w.payout_error
+            FROM withdrawals w JOIN users u ON w.user_id = u.user_id''',
+            ["w.status = 'pending'"], [], 'w.id', after, before)
+
+    def get_promocodes_page(self, after=None, before=None):
+        return self._keyset_page('SELECT id, code, amount, expires_at, max_uses, used_count FROM promocodes',
+                                 [], [], 'id', after, before, descending=True)
+
+    def get_banned_users_page(self, after=None, before=None):
+        return self._keyset_page('SELECT user_id, username, first_name FROM users',
+                                 ['is_banned = 1'], [], 'user_id', after, before)
+
+    def get_users_page(self, after=None, before=None):
+        return self._keyset_page('SELECT user_id, username, first_name, balance, is_banned FROM users',
+                                 [], [], 'user_id', after, before)
+
+    def count_promocodes(self):
+        return self.conn.execute('SELECT COUNT(*) FROM promocodes').fetchone()[0]
+
+    def count_banned_users(self):
+        return self.conn.execute('SELECT COUNT(*) FROM users WHERE is_banned = 1').fetchone()[0]
+
+    def count_users(self):
+        return self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
 
     def get_total_stats(self):
         self.cursor.execute('SELECT COUNT(*) FROM users')
         total_users = self.cursor.fetchone()[0]
-        self.cursor.execute('SELECT SUM(balance) FROM users')
-        total_balance = self.cursor.fetchone()[0] or 0.0
+        self.cursor.execute('SELECT SUM(balance_cents) FROM users')
+        total_balance = (self.cursor.fetchone()[0] or 0) / 100
         self.cursor.execute('SELECT SUM(total_withdrawn) FROM users')
         total_withdrawn = self.cursor.fetchone()[0] or 0.0
-        self.cursor.execute('SELECT COUNT(*) FROM games')
+        self.cursor.execute('''
+            SELECT (SELECT COUNT(*) FROM games) + (SELECT COALESCE(SUM(games), 0) FROM games_archive_months)
+        ''')
         total_games = self.cursor.fetchone()[0]
         return {
             'total_users': total_users,
@@ -726,13 +1830,144 @@ class Database:
             'total_games': total_games
         }
 
-    def cleanup_old_pending(self):
-        week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-        self.cursor.execute('''
-            UPDATE withdrawals SET status = 'expired'
-            WHERE status = 'pending' AND created_at < ?
-        ''', (week_ago,))
-        self.conn.commit()
+    # ---------- Архив игр: горячая таблица + помесячные файлы archive/games_YYYY_MM.db ----------
+    def _attach_archive(self, month, create=False):
+        """Подключает архив месяца (ГГГГ-ММ) и возвращает псевдоним; лишние архивы отключаются"""
+        alias = f"games_{month.replace('-', '_')}"
+        if alias in self._archives:
+            self._archives.move_to_end(alias)
+            return alias
+        path = os.path.join(self.archive_dir, f"{alias}.db")
+        if not create and not os.path.exists(path):
+            return None
+        while len(self._archives) >= ARCHIVE_MAX_ATTACHED:
+            old, _ = self._archives.popitem(last=False)
+            self.conn.execute(f'DETACH DATABASE {old}')
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.conn.execute('ATTACH DATABASE ? AS ' + alias, (path,))
+        self._archives[alias] = month
+        if create:
+            self.conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {alias}.games (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    game_type TEXT,
+                    bet REAL,
+                    multiplier REAL,
+                    win REAL,
+                    result TEXT,
+                    created_at TEXT
+                )
+            ''')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_games_user ON games (user_id)')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_games_created ON games (created_at)')
+            self.conn.commit()
+        return alias
+
+    def _game_sources(self, since=None):
+        """Таблицы, где лежат игры не старше since: архивы нужных месяцев, затем горячая"""
+        months = self.conn.execute('''
+            SELECT DISTINCT month FROM games_archive_months WHERE month >= ? ORDER BY month
+        ''', ((since or '')[:7],)).fetchall()
+        for (month,) in months:
+            alias = self._attach_archive(month)
+            if alias:
+                yield f"{alias}.games"
+        yield "main.games"
+
+    def count_games(self, since=None):
+        return sum(self.conn.execute(f'SELECT COUNT(*) FROM {source} WHERE created_at >= ?',
+                                     (since or '',)).fetchone()[0]
+                   for source in self._game_sources(since))
+
+    def archive_games(self, before, limit):
+        """Переносит до limit самых старых игр, если они старше before, в архив их месяца.
+        Вставка в архив идемпотентна: после сбоя между файлами пачка просто повторится"""
+        oldest = self.conn.execute('SELECT MIN(created_at) FROM games').fetchone()[0]
+        if not oldest or oldest >= before:
+            return 0
+        month = oldest[:7]
+        year, mon = map(int, month.split('-'))
+        next_month = f"{year + mon // 12:04d}-{mon % 12 + 1:02d}-01"
+        alias = self._attach_archive(month, create=True)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+        with self.conn:
+            self.conn.execute('DELETE FROM archive_batch')
+            moved = self.conn.execute('''
+                INSERT INTO archive_batch (id) SELECT id FROM games
+                WHERE created_at >= ? AND created_at < ? ORDER BY created_at LIMIT ?
+            ''', (oldest, min(before, next_month), limit)).rowcount
+            self.conn.execute(f'''
+                INSERT OR IGNORE INTO {alias}.games
+                SELECT id, user_id, game_type, bet, multiplier, win, result, created_at FROM main.games
+                WHERE id IN (SELECT id FROM archive_batch)
+            ''')
+            self.conn.execute('''
+                INSERT INTO games_archive_users (user_id, games, wins, losses, bet, win)
+                SELECT user_id, COUNT(*), SUM(win > 0), SUM(win = 0), SUM(bet), SUM(win) FROM main.games
+                WHERE id IN (SELECT id FROM archive_batch) GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    games = games + excluded.games, wins = wins + excluded.wins, losses = losses + excluded.losses,
+                    bet = bet + excluded.bet, win = win + excluded.win
+            ''')
+            self.conn.execute('''
+                INSERT INTO games_archive_months (month, game_type, games, bet, win)
+                SELECT ?, game_type, COUNT(*), SUM(bet), SUM(win) FROM main.games
+                WHERE id IN (SELECT id FROM archive_batch) GROUP BY game_type
+                ON CONFLICT (month, game_type) DO UPDATE SET
+                    games = games + excluded.games, bet = bet + excluded.bet, win = win + excluded.win
+            ''', (month,))
+            self.conn.execute('DELETE FROM main.games WHERE id IN (SELECT id FROM archive_batch)')
+        return moved
+
+    # ---------- Обслуживание: каждая пачка — отдельная короткая транзакция ----------
+    def expire_withdrawals(self, before, limit):
+        """Переводит в expired до limit pending-заявок старше before. Возвращает [(id, user_id, amount)]"""
+        with self.conn:
+            rows = self.conn.execute('''
+                SELECT id, user_id, amount FROM withdrawals
+                WHERE status = 'pending' AND created_at < ? ORDER BY id LIMIT ?
+            ''', (before, limit)).fetchall()
+            self.conn.executemany('''
+                UPDATE withdrawals SET status = 'expired', processed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending'
+            ''', ((row[0],) for row in rows))
+            self._release((user_id, to_cents(amount)) for _, user_id, amount in rows)
+        return rows
+
+    def expire_invoices(self, before, limit):
+        with self.conn:
+            return self.conn.execute('''
+                UPDATE payments SET status = 'expired'
+                WHERE id IN (SELECT id FROM payments WHERE status = 'pending' AND created_at < ? ORDER BY id LIMIT ?)
+            ''', (before, limit)).rowcount
+
+    def purge_expired_promocodes(self, today, limit):
+        """Удаляет истёкшие коды; promocode_uses остаётся историей активаций"""
+        with self.conn:
+            return self.conn.execute('''
+                DELETE FROM promocodes WHERE id IN (
+                    SELECT id FROM promocodes WHERE expires_at IS NOT NULL AND expires_at < ? LIMIT ?)
+            ''', (today, limit)).rowcount
+
+    def optimize(self, analysis_limit):
+        """ANALYZE только там, где статистика устарела, и по выборке строк"""
+        self.conn.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+        self.conn.execute('PRAGMA optimize')
+
+    def wal_checkpoint(self, mode='PASSIVE'):
+        """(busy, страниц в WAL, перенесено страниц) или None вне режима WAL"""
+        if self.conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            return None
+        return tuple(self.conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+
+    def incremental_vacuum(self, pages):
+        """Отдаёт ОС до pages свободных страниц. Возвращает остаток freelist или None без auto_vacuum"""
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return None
+        # execute() шагает прагму один раз — одна страница; executescript доводит её до конца
+        self.conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        return self.conn.execute('PRAGMA freelist_count').fetchone()[0]
 
     def check_rate_limit(self, user_id):
         self.cursor.execute('SELECT last_game_time FROM users WHERE user_id = ?', (user_id,))
@@ -760,9 +1995,69 @@ class Database:
             ])
         return output.getvalue()
 
+    def get_fair_seed(self, user_id):
+        self.cursor.execute('SELECT * FROM fair_seeds WHERE user_id = ?', (user_id,))
+        seed = self.cursor.fetchone()
+        if seed:
+            return seed
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO fair_seeds (user_id, server_seed, client_seed, nonce)
+            VALUES (?, ?, ?, 0)
+        ''', (user_id, secrets.token_hex(32), secrets.token_hex(8)))
+        self.conn.commit()
+        self.cursor.execute('SELECT * FROM fair_seeds WHERE user_id = ?', (user_id,))
+        return self.cursor.fetchone()
+
+    def rotate_fair_seed(self, user_id, client_seed=None):
+        """Раскрывает текущий сид сервера и выдаёт новый. Возвращает раскрытый сид"""
+        old = self.get_fair_seed(user_id)
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO fair_revealed (server_seed_hash, server_seed, user_id)
+            VALUES (?, ?, ?)
+        ''', (seed_hash(old['server_seed']), old['server_seed'], user_id))
+        self.cursor.execute('''
+            UPDATE fair_seeds SET server_seed = ?, client_seed = ?, nonce = 0, created_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        ''', (secrets.token_hex(32), client_seed or secrets.token_hex(8), user_id))
+        self.conn.commit()
+        return old['server_seed']
+
+    def next_fair_round_id(self):
+        """Первый свободный id раунда: номера раздаёт движок, не дожидаясь вставки"""
+        return 1 + max(
+            self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM fair_rounds').fetchone()[0],
+            self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'fair_rounds'").fetchone()[0])
+
+    def add_fair_rounds(self, rounds):
+        """rounds: (id, user_id, game_type, server_seed, client_seed, nonce, params) — одной транзакцией.
+        Nonce сида сдвигается, только пока сид тот же: после /rotate счёт идёт с нуля"""
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO fair_rounds (id, user_id, game_type, server_seed_hash, client_seed, nonce, params)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', ((rid, uid, game, seed_hash(server), client, nonce, params)
+                  for rid, uid, game, server, client, nonce, params in rounds))
+            self.conn.executemany('''
+                UPDATE fair_seeds SET nonce = MAX(nonce, ?) WHERE user_id = ? AND server_seed = ? AND client_seed = ?
+            ''', ((nonce + 1, uid, server, client) for _, uid, _, server, client, nonce, _ in rounds))
+
+    def get_fair_round(self, round_id):
+        self.cursor.execute('SELECT * FROM fair_rounds WHERE id = ?', (round_id,))
+        return self.cursor.fetchone()
+
+    def get_revealed_seed(self, server_seed_hash):
+        self.cursor.execute('SELECT server_seed FROM fair_revealed WHERE server_seed_hash = ?', (server_seed_hash,))
+        res = self.cursor.fetchone()
+        return res[0] if res else None
+
+    def count_pending_withdrawals(self):
+        return self.conn.execute("SELECT COUNT(*) FROM withdrawals WHERE status = 'pending'").fetchone()[0]
+
     def close(self):
         self.conn.close()
 
+instrument_methods(Database, DB_LATENCY)
+
 # ======================== НАСТРОЙКИ ИГР ========================
 GAME_SETTINGS = {
     'flip': {'win_multiplier': 1.7, 'loss_multiplier': 0},
@@ -776,11 +2071,518 @@ GAME_SETTINGS = {
     'bowling': {'strike': 1.9, 'miss': 0}
 }
 
+# Игры с анимацией Telegram: эмодзи и число возможных значений кубика
+DICE_GAMES = {
+    'dice_num': ('🎲', 6),
+    'dice_even_odd': ('🎲', 6),
+    'slots': ('🎰', 64),
+    'football': ('⚽', 5),
+    'basketball': ('🏀', 5),
+    'darts': ('🎯', 6),
+    'bowling': ('🎳', 6)
+}
+
+# Игры в мгновенном режиме: результат считается на сервере без send_dice
+INSTANT_GAMES = set()
+
+# ======================== ДОКАЗУЕМО ЧЕСТНЫЙ ГСЧ ========================
+# Каждый раунд получает HMAC-SHA256(server_seed, "client_seed:nonce").
+# Игроку заранее известен sha256 сида сервера; после смены сида (/rotate)
+# сам сид раскрывается, и любой раунд можно пересчитать командой /verify.
+# Сид и nonce игрока живут в памяти движка, номер раунда выдаётся сразу,
+# а записи раундов копятся FAIR_FLUSH_WINDOW секунд (или до FAIR_FLUSH_MAX)
+# и фиксируются одной транзакцией, как активации промокодов.
+OUTCOME_ENGINE = os.environ.get("OUTCOME_ENGINE", "fair")
+FAIR_BATCH_SIZE = int(os.environ.get("FAIR_BATCH_SIZE", "32"))
+FAIR_BUFFERED_USERS = int(os.environ.get("FAIR_BUFFERED_USERS", "10000"))
+FAIR_FLUSH_WINDOW = 0.02
+FAIR_FLUSH_MAX = 500
+
+def seed_hash(server_seed):
+    return hashlib.sha256(server_seed.encode()).hexdigest()
+
+def fair_digest(server_seed, client_seed, nonce):
+    return hmac.new(server_seed.encode(), f"{client_seed}:{nonce}".encode(), hashlib.sha256).digest()
+
+def digest_floats(digest):
+    """32 байта HMAC -> 8 чисел в [0, 1), по 4 байта на число"""
+    return [int.from_bytes(digest[i:i + 4], 'big') / 2 ** 32 for i in range(0, 32, 4)]
+
+def sample_positions(floats, total, count):
+    """Частичная перетасовка Фишера-Йейтса: count позиций из total"""
+    pool = list(range(total))
+    for i in range(count):
+        j = i + int(floats[i] * (total - i))
+        pool[i], pool[j] = pool[j], pool[i]
+    return pool[:count]
+
+def pick_case_item(items, r):
+    total = sum(item['chance'] for item in items)
+    point = r * total
+    cur = 0
+    for item in items:
+        cur += item['chance']
+        if point < cur:
+            return item
+    return items[-1] if items else None
+
+def daily_bonus_amount(r):
+    if r < 0.5:
+        return 0.05
+    elif r < 0.8:
+        return 0.10
+    elif r < 0.95:
+        return 0.20
+    return 0.50
+
+class RandomOutcomeEngine:
+    """Обычный random без записи раундов"""
+
+    def draw(self, user_id, game_type, params=None):
+        return None, [random.random() for _ in range(8)]
+
+    def forget(self, user_id):
+        pass
+
+    def flush(self):
+        pass
+
+class FairOutcomeEngine:
+    """HMAC-цепочки сидов с номером раунда (nonce) на пользователя.
+    Хэши считаются пачками в фоновом потоке, в обработчике берётся готовый;
+    раунды пишутся в базу группами"""
+
+    def __init__(self, database, batch_size=FAIR_BATCH_SIZE, max_users=FAIR_BUFFERED_USERS,
+                 window=FAIR_FLUSH_WINDOW, max_pending=FAIR_FLUSH_MAX):
+        self.db = database
+        self.batch_size = batch_size
+        self.max_users = max_users
+        self.window = window
+        self.max_pending = max_pending
+        self._buffers = OrderedDict()  # user_id → сиды, следующий nonce и готовые хэши
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._next_id = None
+        self.pending = []  # (id, user_id, game_type, server_seed, client_seed, nonce, params)
+        self._timer = None
+        self._jobs = queue.Queue()
+        self._worker = threading.Thread(target=self._work, name="fair-rng", daemon=True)
+        self._worker.start()
+
+    def _work(self):
+        while True:
+            user_id, server_seed, client_seed, start = self._jobs.get()
+            digests = [(n, fair_digest(server_seed, client_seed, n)) for n in range(start, start + self.batch_size)]
+            with self._lock:
+                self._refilling.discard(user_id)
+                buf = self._buffers.get(user_id)
+                if buf is None or buf['seeds'] != (server_seed, client_seed):
+                    continue
+                items = buf['items']
+                last = items[-1][0] if items else None
+                items.extend(d for d in digests if last is None or d[0] > last)
+
+    def _request_refill(self, user_id, seeds, start):
+        if user_id in self._refilling:
+            return
+        self._refilling.add(user_id)
+        self._jobs.put((user_id, seeds[0], seeds[1], start))
+
+    def _buffer(self, user_id):
+        """Буфер игрока; сид читается из базы только при первом раунде после запуска или вытеснения"""
+        with self._lock:
+            buf = self._buffers.get(user_id)
+            if buf is not None:
+                self._buffers.move_to_end(user_id)
+                return buf
+        seed = self.db.get_fair_seed(user_id)
+        buf = {'seeds': (seed['server_seed'], seed['client_seed']), 'nonce': seed['nonce'], 'items': deque()}
+        with self._lock:
+            self._buffers[user_id] = buf
+            evict = len(self._buffers) > self.max_users
+        if evict:
+            # Вытесненный игрок перечитает nonce из базы — несохранённые раунды должны быть там
+            self.flush()
+            with self._lock:
+                while len(self._buffers) > self.max_users:
+                    self._buffers.popitem(last=False)
+        return buf
+
+    def _take(self, user_id, buf, nonce):
+        digest = None
+        seeds = buf['seeds']
+        with self._lock:
+            items = buf['items']
+            while items and items[0][0] < nonce:
+                items.popleft()
+            if items and items[0][0] == nonce:
+                digest = items.popleft()[1]
+            if len(items) < self.batch_size // 2:
+                self._request_refill(user_id, seeds, items[-1][0] + 1 if items else nonce + 1)
+        if digest is None:
+            digest = fair_digest(*seeds, nonce)
+        return digest
+
+    def draw(self, user_id, game_type, params=None):
+        """Возвращает (номер раунда, 8 чисел в [0, 1))"""
+        buf = self._buffer(user_id)
+        nonce = buf['nonce']
+        buf['nonce'] = nonce + 1
+        digest = self._take(user_id, buf, nonce)
+        if self._next_id is None:
+            self._next_id = self.db.next_fair_round_id()
+        round_id = self._next_id
+        self._next_id += 1
+        self.pending.append((round_id, user_id, game_type, *buf['seeds'], nonce,
+                             json.dumps(params or {}, ensure_ascii=False)))
+        self._schedule_flush()
+        return round_id, digest_floats(digest)
+
+    def _schedule_flush(self):
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+            return
+        if self._timer is None:
+            try:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+            except RuntimeError:
+                # Вне цикла событий (скрипты, бенчмарки) ждать некому
+                self.flush()
+
+    def flush(self):
+        """Пишет накопленные раунды; /verify, /seed и /rotate зовут её перед чтением из базы"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            self.db.add_fair_rounds(batch)
+        except sqlite3.Error as e:
+            # Номера уже показаны игрокам: пачка остаётся в очереди до следующей фиксации
+            self.pending = batch + self.pending
+            logger.warning("Раунды не записаны (%s шт.): %s", len(batch), e)
+
+    def forget(self, user_id):
+        self.flush()
+        with self._lock:
+            self._buffers.pop(user_id, None)
+
+def create_outcome_engine(database):
+    if OUTCOME_ENGINE == 'random':
+        return RandomOutcomeEngine()
+    return FairOutcomeEngine(database)
+
+def describe_round(game_type, params, floats):
+    """Исход раунда по пересчитанным числам, та же логика, что и в игре"""
+    choice = params.get('choice')
+    if game_type == 'flip':
+        won = floats[0] < 0.5 * RTP_FACTOR
+        return f"Выбор {'🦅 ОРЁЛ' if choice == '1' else '🪙 РЕШКА'}: {'угадал' if won else 'не угадал'}"
+    if game_type == 'roulette':
+        return f"Позиция патрона: {1 + int(floats[0] * 6)}"
+    if game_type in DICE_GAMES:
+        emoji, faces = DICE_GAMES[game_type]
+        rtp = f"проверка RTP: {floats[1]:.6f} {'<' if floats[1] < RTP_FACTOR else '≥'} {RTP_FACTOR}"
+        if params.get('instant'):
+            return f"{emoji} Значение: {1 + int(floats[0] * faces)}, {rtp}"
+        return f"{emoji} Значение от Telegram, {rtp}"
+    if game_type == 'mines':
+        mines = sample_positions(floats, 25, params.get('mines', 5))
+        return "Мины в клетках: " + ", ".join(str(m + 1) for m in sorted(mines))
+    if game_type == 'case':
+        case = db.get_cases()[0]
+        item = pick_case_item(json.loads(case[3]), floats[0])
+        return f"Выпало: {item['name']} (${item['value']:.2f})"
+    if game_type == 'bonus':
+        return f"Бонус: ${daily_bonus_amount(floats[0]):.2f}"
+    return "—"
+
+def round_footer(round_id):
+    if not round_id:
+        return ""
+    return f"\n\n🔐 Раунд #{round_id} — проверка: /verify {round_id}"
+
+# ======================== РАСЧЁТ RTP ========================
+# Вероятности исходов повторяют логику process_game_result и MinesGame:
+# значение кубика Telegram равновероятно, выигрыш дополнительно проходит
+# проверку RTP_FACTOR. RTP считается на $1 ставки, дисперсия — для выплаты.
+RTP_SIM_ROUNDS = 10 ** 7
+MINES_OPTIONS = [3, 4, 5, 6, 7, 8]
+
+GAME_TITLES = {
+    'flip': '🪙 Орёл и решка',
+    'roulette': '💀 Русская рулетка',
+    'dice_number': '🎲 Кости (число)',
+    'dice_even_odd': '🎲 Кости (чёт/нечёт)',
+    'slots': '🎰 Слоты',
+    'football': '⚽ Футбол',
+    'basketball': '🏀 Баскетбол',
+    'darts': '🎯 Дартс',
+    'bowling': '🎳 Боулинг',
+    'mines': '💣 Минное поле',
+    'case': '📦 Кейс Сакура'
+}
+
+# Вероятность выигрышного значения кубика для вариантов ставки
+SLOTS_MATCH_CHANCE = {'1': 61 / 64, '2': 2 / 64, '3': 1 / 64}
+SPORT_HIT_CHANCE = {
+    'football': ('goal', 1 / 5),
+    'basketball': ('point', 1 / 5),
+    'darts': ('bullseye', 1 / 6),
+    'bowling': ('strike', 1 / 6)
+}
+
+def mines_survival(mines, opened, total=25):
+    """Вероятность открыть opened клеток подряд и не попасть на мину"""
+    p = 1.0
+    for i in range(opened):
+        p *= (total - mines - i) / (total - i)
+    return p
+
+def game_distributions(game, settings=None, cases=None):
+    """Варианты ставки игры: {вариант: [(вероятность, множитель), ...]}.
+    cases — строки db.get_cases(); из фонового потока их передают готовыми, база там не трогается"""
+    settings = settings or GAME_SETTINGS
+    if game == 'flip':
+        p = 0.5 * RTP_FACTOR
+        return {'win_multiplier': [(p, settings['flip']['win_multiplier']), (1 - p, 0.0)]}
+    if game == 'roulette':
+        return {k: [((6 - int(k)) / 6, settings['roulette'].get(k, 0)), (int(k) / 6, 0.0)]
+                for k in ['1', '2', '3', '4', '5', '6']}
+    if game == 'dice_number':
+        p = RTP_FACTOR / 6
+        return {'win_multiplier': [(p, settings['dice_number']['win_multiplier']), (1 - p, 0.0)]}
+    if game == 'dice_even_odd':
+        p = RTP_FACTOR / 2
+        return {'win_multiplier': [(p, settings['dice_even_odd']['win_multiplier']), (1 - p, 0.0)]}
+    if game == 'slots':
+        return {k: [(c * RTP_FACTOR, settings['slots'].get(k, 0)), (1 - c * RTP_FACTOR, 0.0)]
+                for k, c in SLOTS_MATCH_CHANCE.items()}
+    if game in SPORT_HIT_CHANCE:
+        hit_key, hit = SPORT_HIT_CHANCE[game]
+        return {
+            hit_key: [(hit * RTP_FACTOR, settings[game][hit_key]), (1 - hit * RTP_FACTOR, 0.0)],
+            'miss': [((1 - hit) * RTP_FACTOR, settings[game]['miss']), (1 - (1 - hit) * RTP_FACTOR, 0.0)]
+        }
+    if game == 'mines':
+        # Игрок открывает k клеток и забирает x(1 + 0.1k); берём лучшее для игрока k
+        result = {}
+        for mines in MINES_OPTIONS:
+            best = max(range(1, 26 - mines),
+                       key=lambda k: mines_survival(mines, k) * (1 + 0.1 * k))
+            p = mines_survival(mines, best)
+            result[f"{mines} мин, {best} кл."] = [(p, 1 + 0.1 * best), (1 - p, 0.0)]
+        return result
+    if game == 'case':
+        case = (cases if cases is not None else db.get_cases())[0]
+        items = json.loads(case[3])
+        total = sum(item['chance'] for item in items)
+        return {'Сакура': [(item['chance'] / total, item['value'] / case[2]) for item in items]}
+    return {}
+
+def distribution_stats(dist):
+    """(RTP, дисперсия выплаты) на $1 ставки"""
+    mean = sum(p * m for p, m in dist)
+    variance = sum(p * m * m for p, m in dist) - mean * mean
+    return mean, variance
+
+def rtp_report(games=None, settings=None, cases=None):
+    """[(игра, вариант, RTP, дисперсия)] — точный расчёт по распределениям"""
+    rows = []
+    for game in games or GAME_TITLES:
+        for option, dist in game_distributions(game, settings, cases).items():
+            rtp, variance = distribution_stats(dist)
+            rows.append((game, option, rtp, variance))
+    return rows
+
+def simulate_rtp(game, option, rounds=RTP_SIM_ROUNDS, settings=None, seed=None, cases=None):
+    """Векторная симуляция раундов на NumPy по механике игры. Возвращает (RTP, дисперсия)"""
+    import numpy as np
+    settings = settings or GAME_SETTINGS
+    rng = np.random.default_rng(seed)
+    rtp_ok = lambda: rng.random(rounds, dtype=np.float32) < RTP_FACTOR
+    if game == 'flip':
+        payout = np.where(rng.random(rounds, dtype=np.float32) < 0.5 * RTP_FACTOR,
+                          settings['flip']['win_multiplier'], 0.0)
+    elif game == 'roulette':
+        position = rng.integers(1, 7, rounds, dtype=np.int8)
+        payout = np.where(position > int(option), settings['roulette'].get(option, 0), 0.0)
+    elif game == 'dice_number':
+        die = rng.integers(1, 7, rounds, dtype=np.int8)
+        payout = np.where((die == 1) & rtp_ok(), settings['dice_number']['win_multiplier'], 0.0)
+    elif game == 'dice_even_odd':
+        die = rng.integers(1, 7, rounds, dtype=np.int8)
+        payout = np.where((die % 2 == 0) & rtp_ok(), settings['dice_even_odd']['win_multiplier'], 0.0)
+    elif game == 'slots':
+        value = rng.integers(1, 65, rounds, dtype=np.int8)
+        matches = np.where(value == 64, 3, np.where((value == 43) | (value == 22), 2, 1))
+        payout = np.where((matches == int(option)) & rtp_ok(), settings['slots'].get(option, 0), 0.0)
+    elif game in SPORT_HIT_CHANCE:
+        hit_key, _ = SPORT_HIT_CHANCE[game]
+        faces, hit_value = {'football': (5, 4), 'basketball': (5, 4), 'darts': (6, 6), 'bowling': (6, 5)}[game]
+        value = rng.integers(1, faces + 1, rounds, dtype=np.int8)
+        hit = value == hit_value
+        won = (hit if option == hit_key else ~hit) & rtp_ok()
+        payout = np.where(won, settings[game][option], 0.0)
+    elif game == 'mines':
+        mines = int(option.split()[0])
+        opened = int(option.split(',')[1].split()[0])
+        hits = rng.hypergeometric(mines, 25 - mines, opened, rounds)
+        payout = np.where(hits == 0, 1 + 0.1 * opened, 0.0)
+    elif game == 'case':
+        dist = game_distributions('case', settings, cases)['Сакура']
+        cdf = np.cumsum([p for p, _ in dist])
+        idx = np.minimum(np.searchsorted(cdf, rng.random(rounds)), len(dist) - 1)
+        payout = np.array([m for _, m in dist])[idx]
+    else:
+        return None
+    return float(payout.mean()), float(payout.var())
+
+def format_rtp_change(game, settings_before, settings_after):
+    """Текст сравнения RTP и дисперсии до и после изменения коэффициента"""
+    before = {opt: (rtp, var) for _, opt, rtp, var in rtp_report([game], settings_before)}
+    after = {opt: (rtp, var) for _, opt, rtp, var in rtp_report([game], settings_after)}
+    lines = []
+    for option, (rtp, var) in after.items():
+        old_rtp, old_var = before.get(option, (0.0, 0.0))
+        warn = " ⚠️" if rtp >= 1.0 else ""
+        lines.append(f"• {option}: RTP {old_rtp * 100:.1f}% → {rtp * 100:.1f}%{warn}, "
+                     f"дисперсия {old_var:.2f} → {var:.2f}")
+    return "\n".join(lines)
+
+# ======================== ИСХОДЯЩИЕ ЗАПРОСЫ ========================
+# Все отправки в Bot API проходят через OutboundScheduler (rate limiter PTB):
+# общий бакет на TG_GLOBAL_RATE сообщений в секунду и бакет на каждый чат.
+# Приоритет передаётся через rate_limit_args: ответы игрокам идут первыми,
+# уведомления следом, рассылки берут токены только сверх резерва. Бакет чата
+# держит только исходящий поток (уведомления и рассылки): ответ на нажатие
+# самого игрока его не ждёт, иначе после TG_CHAT_BURST шагов каждый
+# следующий тормозил бы на секунду. На 429 (RetryAfter) чат или весь бот
+# замолкает на указанное время и запрос повторяется.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_BULK = 2
+
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", "5"))
+TG_BULK_RESERVE = float(os.environ.get("TG_BULK_RESERVE", "10"))
+TG_MAX_RETRIES = 3
+BROADCAST_CHUNK = 50
+
+# Методы, которые Telegram не считает отправкой сообщений
+UNLIMITED_ENDPOINTS = {'answerCallbackQuery', 'answerPreCheckoutQuery', 'getMe', 'getFile', 'getChat',
+                       'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'getUpdates', 'setMyCommands'}
+
+OUTBOUND_WAIT = Histogram("bot_outbound_wait_seconds", "Ожидание токена перед запросом к Bot API", ("priority",))
+OUTBOUND_RETRY_AFTER = Counter("bot_outbound_retry_after_total", "Ответы 429 от Bot API", ("method",))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now, reserve=0.0):
+        """Сколько ждать до токена сверх reserve; 0 — можно брать сейчас"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        need = 1.0 + reserve - self.tokens
+        return need / self.rate if need > 0 else 0.0
+
+    def take(self):
+        self.tokens -= 1.0
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST,
+                 bulk_reserve=TG_BULK_RESERVE, max_retries=TG_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.bulk_reserve = min(bulk_reserve, max(0.0, global_rate - 1))
+        self.max_retries = max_retries
+        self.chats = {}
+        self.waiting = [0, 0, 0]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) > 50000:
+                # Полные бакеты ничего не помнят — их можно выбросить
+                now = time.monotonic()
+                self.chats = {k: b for k, b in self.chats.items() if now - b.updated < 60 or now < b.blocked_until}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_bucket, priority):
+        # Сначала свой чат: его ожидание никого больше не задерживает
+        if chat_bucket is not None and priority != PRIORITY_INTERACTIVE:
+            while (wait := chat_bucket.wait_time(time.monotonic())) > 0:
+                await asyncio.sleep(wait)
+            chat_bucket.take()
+        elif chat_bucket is not None:
+            # Ответ игроку ждёт только паузу после 429 в этом чате
+            while (wait := chat_bucket.blocked_until - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+        reserve = self.bulk_reserve if priority == PRIORITY_BULK else 0.0
+        self.waiting[priority] += 1
+        try:
+            while True:
+                if any(self.waiting[:priority]):
+                    # Общий токен достанется более срочным запросам
+                    wait = 1.0 / self.global_bucket.rate
+                else:
+                    wait = self.global_bucket.wait_time(time.monotonic(), reserve)
+                    if wait <= 0:
+                        self.global_bucket.take()
+                        return
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting[priority] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            await self._acquire(chat_bucket, priority)
+            OUTBOUND_WAIT.labels(priority).observe(time.perf_counter() - start)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                OUTBOUND_RETRY_AFTER.labels(endpoint).inc()
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                # Без chat_id не понять, чей лимит, — останавливаем всех
+                bucket = chat_bucket or self.global_bucket
+                bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay + 0.1)
+                logger.warning("429 на %s, пауза %.1f c (попытка %s)", endpoint, delay, attempt + 1)
+
 # ======================== БОТ ========================
 db = Database()
+outcomes = create_outcome_engine(db)
 
 def signal_handler(sig, frame):
     print('🛑 Остановка...')
+    outcomes.flush()
     db.close()
     sys.exit(0)
 
@@ -789,7 +2591,13 @@ signal.signal(signal.SIGTERM, signal_handler)
 
 # ======================== ОБРАБОТЧИК ОШИБОК ========================
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.error(f"Update {update} caused error {context.error}")
+    # Update целиком не форматируем: при сбое Telegram это сотни больших строк
+    extra = {}
+    if isinstance(update, Update):
+        extra['route'] = update_route(update, context)
+        if update.effective_user:
+            extra['user_id'] = update.effective_user.id
+    logger.error("Ошибка обработки обновления: %r", context.error, exc_info=context.error, extra=extra)
     if isinstance(context.error, Conflict):
         logger.warning("Конфликт обновлений - игнорируем")
         return
@@ -803,11 +2611,11 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 async def edit_message(query, text, keyboard=None):
     try:
         if query.message.photo:
-            if keyboard:
-                await query.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard)
-            else:
-                await query.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
-            await query.edit_message_reply_markup(reply_markup=None)
+            # Новое сообщение и снятие кнопок с фото друг от друга не зависят
+            await asyncio.gather(
+                query.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard),
+                query.edit_message_reply_markup(reply_markup=None)
+            )
         else:
             if keyboard:
                 await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboard)
@@ -815,7 +2623,7 @@ async def edit_message(query, text, keyboard=None):
                 await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN)
         return True
     except Exception as e:
-        logger.error(f"Ошибка редактирования: {e}")
+        logger.error("Ошибка редактирования: %s", e)
         return False
 
 async def check_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -834,12 +2642,36 @@ def back_button(target='main_menu'):
         [InlineKeyboardButton("◀️ Назад", callback_data=target, style="primary")]
     ])
 
+def page_request(data):
+    """«admin_bans:next:123» → {'after': 123}; без курсора — первая страница"""
+    parts = data.split(":")
+    if len(parts) != 3:
+        return {}
+    return {'after' if parts[1] == 'next' else 'before': int(parts[2])}
+
+def page_buttons(screen, rows, has_prev, has_next):
+    if not rows:
+        # Строки страницы успели удалить (истёкшие промокоды, разбан): курсора нет, только в начало
+        if has_prev or has_next:
+            return [[InlineKeyboardButton("⏮ В начало", callback_data=screen, style="primary")]]
+        return []
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{screen}:prev:{rows[0][0]}", style="primary"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"{screen}:next:{rows[-1][0]}", style="primary"))
+    return [nav] if nav else []
+
 def home_button():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu", style="primary")]
     ])
 
 # ======================== ВАЛИДАЦИЯ СТАВКИ ========================
+def available(user):
+    """Баланс за вычетом холдов по заявкам на вывод — им можно играть и выводить"""
+    return user['available_cents'] / 100
+
 async def validate_bet(update, context, user_id, bet):
     if bet <= 0:
         await update.message.reply_text("❌ Ставка должна быть положительной.")
@@ -851,8 +2683,8 @@ async def validate_bet(update, context, user_id, bet):
     if not user:
         await update.message.reply_text("❌ Пользователь не найден.")
         return None
-    if bet > user[3]:
-        await update.message.reply_text(f"❌ Недостаточно средств. У вас ${user[3]:.2f}")
+    if bet > available(user):
+        await update.message.reply_text(f"❌ Недостаточно средств. Доступно ${available(user):.2f}")
         return None
     if not db.check_rate_limit(user_id):
         await update.message.reply_text(f"⏳ Подождите {RATE_LIMIT_SECONDS} секунд между играми.")
@@ -865,7 +2697,7 @@ async def check_balance_and_offer(update, context, user_id, required_amount, act
         if isinstance(update, Update) and update.message:
             await update.message.reply_text("❌ Пользователь не найден")
         return
-    balance = user[3]
+    balance = available(user)
     if balance >= required_amount:
         if game_data:
             context.user_data['game_data'] = game_data
@@ -883,7 +2715,7 @@ async def check_balance_and_offer(update, context, user_id, required_amount, act
             else:
                 await update.message.reply_text(text, reply_markup=kb)
         except Exception as e:
-            logger.error(f"Ошибка check_balance: {e}")
+            logger.error("Ошибка check_balance: %s", e)
             if isinstance(update, Update) and update.message:
                 await update.message.reply_text(text, reply_markup=kb)
     else:
@@ -1101,7 +2933,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'flip'
         context.user_data['game_choice'] = choice
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         text = (f"🪙 *ОРЁЛ И РЕШКА*\n\n"
                 f"Твой выбор: {'🦅 ОРЁЛ' if choice == '1' else '🪙 РЕШКА'}\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1113,7 +2945,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'roulette'
         context.user_data['game_choice'] = choice
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['roulette'].get(choice, 0)
         text = (f"💀 *РУССКАЯ РУЛЕТКА*\n\n"
                 f"Патронов: {choice} (x{mult if mult>0 else '💀'})\n"
@@ -1126,7 +2958,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'dice_num'
         context.user_data['game_choice'] = num
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['dice_number']['win_multiplier']
         text = (f"🎲 *КОСТИ - ЧИСЛО {num}*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1138,7 +2970,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'dice_even_odd'
         context.user_data['game_choice'] = 'even'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['dice_even_odd']['win_multiplier']
         text = (f"🎲 *КОСТИ - ЧЁТНОЕ*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1150,7 +2982,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'dice_even_odd'
         context.user_data['game_choice'] = 'odd'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['dice_even_odd']['win_multiplier']
         text = (f"🎲 *КОСТИ - НЕЧЁТНОЕ*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1163,7 +2995,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'slots'
         context.user_data['game_choice'] = choice
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['slots'].get(choice, 0)
         text = (f"🎰 *СЛОТЫ - {choice} СОВПАДЕНИЕ*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1175,7 +3007,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'football'
         context.user_data['game_choice'] = 'goal'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['football']['goal']
         text = (f"⚽ *ФУТБОЛ - ГОЛ*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1187,7 +3019,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'football'
         context.user_data['game_choice'] = 'miss'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['football']['miss']
         text = (f"⚽ *ФУТБОЛ - МИМО*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1200,7 +3032,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'basketball'
         context.user_data['game_choice'] = 'point'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['basketball']['point']
         text = (f"🏀 *БАСКЕТБОЛ - ОЧКО*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1212,7 +3044,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'basketball'
         context.user_data['game_choice'] = 'miss'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['basketball']['miss']
         text = (f"🏀 *БАСКЕТБОЛ - МИМО*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1225,7 +3057,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'darts'
         context.user_data['game_choice'] = 'bullseye'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['darts']['bullseye']
         text = (f"🎯 *ДАРТС - В ЯБЛОЧКО*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1237,7 +3069,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'darts'
         context.user_data['game_choice'] = 'miss'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['darts']['miss']
         text = (f"🎯 *ДАРТС - МИМО*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1250,7 +3082,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'bowling'
         context.user_data['game_choice'] = 'strike'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['bowling']['strike']
         text = (f"🎳 *БОУЛИНГ - СТРАЙК*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1262,7 +3094,7 @@ async def handle_game_choice(update, context, user_id, data):
         context.user_data['game_type'] = 'bowling'
         context.user_data['game_choice'] = 'miss'
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         mult = GAME_SETTINGS['bowling']['miss']
         text = (f"🎳 *БОУЛИНГ - МИМО*\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n\n"
@@ -1291,15 +3123,27 @@ async def handle_bet(update, context, user_id, bet):
     )
 
 # ======================== ОБРАБОТКА РЕЗУЛЬТАТА ========================
+async def roll_dice(context, user_id, game_type, r=None):
+    """Значение кубика: из анимации Telegram или из числа ГСЧ r в мгновенном режиме"""
+    emoji, faces = DICE_GAMES[game_type]
+    if r is not None:
+        # Telegram выбирает значение анимации сам, поэтому в мгновенном режиме
+        # она не отправляется: иначе картинка расходилась бы с результатом
+        return 1 + int(r * faces)
+    msg = await context.bot.send_dice(chat_id=user_id, emoji=emoji)
+    return msg.dice.value
+
 async def process_game_result(update, context, user_id, bet, game_type, game_choice):
     query = update.callback_query
     user = db.get_user(user_id)
     win = 0.0
     multiplier = 0.0
     result_text = ""
+    instant = game_type in INSTANT_GAMES
+    round_id, rnd = outcomes.draw(user_id, game_type, {'choice': game_choice, 'instant': instant})
 
     if game_type == 'flip':
-        if random.random() < 0.5 * RTP_FACTOR:
+        if rnd[0] < 0.5 * RTP_FACTOR:
             result = game_choice
         else:
             result = '1' if game_choice == '2' else '2'
@@ -1311,7 +3155,7 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
             result_text = f"😢 Не угадал. Выпал {'🦅 ОРЁЛ' if result == '1' else '🪙 РЕШКА'}"
 
     elif game_type == 'roulette':
-        result = random.randint(1, 6)
+        result = 1 + int(rnd[0] * 6)
         choice_num = int(game_choice)
         if result <= choice_num:
             result_text = f"💥 БАХ! Патрон был в позиции {result}"
@@ -1321,10 +3165,9 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
             result_text = f"🎉 Ты выжил! Выпал номер {result}"
 
     elif game_type == 'dice_num':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='🎲')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         if str(res) == game_choice:
-            if random.random() < RTP_FACTOR:
+            if rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['dice_number']['win_multiplier']
                 win = bet * multiplier
                 result_text = f"🎉 Точное попадание! Выпало {res}"
@@ -1334,11 +3177,10 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
             result_text = f"😢 Не угадал. Выпало {res}"
 
     elif game_type == 'dice_even_odd':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='🎲')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         is_even = res % 2 == 0
         if (game_choice == 'even' and is_even) or (game_choice == 'odd' and not is_even):
-            if random.random() < RTP_FACTOR:
+            if rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['dice_even_odd']['win_multiplier']
                 win = bet * multiplier
                 result_text = f"🎉 Угадал! Выпало {'чётное' if is_even else 'нечётное'} число {res}"
@@ -1348,8 +3190,7 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
             result_text = f"😢 Не угадал. Выпало {'чётное' if is_even else 'нечётное'} число {res}"
 
     elif game_type == 'slots':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='🎰')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         if res == 64:
             matches = 3
         elif res == 43 or res == 22:
@@ -1357,7 +3198,7 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
         else:
             matches = 1
         if matches == int(game_choice):
-            if random.random() < RTP_FACTOR:
+            if rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['slots'].get(game_choice, 0)
                 win = bet * multiplier
                 result_text = f"🎉 Угадал! {matches} совпадения"
@@ -1367,17 +3208,16 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
             result_text = f"😢 Не угадал. Выпало {matches} совпадения"
 
     elif game_type == 'football':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='⚽')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         if game_choice == 'goal':
-            if res == 4 and random.random() < RTP_FACTOR:
+            if res == 4 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['football']['goal']
                 win = bet * multiplier
                 result_text = f"⚽ ГОЛ! Ты выиграл! x{multiplier}"
             else:
                 result_text = f"😢 НЕТ ГОЛА! Ты проиграл!"
         else:
-            if res != 4 and random.random() < RTP_FACTOR:
+            if res != 4 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['football']['miss']
                 win = bet * multiplier
                 result_text = f"💨 МИМО! Ты выиграл! x{multiplier}"
@@ -1385,17 +3225,16 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
                 result_text = f"😢 ГОЛ! Ты проиграл (ставил на МИМО)"
 
     elif game_type == 'basketball':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='🏀')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         if game_choice == 'point':
-            if res == 4 and random.random() < RTP_FACTOR:
+            if res == 4 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['basketball']['point']
                 win = bet * multiplier
                 result_text = f"🏀 ОЧКО! Ты выиграл! x{multiplier}"
             else:
                 result_text = f"😢 НЕТ ОЧКА! Ты проиграл!"
         else:
-            if res != 4 and random.random() < RTP_FACTOR:
+            if res != 4 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['basketball']['miss']
                 win = bet * multiplier
                 result_text = f"💨 МИМО! Ты выиграл! x{multiplier}"
@@ -1403,17 +3242,16 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
                 result_text = f"😢 ОЧКО! Ты проиграл (ставил на МИМО)"
 
     elif game_type == 'darts':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='🎯')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         if game_choice == 'bullseye':
-            if res == 6 and random.random() < RTP_FACTOR:
+            if res == 6 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['darts']['bullseye']
                 win = bet * multiplier
                 result_text = f"🎯 В ЯБЛОЧКО! Ты выиграл! x{multiplier}"
             else:
                 result_text = f"😢 МИМО! Ты проиграл!"
         else:
-            if res != 6 and random.random() < RTP_FACTOR:
+            if res != 6 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['darts']['miss']
                 win = bet * multiplier
                 result_text = f"💨 МИМО! Ты выиграл! x{multiplier}"
@@ -1421,38 +3259,40 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
                 result_text = f"😢 В ЯБЛОЧКО! Ты проиграл (ставил на МИМО)"
 
     elif game_type == 'bowling':
-        msg = await context.bot.send_dice(chat_id=user_id, emoji='🎳')
-        res = msg.dice.value
+        res = await roll_dice(context, user_id, game_type, rnd[0] if instant else None)
         if game_choice == 'strike':
-            if res == 5 and random.random() < RTP_FACTOR:
+            if res == 5 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['bowling']['strike']
                 win = bet * multiplier
                 result_text = f"🎳 СТРАЙК! Ты выиграл! x{multiplier}"
             else:
                 result_text = f"😢 МИМО! Ты проиграл!"
         else:
-            if res != 5 and random.random() < RTP_FACTOR:
+            if res != 5 and rnd[1] < RTP_FACTOR:
                 multiplier = GAME_SETTINGS['bowling']['miss']
                 win = bet * multiplier
                 result_text = f"💨 МИМО! Ты выиграл! x{multiplier}"
             else:
                 result_text = f"😢 СТРАЙК! Ты проиграл (ставил на МИМО)"
 
+    record_bet(game_type, bet, win)
     if win > 0:
-        db.update_balance(user_id, win)
+        db.update_balance(user_id, win, 'win')
         new_balance = user[3] - bet + win
         text = (f"🎉 *ВЫИГРАЛ!*\n\n"
                f"{result_text}\n\n"
                f"💰 Ставка: ${bet:.2f}\n"
                f"💵 Выигрыш: ${win:.2f} (x{multiplier})\n"
-               f"💳 Баланс: ${new_balance:.2f}")
+               f"💳 Баланс: ${new_balance:.2f}"
+               f"{round_footer(round_id)}")
     else:
         db.add_lost(user_id, bet)
         new_balance = user[3] - bet
         text = (f"😢 *ПРОИГРЫШ*\n\n"
                f"{result_text}\n\n"
                f"💰 Ставка: ${bet:.2f} сгорела\n"
-               f"💳 Баланс: ${new_balance:.2f}")
+               f"💳 Баланс: ${new_balance:.2f}"
+               f"{round_footer(round_id)}")
 
     if game_type in ['dice_num', 'dice_even_odd']:
         base_game = 'dice_classic'
@@ -1469,11 +3309,14 @@ async def process_game_result(update, context, user_id, bet, game_type, game_cho
 
 # ======================== МИННОЕ ПОЛЕ ========================
 class MinesGame:
-    def __init__(self, bet, mines_count=5):
+    def __init__(self, bet, mines_count=5, rnd=None, round_id=None):
         self.bet = bet
         self.mines_count = mines_count
         self.total_cells = 25
-        self.mines = random.sample(range(self.total_cells), mines_count)
+        if rnd is None:
+            rnd = [random.random() for _ in range(mines_count)]
+        self.mines = sample_positions(rnd, self.total_cells, mines_count)
+        self.round_id = round_id
         self.opened = []
         self.multiplier = 1.0
         self.game_over = False
@@ -1511,12 +3354,153 @@ async def show_mines_field(update, context, game):
     kb.append([InlineKeyboardButton("◀️ Назад", callback_data="casino_menu", style="danger")])
     text = (f"💣 Минное поле\n💰 Ставка: ${game.bet:.2f}\n"
             f"📈 Множитель: x{game.multiplier:.2f}\n"
-            f"✅ Открыто: {len(game.opened)}/{25-game.mines_count}")
+            f"✅ Открыто: {len(game.opened)}/{25-game.mines_count}"
+            f"{round_footer(game.round_id)}")
     if update.message:
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
     else:
         await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
 
+# ======================== СЕССИИ ========================
+# user_data — это SessionData: каждый ключ живёт SESSION_TTL секунд с момента
+# записи (свои сроки в SESSION_KEY_TTL). Просроченные ключи снимаются перед
+# каждым обновлением пользователя и раз в SESSION_SWEEP_INTERVAL фоновой
+# задачей. Если сессии вместе занимают больше SESSION_MAX_MB, вытесняются
+# давно неактивные. Брошенная игра в мины при этом закрывается: без
+# открытых клеток ставка возвращается, иначе выплачивается текущий выигрыш.
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "900"))
+SESSION_KEY_TTL = {
+    'mines_game': 3600,
+    'promo_step': 1800, 'promo_amount': 1800, 'promo_days': 1800, 'promo_bulk': 1800,
+    'setting_game': 1800, 'setting_key': 1800, 'setting_value': 1800,
+    'reject_id': 1800,
+}
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_MB", "64")) * 2 ** 20
+SESSION_SWEEP_INTERVAL = 60
+SESSION_IDLE_DROP = 300
+
+SESSIONS_BYTES = Gauge("bot_sessions_bytes", "Примерный объём user_data всех пользователей")
+SESSIONS_ACTIVE = Gauge("bot_sessions", "Пользователи с user_data в памяти")
+SESSIONS_EVICTED = Counter("bot_session_evictions_total", "Снятые ключи и сессии", ("reason",))
+MINES_SETTLED = Counter("bot_mines_settled_total", "Брошенные игры в мины, закрытые при вытеснении", ("outcome",))
+
+class SessionData(dict):
+    """user_data с временем записи ключей и последней активности"""
+    __slots__ = ('written', 'last_seen')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.written = {}
+        self.last_seen = time.monotonic()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.written[key] = time.monotonic()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop_expired(self, now):
+        """Снимает просроченные ключи и возвращает их значения"""
+        expired = {}
+        for key, written in list(self.written.items()):
+            if key not in self:
+                del self.written[key]
+            elif now - written > SESSION_KEY_TTL.get(key, SESSION_TTL):
+                expired[key] = self.pop(key)
+                del self.written[key]
+        return expired
+
+def approx_size(obj, depth=3):
+    """Грубая оценка памяти объекта: getsizeof с обходом контейнеров на depth уровней"""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(approx_size(k, depth - 1) + approx_size(v, depth - 1) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(approx_size(v, depth - 1) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return size + approx_size(vars(obj), depth - 1)
+    return size
+
+def settle_mines_game(user_id, game):
+    """Закрывает брошенную игру; возвращает зачисленную сумму"""
+    if game.game_over:
+        return 0.0
+    if game.opened:
+        amount = game.cashout()
+        record_bet('mines', game.bet, amount)
+        MINES_SETTLED.labels('cashout').inc()
+        db.update_balance(user_id, amount, 'win')
+    else:
+        game.game_over = True
+        amount = game.bet
+        MINES_SETTLED.labels('refund').inc()
+        db.update_balance(user_id, amount, 'refund')
+    return amount
+
+async def notify_settled(bot, user_id, amount):
+    try:
+        await bot.send_message(user_id, f"💣 Игра в мины закрыта по таймауту, на баланс зачислено ${amount:.2f}",
+                               rate_limit_args=PRIORITY_NOTIFY)
+    except TelegramError as e:
+        logger.warning("Не удалось сообщить о закрытии мин %s: %s", user_id, e)
+
+async def expire_session(bot, user_id, session, now, reason):
+    expired = session.pop_expired(now) if reason == 'ttl' else dict(session)
+    if not expired:
+        return
+    SESSIONS_EVICTED.labels(reason).inc(len(expired))
+    game = expired.get('mines_game')
+    if game is not None:
+        amount = settle_mines_game(user_id, game)
+        if amount:
+            await notify_settled(bot, user_id, amount)
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: снимает просроченные ключи до основных обработчиков"""
+    traffic.hit()
+    session = context.user_data
+    if not isinstance(session, SessionData):
+        return
+    now = time.monotonic()
+    session.last_seen = now
+    await expire_session(context.bot, update.effective_user.id, session, now, 'ttl')
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    application = context.application
+    now = time.monotonic()
+    sizes = []
+    for user_id, session in list(application.user_data.items()):
+        if not isinstance(session, SessionData):
+            continue
+        await expire_session(context.bot, user_id, session, now, 'ttl')
+        if not session and now - session.last_seen > SESSION_IDLE_DROP:
+            application.drop_user_data(user_id)
+            SESSIONS_EVICTED.labels('idle').inc()
+            continue
+        sizes.append((session.last_seen, user_id, approx_size(session)))
+    total = sum(size for _, _, size in sizes)
+    if total > SESSION_MAX_BYTES:
+        # Вытесняем самые давние сессии, пока не уложимся в лимит
+        for _, user_id, size in sorted(sizes):
+            if total <= SESSION_MAX_BYTES:
+                break
+            session = application.user_data.get(user_id)
+            if session is not None:
+                await expire_session(context.bot, user_id, session, now, 'lru')
+                application.drop_user_data(user_id)
+            total -= size
+    SESSIONS_BYTES.set(total)
+
 # ======================== ПОПОЛНЕНИЕ ========================
 class DepositHandler:
     @staticmethod
@@ -1620,9 +3604,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user[11] == 1 and user_id not in ADMIN_IDS:
         await query.edit_message_text("❌ Вы заблокированы")
         return
-    if 'game_start_time' in context.user_data:
-        if time.time() - context.user_data['game_start_time'] > 600:
-            context.user_data.clear()
     data = query.data
 
     # ---------- ПРОФИЛЬ ----------
@@ -1634,6 +3615,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"👤 Имя: {user[2]}\n"
                 f"📛 Username: @{user[1] or 'нет'}\n"
                 f"💰 Баланс: ${user[3]:.2f}\n"
+                + (f"🔒 В заявках на вывод: ${user['held_cents'] / 100:.2f}\n" if user['held_cents'] else "") +
                 f"👥 Рефералов: {user[5]}\n\n"
                 f"📊 Статистика игр:\n"
                 f"• Всего игр: {stats[0] or 0}\n"
@@ -1643,7 +3625,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"📋 Последние выводы:\n")
         if wd:
             for w in wd:
-                emoji = {"pending":"⏳","approved":"✅","completed":"✔️","rejected":"❌"}.get(w[3],"❓")
+                emoji = {"pending":"⏳","approved":"✅","paying":"🔄","unknown":"🔄","review":"🔄","completed":"✔️","rejected":"❌","expired":"⌛"}.get(w[3],"❓")
                 text += f"{emoji} ${w[1]:.2f} — {w[2]}\n"
         else:
             text += "Пока нет выводов"
@@ -1735,7 +3717,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mines = int(data.replace("mines_set_", ""))
         context.user_data['mines_count'] = mines
         user = db.get_user(user_id)
-        max_bet = min(user[3], MAX_BET_ABSOLUTE)
+        max_bet = min(available(user), MAX_BET_ABSOLUTE)
         text = f"💣 Минное поле\n\nМин: {mines}\n\nВведите сумму ставки (мин. 0.1$, макс. ${max_bet:.2f}):"
         await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN)
         context.user_data['awaiting'] = 'mines_bet'
@@ -1748,14 +3730,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         res = game.open_cell(pos)
         if res['result'] == 'lose':
+            record_bet('mines', game.bet, 0)
             db.add_lost(user_id, game.bet)
             await edit_message(query, f"💥 БАБАХ!\n💰 Ставка ${game.bet:.2f} проиграна")
             context.user_data.pop('mines_game', None)
         elif res['result'] == 'win':
-            db.update_balance(user_id, res['win'])
+            record_bet('mines', game.bet, res['win'])
+            db.update_balance(user_id, res['win'], 'win')
             await edit_message(query, f"🎉 ТЫ ВЫИГРАЛ ВСЁ ПОЛЕ!\n💰 Выигрыш: ${res['win']:.2f}")
             context.user_data.pop('mines_game', None)
         elif res['result'] == 'continue':
+            # Повторная запись продлевает срок жизни игры в сессии
+            context.user_data['mines_game'] = game
             await show_mines_field(update, context, game)
         else:
             await edit_message(query, "❌ Неверный ход")
@@ -1764,7 +3750,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         game = context.user_data.get('mines_game')
         if game:
             win = game.cashout()
-            db.update_balance(user_id, win)
+            record_bet('mines', game.bet, win)
+            db.update_balance(user_id, win, 'win')
             await edit_message(query, f"💰 Забрал выигрыш\n💵 ${win:.2f}")
             context.user_data.pop('mines_game', None)
         else:
@@ -1780,10 +3767,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         game_type = context.user_data.get('game_type')
         game_choice = context.user_data.get('game_choice')
         current_user = db.get_user(user_id)
-        if not current_user or current_user[3] < bet:
+        if not current_user or available(current_user) < bet:
             await edit_message(query, "❌ Недостаточно средств. Пополните баланс.", home_button())
             return
-        db.update_balance(user_id, -bet)
+        db.update_balance(user_id, -bet, 'bet')
         await process_game_result(update, context, user_id, bet, game_type, game_choice)
         context.user_data.pop('game_data', None)
 
@@ -1820,14 +3807,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "confirm_open_case":
         case_price = 1.0
         current_user = db.get_user(user_id)
-        if current_user[3] < case_price:
+        if available(current_user) < case_price:
             await check_balance_and_offer(update, context, user_id, case_price, "confirm_open_case", "🎁 Открыть кейс")
             return
-        db.update_balance(user_id, -case_price)
-        res = db.open_case(1, user_id)
+        db.update_balance(user_id, -case_price, 'case')
+        round_id, rnd = outcomes.draw(user_id, 'case')
+        res = db.open_case(1, user_id, rnd[0])
         if res:
-            db.update_balance(user_id, res['value'])
-            text = f"🎉 Поздравляем!\n\nВы выиграли: {res['name']}\n💰 ${res['value']:.2f} зачислено на баланс!"
+            record_bet('case', case_price, res['value'])
+            db.update_balance(user_id, res['value'], 'case')
+            text = (f"🎉 Поздравляем!\n\nВы выиграли: {res['name']}\n💰 ${res['value']:.2f} зачислено на баланс!"
+                    f"{round_footer(round_id)}")
             kb = back_button("case_menu")
             await edit_message(query, text, kb)
         else:
@@ -1845,9 +3835,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ---------- БОНУС ----------
     elif data == "daily_bonus":
-        bonus = db.check_daily_bonus(user_id)
+        bonus = 0.0
+        if db.daily_bonus_available(user_id):
+            round_id, rnd = outcomes.draw(user_id, 'bonus')
+            bonus = db.check_daily_bonus(user_id, rnd[0])
         if bonus > 0:
-            text = f"🎁 +${bonus:.2f}"
+            text = f"🎁 +${bonus:.2f}{round_footer(round_id)}"
         else:
             text = "❌ Бонус уже получен сегодня"
         await edit_message(query, text, home_button())
@@ -1879,6 +3872,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "withdraw_menu":
         text = (f"💸 Вывод\n\n"
                 f"💰 Баланс: ${user[3]:.2f}\n"
+                + (f"🔒 В заявках на вывод: ${user['held_cents'] / 100:.2f}\n" if user['held_cents'] else "") +
+                f"✅ Доступно к выводу: ${available(user):.2f}\n"
                 f"💳 CryptoBot ID: {user[8] or 'не указан'}\n\n"
                 f"Минимум $2.00, комиссия 0%")
         kb = InlineKeyboardMarkup([
@@ -1900,14 +3895,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await edit_message(query, "💳 Отправьте ваш CryptoBot ID (только цифры):")
 
     elif data == "withdraw_crypto":
-        if user[3] < 2.0:
+        if available(user) < 2.0:
             await edit_message(query, "❌ Минимум $2.00")
             return
         if not user[8]:
             await edit_message(query, "❌ Сначала укажите CryptoBot ID")
             return
         context.user_data['awaiting'] = 'withdraw_crypto_amount'
-        await edit_message(query, f"💳 Введите сумму для вывода (макс ${user[3]:.2f}):")
+        await edit_message(query, f"💳 Введите сумму для вывода (макс ${available(user):.2f}):")
 
     # ---------- АДМИН-ПАНЕЛЬ ----------
     elif data == "admin_panel":
@@ -1915,7 +3910,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await edit_message(query, "❌ Нет прав")
             return
         stats = db.get_total_stats()
-        ps = len(db.get_pending_withdrawals())
+        ps = db.count_pending_withdrawals()
         text = (f"⚙️ Админ-панель\n\n"
                 f"👥 Пользователей: {stats['total_users']}\n"
                 f"💰 Баланс: ${stats['total_balance']:.2f}\n"
@@ -1923,7 +3918,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🎮 Игр: {stats['total_games']}\n\n"
                 f"⏳ Заявок на вывод: {ps}")
         kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("👥 Пользователи (CSV)", callback_data="admin_users_csv", style="primary")],
+            [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users", style="primary"),
+             InlineKeyboardButton("📄 CSV", callback_data="admin_users_csv", style="primary")],
             [InlineKeyboardButton("⏳ Заявки вывод", callback_data="admin_withdrawals", style="primary")],
             [InlineKeyboardButton("🎟️ Промокоды", callback_data="admin_promocodes", style="primary")],
             [InlineKeyboardButton("🔨 Баны", callback_data="admin_bans", style="danger")],
@@ -1951,10 +3947,107 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🏀 Баскетбол", callback_data="game_setting_basketball", style="primary")],
             [InlineKeyboardButton("🎯 Дартс", callback_data="game_setting_darts", style="primary")],
             [InlineKeyboardButton("🎳 Боулинг", callback_data="game_setting_bowling", style="primary")],
+            [InlineKeyboardButton("⚡ Мгновенный режим", callback_data="admin_instant_mode", style="success")],
+            [InlineKeyboardButton("📈 Отчёт RTP", callback_data="admin_rtp", style="primary")],
             [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel", style="danger")]
         ])
         await edit_message(query, text, kb)
 
+    elif data == "admin_rtp":
+        if user_id not in ADMIN_IDS:
+            return
+        text = f"📈 RTP игр (RTP_FACTOR = {RTP_FACTOR})\n"
+        current = None
+        for game, option, rtp, variance in rtp_report():
+            if game != current:
+                text += f"\n{GAME_TITLES[game]}\n"
+                current = game
+            warn = " ⚠️" if rtp >= 1.0 else ""
+            text += f"• {option}: {rtp * 100:.1f}%{warn} (дисп. {variance:.2f})\n"
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎲 Симуляция 10^7 раундов", callback_data="admin_rtp_sim", style="primary")],
+            [InlineKeyboardButton("◀️ Назад", callback_data="admin_game_settings", style="danger")]
+        ])
+        await query.edit_message_text(text, reply_markup=kb)
+
+    elif data == "admin_rtp_sim":
+        if user_id not in ADMIN_IDS:
+            return
+        await query.edit_message_text("⏳ Симуляция...")
+        # Курсор Database общий с циклом событий: кейсы читаются здесь, поток базу не трогает
+        cases = db.get_cases()
+
+        def run_simulation():
+            lines = []
+            for game, option, rtp, _ in rtp_report(cases=cases):
+                t0 = time.perf_counter()
+                sim = simulate_rtp(game, option, cases=cases)
+                elapsed = time.perf_counter() - t0
+                if sim:
+                    lines.append(f"{GAME_TITLES[game]} {option}: {sim[0] * 100:.2f}% "
+                                 f"(точно {rtp * 100:.2f}%, {elapsed:.2f} c)")
+            return lines
+
+        try:
+            lines = await asyncio.to_thread(run_simulation)
+            text = f"🎲 Симуляция по {RTP_SIM_ROUNDS:,} раундов\n\n" + "\n".join(lines)
+        except ImportError:
+            text = "❌ Для симуляции нужен numpy"
+        await query.edit_message_text(text, reply_markup=back_button("admin_rtp"))
+
+    elif data == "game_setting_apply":
+        if user_id not in ADMIN_IDS:
+            return
+        game = context.user_data.pop('setting_game', None)
+        key = context.user_data.pop('setting_key', None)
+        new_value = context.user_data.pop('setting_value', None)
+        if game is None or key is None or new_value is None:
+            await edit_message(query, "❌ Нет изменения для применения", back_button("admin_game_settings"))
+            return
+        GAME_SETTINGS[game][key] = new_value
+        db.save_game_settings()
+        await edit_message(query, f"✅ Коэффициент для {game} - {key} изменён на x{new_value}",
+                           back_button("admin_game_settings"))
+
+    elif data == "game_setting_cancel":
+        if user_id not in ADMIN_IDS:
+            return
+        for k in ('setting_game', 'setting_key', 'setting_value'):
+            context.user_data.pop(k, None)
+        await edit_message(query, "❌ Изменение отменено", back_button("admin_game_settings"))
+
+    elif data == "admin_instant_mode" or data.startswith("instant_toggle_"):
+        if user_id not in ADMIN_IDS:
+            return
+        if data.startswith("instant_toggle_"):
+            game = data.replace("instant_toggle_", "")
+            if game in DICE_GAMES:
+                if game in INSTANT_GAMES:
+                    INSTANT_GAMES.discard(game)
+                else:
+                    INSTANT_GAMES.add(game)
+                db.save_instant_games()
+        names = {
+            'dice_num': '🎲 Кости (число)',
+            'dice_even_odd': '🎲 Кости (чёт/нечёт)',
+            'slots': '🎰 Слоты',
+            'football': '⚽ Футбол',
+            'basketball': '🏀 Баскетбол',
+            'darts': '🎯 Дартс',
+            'bowling': '🎳 Боулинг'
+        }
+        text = ("⚡ *Мгновенный режим*\n\n"
+                "Результат считается на сервере с теми же шансами, что и у анимации Telegram, "
+                "и приходит одним сообщением без броска кубика.\n\n"
+                "Нажмите на игру, чтобы переключить режим:")
+        kb_rows = []
+        for game, name in names.items():
+            mark = "⚡ вкл" if game in INSTANT_GAMES else "🎬 выкл"
+            kb_rows.append([InlineKeyboardButton(f"{name} — {mark}", callback_data=f"instant_toggle_{game}",
+                                                 style="success" if game in INSTANT_GAMES else "primary")])
+        kb_rows.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_game_settings", style="danger")])
+        await edit_message(query, text, InlineKeyboardMarkup(kb_rows))
+
     elif data == "game_setting_flip":
         if user_id not in ADMIN_IDS:
             return
@@ -2192,6 +4285,19 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"📊 Чистая прибыль: ${s['profit']:.2f}")
         await edit_message(query, text, back_button("admin_panel"))
 
+    elif data == "admin_users" or data.startswith("admin_users:"):
+        if user_id not in ADMIN_IDS:
+            return
+        users, has_prev, has_next = db.get_users_page(**page_request(data))
+        text = f"👥 Пользователи (всего {db.count_users()})\n\n"
+        for u in users:
+            text += f"• {u[2]} (@{u[1]}) — ID: {u[0]} · ${u[3]:.2f}{' 🔨' if u[4] else ''}\n"
+        if not users:
+            text += "На этой странице никого нет\n"
+        kb_rows = page_buttons("admin_users", users, has_prev, has_next)
+        kb_rows.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel", style="danger")])
+        await edit_message(query, text, InlineKeyboardMarkup(kb_rows))
+
     elif data == "admin_users_csv":
         if user_id not in ADMIN_IDS:
             return
@@ -2204,33 +4310,89 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await edit_message(query, "✅ CSV-файл отправлен.", back_button("admin_panel"))
 
-    elif data == "admin_withdrawals":
+    elif data == "admin_withdrawals" or data.startswith("admin_withdrawals:"):
         if user_id not in ADMIN_IDS:
             return
-        ws = db.get_pending_withdrawals()
+        ws, has_prev, has_next = db.get_pending_withdrawals_page(**page_request(data))
+        approved_count, _, approved_last = db.withdrawal_summary('approved')
+        complete_row = [InlineKeyboardButton(f"📦 Выдано все одобренные ({approved_count})",
+                                             callback_data=f"complete_range_0_{approved_last}", style="primary")]
+        review_count = db.withdrawal_summary('review')[0]
+        review_row = [InlineKeyboardButton(f"❓ Автовыплаты на проверке ({review_count})",
+                                           callback_data="admin_payout_review", style="primary")]
         if not ws:
-            await edit_message(query, "✅ Нет заявок", back_button("admin_panel"))
+            kb_rows = [complete_row] if approved_count else []
+            if review_count:
+                kb_rows.append(review_row)
+            kb_rows.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel", style="danger")])
+            await edit_message(query, "✅ Нет заявок", InlineKeyboardMarkup(kb_rows))
             return
-        text = "⏳ Заявки на вывод:\n\n"
+        text = f"⏳ Заявки на вывод (всего {db.count_pending_withdrawals()}):\n\n"
         kb_rows = []
-        for w in ws[:5]:
-            text += f"🆔 #{w[0]}\n👤 @{w[7]}\n💰 ${w[2]:.2f}\n🕐 {w[6][:16]}\n\n"
+        for w in ws:
+            text += f"🆔 #{w[0]}\n👤 @{w[7]}\n💰 ${w[2]:.2f}\n🕐 {w[6][:16]}\n"
+            if w[9]:
+                text += f"⚠️ Автовыплата: {w[9]}\n"
+            text += "\n"
             kb_rows.append([
                 InlineKeyboardButton(f"✅ Принять #{w[0]}", callback_data=f"approve_withdrawal_{w[0]}", style="success"),
                 InlineKeyboardButton(f"❌ Отклонить #{w[0]}", callback_data=f"reject_withdrawal_{w[0]}", style="danger")
             ])
+        kb_rows += page_buttons("admin_withdrawals", ws, has_prev, has_next)
+        count, total, last_id = db.withdrawal_summary('pending')
+        kb_rows.append([InlineKeyboardButton(f"✅ Принять все подходящие ({count}, ${total:.2f})",
+                                             callback_data=f"approve_range_0_{last_id}", style="success")])
+        if approved_count:
+            kb_rows.append(complete_row)
+        if review_count:
+            kb_rows.append(review_row)
         kb_rows.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel", style="danger")])
         kb = InlineKeyboardMarkup(kb_rows)
         await edit_message(query, text, kb)
 
+    elif data == "admin_payout_review":
+        if user_id not in ADMIN_IDS:
+            return
+        rows = db.get_payouts_in_review(PAYOUT_REVIEW_LIST)
+        if not rows:
+            await edit_message(query, "✅ Автовыплат на проверке нет", back_button("admin_withdrawals"))
+            return
+        text = "❓ Автовыплаты на проверке: баланс списан, перевода в CryptoBot не нашлось.\n\n"
+        kb_rows = []
+        for w in rows:
+            text += f"🆔 #{w[0]}\n👤 @{w[6]}\n💰 ${w[2]:.2f}\n🔑 {w[3]} · попыток {w[4]}\n"
+            if w[5]:
+                text += f"⚠️ {w[5]}\n"
+            text += "\n"
+            kb_rows += payout_review_keyboard(w[0]).inline_keyboard
+        kb_rows.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_withdrawals", style="danger")])
+        await edit_message(query, text, InlineKeyboardMarkup(kb_rows))
+
+    elif data.startswith("payout_done_") or data.startswith("payout_refund_"):
+        if user_id not in ADMIN_IDS:
+            return
+        transferred = data.startswith("payout_done_")
+        wid = int(data.rsplit("_", 1)[1])
+        resolved = db.resolve_payout(wid, user_id, transferred)
+        if not resolved:
+            await edit_message(query, f"❌ Заявка #{wid} уже не на проверке", back_button("admin_withdrawals"))
+            return
+        uid, amt = resolved
+        if transferred:
+            enqueue_messages([(uid, completed_text(amt))])
+            await edit_message(query, f"✅ Заявка #{wid} отмечена выполненной.", back_button("admin_payout_review"))
+        else:
+            enqueue_messages([(uid, f"↩️ Автовыплата не прошла\n💰 ${amt:.2f} возвращены на баланс.")])
+            await edit_message(query, f"↩️ Заявка #{wid}: ${amt:.2f} возвращены на баланс.",
+                               back_button("admin_payout_review"))
+
     elif data.startswith("approve_withdrawal_"):
         if user_id not in ADMIN_IDS:
             return
         wid = int(data.replace("approve_withdrawal_", ""))
-        if db.approve_withdrawal(wid, user_id):
-            db.cursor.execute('SELECT user_id, amount FROM withdrawals WHERE id = ?', (wid,))
-            uid, amt = db.cursor.fetchone()
-            await context.bot.send_message(uid, f"✅ Заявка на вывод одобрена!\n💰 ${amt:.2f}\n⏳ Ожидайте выдачи.")
+        approved = db.approve_withdrawals(wid, wid, user_id)
+        if approved:
+            enqueue_messages((uid, approved_text(amt)) for _, uid, amt in approved)
             kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"✅ Выдано #{wid}", callback_data=f"complete_withdrawal_{wid}", style="success")]])
             await edit_message(query, f"✅ Заявка #{wid} одобрена. После выдачи нажмите кнопку.", kb)
         else:
@@ -2240,14 +4402,41 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_id not in ADMIN_IDS:
             return
         wid = int(data.replace("complete_withdrawal_", ""))
-        if db.complete_withdrawal(wid, user_id):
-            db.cursor.execute('SELECT user_id, amount FROM withdrawals WHERE id = ?', (wid,))
-            uid, amt = db.cursor.fetchone()
-            await context.bot.send_message(uid, f"✅ Вывод выполнен!\n💰 ${amt:.2f} получены.")
+        completed = db.complete_withdrawals(wid, wid, user_id)
+        if completed:
+            enqueue_messages((uid, completed_text(amt)) for _, uid, amt in completed)
             await edit_message(query, f"✅ Заявка #{wid} завершена.")
         else:
             await edit_message(query, "❌ Ошибка")
 
+    elif data.startswith("approve_range_"):
+        if user_id not in ADMIN_IDS:
+            return
+        first, last = map(int, data.replace("approve_range_", "").split("_"))
+        approved = db.approve_withdrawals(first, last, user_id)
+        if not approved:
+            await edit_message(query, "✅ Нет заявок для одобрения", back_button("admin_panel"))
+            return
+        enqueue_messages((uid, approved_text(amt)) for _, uid, amt in approved)
+        total = sum(amt for _, _, amt in approved)
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"✅ Выдано все ({len(approved)})",
+                                  callback_data=f"complete_range_{approved[0][0]}_{approved[-1][0]}", style="success")],
+            [InlineKeyboardButton("📋 Открыть список", callback_data="admin_withdrawals", style="primary")]
+        ])
+        await edit_message(query, f"✅ Одобрено заявок: {len(approved)} на ${total:.2f} "
+                                  f"(#{approved[0][0]}–#{approved[-1][0]}).\n"
+                                  f"Заявки без покрытия балансом остались в списке.\n"
+                                  f"После выдачи нажмите кнопку.", kb)
+
+    elif data.startswith("complete_range_"):
+        if user_id not in ADMIN_IDS:
+            return
+        first, last = map(int, data.replace("complete_range_", "").split("_"))
+        completed = db.complete_withdrawals(first, last, user_id)
+        enqueue_messages((uid, completed_text(amt)) for _, uid, amt in completed)
+        await edit_message(query, f"✅ Завершено заявок: {len(completed)}.", back_button("admin_panel"))
+
     elif data.startswith("reject_withdrawal_"):
         if user_id not in ADMIN_IDS:
             return
@@ -2256,18 +4445,22 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['awaiting'] = 'reject_reason'
         await edit_message(query, f"❌ Причина отказа для #{wid}:")
 
-    elif data == "admin_promocodes":
+    elif data == "admin_promocodes" or data.startswith("admin_promocodes:"):
         if user_id not in ADMIN_IDS:
             return
-        promos = db.get_all_promocodes()
-        text = "🎟️ Промокоды\n\n"
+        promos, has_prev, has_next = db.get_promocodes_page(**page_request(data))
+        text = f"🎟️ Промокоды (всего {db.count_promocodes()})\n\n"
         for p in promos:
             text += f"• `{p[1]}` — ${p[2]:.2f} | {p[5]}/{p[4]}\n"
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("➕ Создать", callback_data="admin_create_promo", style="success")],
+        if not promos:
+            text += "На этой странице промокодов нет\n"
+        kb_rows = page_buttons("admin_promocodes", promos, has_prev, has_next)
+        kb_rows += [
+            [InlineKeyboardButton("➕ Создать", callback_data="admin_create_promo", style="success"),
+             InlineKeyboardButton("📦 Пачка кодов", callback_data="admin_bulk_promo", style="success")],
             [InlineKeyboardButton("◀️ Назад", callback_data="admin_panel", style="danger")]
-        ])
-        await edit_message(query, text, kb)
+        ]
+        await edit_message(query, text, InlineKeyboardMarkup(kb_rows))
 
     elif data == "admin_create_promo":
         if user_id not in ADMIN_IDS:
@@ -2276,18 +4469,26 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['awaiting'] = 'promo_amount'
         await edit_message(query, "🎟️ Сумма в $:")
 
-    elif data == "admin_bans":
+    elif data == "admin_bulk_promo":
+        if user_id not in ADMIN_IDS:
+            return
+        context.user_data['promo_bulk'] = True
+        context.user_data['awaiting'] = 'promo_amount'
+        await edit_message(query, "📦 Одноразовые коды для партнёров.\n🎟️ Сумма каждого в $:")
+
+    elif data == "admin_bans" or data.startswith("admin_bans:"):
         if user_id not in ADMIN_IDS:
             return
-        banned = db.get_banned_users()
+        banned, has_prev, has_next = db.get_banned_users_page(**page_request(data))
         if not banned:
             await edit_message(query, "✅ Нет забаненных", back_button("admin_panel"))
             return
-        text = "🔨 Забанены:\n\n"
+        text = f"🔨 Забанены (всего {db.count_banned_users()}):\n\n"
         kb_rows = []
         for b in banned:
             text += f"• {b[2]} (@{b[1]}) — ID: {b[0]}\n"
             kb_rows.append([InlineKeyboardButton(f"✅ Разбанить {b[0]}", callback_data=f"unban_{b[0]}", style="success")])
+        kb_rows += page_buttons("admin_bans", banned, has_prev, has_next)
         kb_rows.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel", style="danger")])
         kb = InlineKeyboardMarkup(kb_rows)
         await edit_message(query, text, kb)
@@ -2362,6 +4563,655 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pass
 
+# ======================== РАССЫЛКА ========================
+async def run_broadcast(bot, admin_id, chat_ids, send):
+    """Отправляет пачками по BROADCAST_CHUNK; темп задаёт OutboundScheduler"""
+    sent = 0
+    failed = 0
+    for i in range(0, len(chat_ids), BROADCAST_CHUNK):
+        results = await asyncio.gather(*(send(chat_id) for chat_id in chat_ids[i:i + BROADCAST_CHUNK]),
+                                       return_exceptions=True)
+        errors = sum(1 for r in results if isinstance(r, Exception))
+        failed += errors
+        sent += len(results) - errors
+    await bot.send_message(admin_id, f"✅ Отправлено: {sent}\n❌ Ошибок: {failed}", rate_limit_args=PRIORITY_NOTIFY)
+
+# ======================== УВЕДОМЛЕНИЯ ========================
+# Обработчики не шлют уведомления сами, а пишут их в таблицу notifications.
+# dispatch_notifications раз в NOTIFY_INTERVAL секунд забирает очередь и
+# отправляет всё параллельно (темп держит OutboundScheduler). Заявки на
+# вывод копятся за интервал: если админу набралось NOTIFY_DIGEST_MIN и
+# больше, он получает одну сводку с кнопкой «принять все». Уведомления о
+# заявках, которые уже решены, не отправляются вовсе.
+NOTIFY_INTERVAL = float(os.environ.get("NOTIFY_INTERVAL", "3"))
+NOTIFY_BATCH = 500
+NOTIFY_DIGEST_MIN = int(os.environ.get("NOTIFY_DIGEST_MIN", "4"))
+NOTIFY_DIGEST_LINES = 15
+NOTIFY_MAX_ATTEMPTS = 5
+
+NOTIFICATIONS = Counter("bot_notifications_total", "Доставка уведомлений из очереди", ("kind", "outcome"))
+NOTIFICATIONS_QUEUED = Gauge("bot_notifications_queued", "Уведомления в очереди на отправку")
+
+def enqueue_notifications(chat_ids, text, kind='text', ref_id=None):
+    db.enqueue_notifications([(chat_id, kind, ref_id, text) for chat_id in chat_ids])
+
+def notify_admins(text, kind='text', ref_id=None):
+    enqueue_notifications(ADMIN_IDS, text, kind, ref_id)
+
+def enqueue_messages(messages):
+    """messages: (chat_id, текст) — все попадают в очередь одной транзакцией"""
+    db.enqueue_notifications([(chat_id, 'text', None, text) for chat_id, text in messages])
+
+def approved_text(amount):
+    return f"✅ Заявка на вывод одобрена!\n💰 ${amount:.2f}\n⏳ Ожидайте выдачи."
+
+def completed_text(amount):
+    return f"✅ Вывод выполнен!\n💰 ${amount:.2f} получены."
+
+def withdrawal_keyboard(wid):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Принять #{wid}", callback_data=f"approve_withdrawal_{wid}", style="success"),
+         InlineKeyboardButton(f"❌ Отклонить #{wid}", callback_data=f"reject_withdrawal_{wid}", style="danger")]
+    ])
+
+def withdrawal_digest(items):
+    ids = [n['ref_id'] for n in items]
+    total = sum(n['ref_amount'] for n in items)
+    text = f"📬 Новые заявки на вывод: {len(items)} на ${total:.2f}\n\n"
+    for n in items[:NOTIFY_DIGEST_LINES]:
+        text += f"🆔 #{n['ref_id']} · @{n['ref_username']} · ${n['ref_amount']:.2f}\n"
+    if len(items) > NOTIFY_DIGEST_LINES:
+        text += f"…и ещё {len(items) - NOTIFY_DIGEST_LINES}\n"
+    # Выдать можно только одобренные: кнопка пригодится, когда заявки одобрил другой админ
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Принять все ({len(items)})", callback_data=f"approve_range_{min(ids)}_{max(ids)}",
+                              style="success")],
+        [InlineKeyboardButton("📦 Выдано все одобренные", callback_data=f"complete_range_{min(ids)}_{max(ids)}",
+                              style="primary")],
+        [InlineKeyboardButton("📋 Открыть список", callback_data="admin_withdrawals", style="primary")]
+    ])
+    return text, kb
+
+async def dispatch_notifications(context: ContextTypes.DEFAULT_TYPE):
+    due = db.get_due_notifications(NOTIFY_BATCH)
+    if not due:
+        return
+    done = []
+    sends = []  # (уведомления, вид, chat_id, текст, клавиатура)
+    withdrawals = defaultdict(list)
+    for n in due:
+        if n['kind'] == 'payout_review':
+            sends.append(([n], n['kind'], n['chat_id'], n['text'], payout_review_keyboard(n['ref_id'])))
+        elif n['kind'] != 'withdrawal':
+            sends.append(([n], n['kind'], n['chat_id'], n['text'], None))
+        elif n['ref_status'] != 'pending':
+            done.append(n['id'])
+            NOTIFICATIONS.labels('withdrawal', 'dropped').inc()
+        else:
+            withdrawals[n['chat_id']].append(n)
+    for chat_id, items in withdrawals.items():
+        if len(items) >= NOTIFY_DIGEST_MIN:
+            sends.append((items, 'digest', chat_id, *withdrawal_digest(items)))
+        else:
+            sends.extend(([n], 'withdrawal', chat_id, n['text'], withdrawal_keyboard(n['ref_id'])) for n in items)
+
+    results = await asyncio.gather(*(
+        context.bot.send_message(chat_id, text, reply_markup=kb, rate_limit_args=PRIORITY_NOTIFY)
+        for _, _, chat_id, text, kb in sends
+    ), return_exceptions=True)
+    for (items, kind, chat_id, _, _), result in zip(sends, results):
+        ids = [n['id'] for n in items]
+        if not isinstance(result, Exception):
+            done.extend(ids)
+            NOTIFICATIONS.labels(kind, 'sent').inc()
+            continue
+        attempts = max(n['attempts'] for n in items) + 1
+        # Бот заблокирован — повторять бессмысленно
+        final = isinstance(result, Forbidden) or attempts >= NOTIFY_MAX_ATTEMPTS
+        db.defer_notifications(ids, NOTIFY_INTERVAL * 2 ** attempts, repr(result), final)
+        NOTIFICATIONS.labels(kind, 'failed' if final else 'retry').inc()
+        logger.warning("Уведомление %s для %s не отправлено (попытка %s): %s", kind, chat_id, attempts, result)
+    db.delete_notifications(done)
+
+# ======================== ПРОМОКОДЫ ========================
+# Активации копятся PROMO_BATCH_WINDOW секунд (или до PROMO_BATCH_MAX) и
+# фиксируются одной транзакцией Database.redeem_promocodes. Несуществующие,
+# истёкшие и исчерпанные коды отсекаются по кэшу без обращения к базе.
+PROMO_BATCH_WINDOW = 0.005
+PROMO_BATCH_MAX = 500
+PROMO_CACHE_TTL = 30
+PROMO_CACHE_MAX = 10000
+
+PROMO_REASONS = {
+    'not_found': '❌ Код не найден',
+    'expired': '❌ Промокод истёк',
+    'exhausted': '❌ Промокод использован максимальное количество раз',
+    'used': '❌ Вы уже активировали этот промокод',
+}
+
+PROMO_REDEMPTIONS = Counter("bot_promo_redemptions_total", "Попытки активации промокодов", ("outcome",))
+PROMO_BATCH = Histogram("bot_promo_batch_size", "Активаций в одной транзакции",
+                        buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+def promo_result(outcome, amount=None):
+    PROMO_REDEMPTIONS.labels(outcome).inc()
+    if outcome == 'ok':
+        return {'success': True, 'amount': amount}
+    return {'success': False, 'reason': PROMO_REASONS[outcome]}
+
+class PromoRedeemer:
+    """Кэш кодов и групповая фиксация активаций"""
+
+    def __init__(self, database, window=PROMO_BATCH_WINDOW, max_batch=PROMO_BATCH_MAX):
+        self.db = database
+        self.window = window
+        self.max_batch = max_batch
+        self.cache = {}  # code → (amount, expires_at, загружено) или (None, None, загружено)
+        self.exhausted = {}  # code → когда лимит кончился
+        self.pending = []  # (user_id, code, amount, future)
+        self._timer = None
+
+    def lookup(self, code):
+        now = time.monotonic()
+        entry = self.cache.get(code)
+        if entry is None or now - entry[2] > PROMO_CACHE_TTL:
+            if len(self.cache) >= PROMO_CACHE_MAX:
+                self.cache.clear()
+            promo = self.db.get_promocode_info(code)
+            entry = (promo[2], promo[3], now) if promo else (None, None, now)
+            self.cache[code] = entry
+        return entry
+
+    def forget(self, code):
+        self.cache.pop(code, None)
+        self.exhausted.pop(code, None)
+
+    def forget_missing(self):
+        """После создания кодов: закэшированное «не найден» могло устареть"""
+        self.cache = {code: entry for code, entry in self.cache.items() if entry[0] is not None}
+
+    async def redeem(self, user_id, code):
+        amount, expires_at, _ = self.lookup(code)
+        if amount is None:
+            return promo_result('not_found')
+        if expires_at and datetime.now().date().isoformat() > expires_at:
+            return promo_result('expired')
+        if time.monotonic() - self.exhausted.get(code, -PROMO_CACHE_TTL) < PROMO_CACHE_TTL:
+            return promo_result('exhausted')
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((user_id, code, amount, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        PROMO_BATCH.observe(len(batch))
+        try:
+            outcomes = self.db.redeem_promocodes([(user_id, code, amount) for user_id, code, amount, _ in batch])
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        now = time.monotonic()
+        for (_, code, amount, future), outcome in zip(batch, outcomes):
+            if outcome == 'exhausted':
+                self.exhausted[code] = now
+            if not future.done():
+                future.set_result(promo_result(outcome, amount))
+
+promo_redeemer = PromoRedeemer(db)
+
+def promocodes_csv(codes, amount, expires_at, max_uses):
+    """CSV пачки кодов: строки пишутся в буфер по мере обхода, без промежуточного списка"""
+    output = io.BytesIO()
+    text = io.TextIOWrapper(output, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(['Код', 'Сумма ($)', 'Действует до', 'Активаций'])
+    writer.writerows((code, f"{amount:.2f}", expires_at, max_uses) for code in codes)
+    text.detach()
+    output.seek(0)
+    return output
+
+def build_promocodes(path, count, amount, days, created_by):
+    """Фоновый поток: коды пачки своим соединением и готовый CSV"""
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        codes, expires_at = db.generate_promocodes(count, amount, days, 1, created_by, conn=conn)
+    finally:
+        conn.close()
+    return codes, expires_at, promocodes_csv(codes, amount, expires_at, 1)
+
+async def send_bulk_promocodes(bot, chat_id, count, amount, days):
+    try:
+        codes, expires_at, document = await asyncio.to_thread(build_promocodes, db.path, count, amount, days, chat_id)
+    except sqlite3.Error as e:
+        logger.warning("Пачка промокодов не создана: %s", e)
+        await bot.send_message(chat_id, f"❌ Коды не созданы: {e}")
+        return
+    promo_redeemer.forget_missing()
+    await bot.send_document(
+        chat_id=chat_id,
+        document=document,
+        filename=f"promocodes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        caption=f"📦 {len(codes)} кодов по ${amount:.2f}, до {expires_at}"
+    )
+
+async def redeem_promocode(update, user_id, code):
+    res = await promo_redeemer.redeem(user_id, code)
+    if res['success']:
+        msg = f"✅ Промокод активирован!\n💰 +${res['amount']:.2f}"
+    else:
+        msg = res['reason']
+    await update.message.reply_text(msg, reply_markup=home_button())
+
+# ======================== АВТОВЫПЛАТЫ ========================
+# Заявки до AUTO_PAYOUT_MAX долларов выплачивает задача JobQueue через
+# CryptoBot. Заявка переходит в paying вместе со списанием баланса, затем
+# делается перевод со spend_id «withdrawal_<id>». Нет ответа — статус unknown,
+# и сверка через getTransfers решает: перевод был — completed, не было —
+# повтор с тем же spend_id. Отказ CryptoBot возвращает деньги и отдаёт
+# заявку админам. paying после перезапуска сверяется так же, как unknown.
+# Когда AUTO_PAYOUT_MAX_ATTEMPTS попыток кончились, а перевода нет, заявка
+# уходит в review: сверка её больше не опрашивает, админ отмечает перевод
+# выполненным или возвращает деньги.
+AUTO_PAYOUT_MAX = float(os.environ.get("AUTO_PAYOUT_MAX", "0"))
+AUTO_PAYOUT_INTERVAL = int(os.environ.get("AUTO_PAYOUT_INTERVAL", "30"))
+AUTO_PAYOUT_BATCH = int(os.environ.get("AUTO_PAYOUT_BATCH", "20"))
+AUTO_PAYOUT_CONCURRENCY = int(os.environ.get("AUTO_PAYOUT_CONCURRENCY", "4"))
+AUTO_PAYOUT_MAX_ATTEMPTS = 3
+PAYOUT_REVIEW_LIST = 20
+
+PAYOUTS = Counter("bot_payouts_total", "Исходы автовыплат", ("outcome",))
+payouts_in_flight = set()
+
+def auto_payout_eligible(amount):
+    return bool(AUTO_PAYOUT_MAX and CRYPTOBOT_API_KEY) and amount <= AUTO_PAYOUT_MAX
+
+def apply_payout_result(w, outcome, result):
+    wid = w['id']
+    PAYOUTS.labels(outcome).inc()
+    if outcome == 'completed':
+        if db.complete_payout(wid, result.get('transfer_id')):
+            enqueue_notifications([w['user_id']], f"✅ Вывод выполнен!\n💰 ${w['amount']:.2f} отправлены в CryptoBot.")
+    elif outcome == 'failed':
+        if db.fail_payout(wid, result):
+            notify_admins(f"⚠️ Автовыплата #{wid} (${w['amount']:.2f}) отклонена CryptoBot: {result}\n"
+                                     f"Баланс возвращён, заявка ждёт ручного решения.")
+    else:
+        # Последнюю попытку разберёт следующая сверка: перевод найдётся или заявка уйдёт в review
+        db.mark_payout_unknown(wid, result)
+
+def payout_review_keyboard(wid):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Перевод прошёл #{wid}", callback_data=f"payout_done_{wid}", style="success"),
+         InlineKeyboardButton(f"↩️ Вернуть #{wid}", callback_data=f"payout_refund_{wid}", style="danger")]
+    ])
+
+async def pay_out(w, semaphore):
+    payouts_in_flight.add(w['id'])
+    try:
+        async with semaphore:
+            outcome, result = await asyncio.to_thread(crypto.transfer, w['user_id'], w['payout_amount'], w['spend_id'])
+        apply_payout_result(w, outcome, result)
+    finally:
+        payouts_in_flight.discard(w['id'])
+
+async def reconcile_payouts(semaphore):
+    retries = []
+    for w in db.get_unsettled_payouts():
+        if w['id'] in payouts_in_flight:
+            continue
+        try:
+            transfer = await asyncio.to_thread(crypto.get_transfer, w['spend_id'])
+        except Exception as e:
+            logger.warning("Сверка выплаты #%s не удалась: %s", w['id'], e)
+            continue
+        if transfer:
+            apply_payout_result(w, 'completed', transfer)
+        elif w['payout_attempts'] < AUTO_PAYOUT_MAX_ATTEMPTS:
+            # Перевода нет — повтор с тем же spend_id безопасен
+            db.retry_payout(w['id'])
+            w['payout_attempts'] += 1
+            retries.append(pay_out(w, semaphore))
+        elif w['status'] == 'unknown' and db.send_payout_to_review(w['id']):
+            PAYOUTS.labels('review').inc()
+            notify_admins(f"❓ Автовыплата #{w['id']} (${w['amount']:.2f}): перевода {w['spend_id']} нет в CryptoBot "
+                          f"после {w['payout_attempts']} попыток. Баланс списан — проверьте и решите вручную.",
+                          'payout_review', w['id'])
+    await asyncio.gather(*retries)
+
+async def auto_payout_job(context: ContextTypes.DEFAULT_TYPE):
+    if not AUTO_PAYOUT_MAX or not CRYPTOBOT_API_KEY:
+        return
+    semaphore = asyncio.Semaphore(AUTO_PAYOUT_CONCURRENCY)
+    await reconcile_payouts(semaphore)
+    if not db.count_auto_payouts(AUTO_PAYOUT_MAX):
+        return
+    ton_price = await asyncio.to_thread(get_ton_to_dollar)
+    batch = db.claim_auto_payouts(AUTO_PAYOUT_MAX, AUTO_PAYOUT_BATCH, ton_price)
+    await asyncio.gather(*(pay_out(w, semaphore) for w in batch))
+
+# ======================== СВЕРКА БАЛАНСОВ ========================
+# check_integrity открывает базу отдельным соединением только на чтение и
+# в одной читающей транзакции (WAL: игра пишет дальше, сверка видит
+# согласованный снимок). Все проходы идут потоком по индексам в порядке
+# ключа, в Python одновременно живёт пачка из INTEGRITY_FETCH строк:
+#   · users слиянием по user_id с суммами ledger — кэш баланса против журнала,
+#     и с суммами pending-заявок — холды и доступный остаток;
+#   · проводки со ссылками — против платежей, заявок, активаций промокодов
+#     и рефереров;
+#   · платежи и заявки после перехода на журнал — против их проводок.
+# Ставки, выигрыши и ежедневные бонусы своих строк, кроме журнала, не
+# оставляют, поэтому сверяются в составе суммы по пользователю.
+INTEGRITY_FETCH = 10000
+INTEGRITY_SAMPLES = 20
+INTEGRITY_INTERVAL = 86400
+INTEGRITY_POLL = 3600  # плановая сверка ждёт окна MAINT_HOURS, проверяя его раз в столько секунд
+DEBITED_STATUSES = ('approved', 'completed', 'paying', 'unknown', 'review')
+
+INTEGRITY_MISMATCHES = Gauge("bot_integrity_mismatches", "Расхождения последней сверки балансов", ("kind",))
+
+def stream_rows(conn, sql, params=()):
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(INTEGRITY_FETCH)
+        if not rows:
+            return
+        yield from rows
+
+def aligned(rows, orphan):
+    """Поток (user_id, значение) по возрастанию user_id → take(user_id) с нулём для пропусков.
+    Строки пользователей, которых нет в users, уходят в orphan"""
+    rows = iter(rows)
+    head = next(rows, None)
+
+    def take(user_id=None):
+        nonlocal head
+        while head is not None and (user_id is None or head[0] < user_id):
+            orphan(head)
+            head = next(rows, None)
+        if head is not None and head[0] == user_id:
+            value, head = head[1], next(rows, None)
+            return value
+        return 0
+    return take
+
+def check_integrity(path, samples=INTEGRITY_SAMPLES):
+    """Сверяет балансы с журналом и журнал с исходными таблицами. Ничего не пишет"""
+    started = time.perf_counter()
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, isolation_level=None, check_same_thread=False)
+    conn.create_function('cents', 1, to_cents, deterministic=True)
+    report = {'users': 0, 'ledger_users': 0, 'references': 0, 'mismatches': defaultdict(int), 'samples': []}
+
+    def mismatch(kind, *details):
+        report['mismatches'][kind] += 1
+        if len(report['samples']) < samples:
+            report['samples'].append((kind, *details))
+
+    def counted(rows):
+        for row in rows:
+            report['ledger_users'] += 1
+            yield row
+
+    try:
+        conn.execute('BEGIN')
+        row = conn.execute("SELECT value FROM settings WHERE key = 'ledger_since'").fetchone()
+        since = json.loads(row[0]) if row else {'payments': 0, 'withdrawals': 0}
+
+        # 1. Кэш баланса и холды против журнала и заявок: слияние потоков, упорядоченных по user_id
+        ledger = aligned(counted(stream_rows(conn, '''
+            SELECT user_id, SUM(amount_cents) FROM ledger INDEXED BY idx_ledger_balance GROUP BY user_id ORDER BY user_id
+        ''')), lambda row: mismatch('orphan', row[0], None, row[1]))
+        holds = aligned(stream_rows(conn, '''
+            SELECT user_id, SUM(cents(amount)) FROM withdrawals WHERE status = 'pending' GROUP BY user_id ORDER BY user_id
+        '''), lambda row: mismatch('orphan', row[0], 'hold', row[1]))
+        for user_id, balance_cents, balance, held_cents, available_cents in stream_rows(conn, '''
+            SELECT user_id, balance_cents, balance, held_cents, available_cents FROM users ORDER BY user_id
+        '''):
+            report['users'] += 1
+            expected = ledger(user_id)
+            held = holds(user_id)
+            if balance_cents != expected:
+                mismatch('balance', user_id, balance_cents, expected)
+            elif balance != balance_cents / 100:
+                mismatch('mirror', user_id, balance_cents, balance)
+            if held_cents != held:
+                mismatch('hold', user_id, held_cents, held)
+            elif available_cents != balance_cents - held_cents:
+                mismatch('available', user_id, available_cents, balance_cents - held_cents)
+        ledger()
+        holds()
+
+        # 2. Проводки со ссылками: источник есть, принадлежит тому же пользователю и сходится по сумме
+        report['references'] = conn.execute('SELECT COUNT(*) FROM ledger WHERE ref_id IS NOT NULL').fetchone()[0]
+        for row in stream_rows(conn, '''
+            SELECT l.id, l.reason, l.user_id, l.amount_cents, l.ref_id FROM ledger l
+            LEFT JOIN payments p ON l.reason = 'deposit' AND p.id = l.ref_id
+            LEFT JOIN withdrawals w ON l.reason IN ('withdrawal', 'refund') AND w.id = l.ref_id
+            LEFT JOIN promocode_uses pu ON l.reason = 'promo' AND pu.id = l.ref_id
+            LEFT JOIN users r ON l.reason = 'referral' AND r.user_id = l.ref_id
+            WHERE l.ref_id IS NOT NULL AND (
+                (l.reason = 'deposit' AND (p.id IS NULL OR p.user_id != l.user_id OR p.status != 'completed'
+                                           OR cents(p.amount) != l.amount_cents))
+                OR (l.reason = 'withdrawal' AND (w.id IS NULL OR w.user_id != l.user_id
+                                                 OR cents(w.amount) != -l.amount_cents))
+                OR (l.reason = 'refund' AND (w.id IS NULL OR w.user_id != l.user_id
+                                             OR cents(w.amount) != l.amount_cents))
+                OR (l.reason = 'promo' AND (pu.id IS NULL OR pu.user_id != l.user_id))
+                OR (l.reason = 'referral' AND (r.user_id IS NULL OR r.referred_by IS NOT l.user_id))
+            )
+            ORDER BY l.id
+        '''):
+            mismatch('reference', *row)
+
+        # 3. Обратная сторона: каждое зачисление и списание по новым платежам и заявкам проведено
+        for row in stream_rows(conn, '''
+            SELECT p.id, p.user_id, p.amount FROM payments p
+            WHERE p.id > ? AND p.status = 'completed'
+              AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.reason = 'deposit' AND l.ref_id = p.id)
+            ORDER BY p.id
+        ''', (since['payments'],)):
+            mismatch('deposit', *row)
+        statuses = ', '.join(f"'{status}'" for status in DEBITED_STATUSES)
+        for row in stream_rows(conn, f'''
+            SELECT w.id, w.user_id, w.status, expected, net FROM (
+                SELECT w.id, w.user_id, w.status,
+                       CASE WHEN w.status IN ({statuses}) THEN -cents(w.amount) ELSE 0 END AS expected,
+                       (SELECT COALESCE(SUM(l.amount_cents), 0) FROM ledger l
+                        WHERE l.reason IN ('withdrawal', 'refund') AND l.ref_id = w.id) AS net
+                FROM withdrawals w WHERE w.id > ?
+            ) w WHERE expected != net
+            ORDER BY w.id
+        ''', (since['withdrawals'],)):
+            mismatch('withdrawal', *row)
+    finally:
+        conn.close()
+    report['mismatches'] = dict(report['mismatches'])
+    report['seconds'] = round(time.perf_counter() - started, 2)
+    return report
+
+def integrity_text(report):
+    lines = [f"🧮 Сверка балансов за {report['seconds']} с\n"
+             f"Пользователей: {report['users']}, в журнале: {report['ledger_users']}, "
+             f"проводок со ссылками: {report['references']}"]
+    if not report['mismatches']:
+        lines.append("✅ Расхождений нет")
+    else:
+        lines.append("❌ Расхождения: " + ", ".join(f"{kind} — {n}" for kind, n in report['mismatches'].items()))
+        lines += [" · ".join(str(v) for v in sample) for sample in report['samples']]
+    return "\n".join(lines)
+
+async def run_integrity_check():
+    report = await asyncio.to_thread(check_integrity, db.path)
+    for kind in ('balance', 'mirror', 'hold', 'available', 'orphan', 'reference', 'deposit', 'withdrawal'):
+        INTEGRITY_MISMATCHES.labels(kind).set(report['mismatches'].get(kind, 0))
+    return report
+
+# ======================== ОБСЛУЖИВАНИЕ БАЗЫ ========================
+# Задачи JobQueue, которые держат базу в форме: истечение старых заявок и
+# счетов, чистка промокодов, снимки балансов журнала, PRAGMA optimize,
+# контрольные точки WAL и incremental vacuum. Работа режется на пачки по MAINT_BATCH строк, каждая в
+# своей транзакции, а между пачками цикл событий обслуживает обновления —
+# блокировка записи держится миллисекунды. Задачи пропускаются, пока идёт
+# больше MAINT_MAX_UPM обновлений в минуту; тяжёлые ещё и ждут часов
+# MAINT_HOURS (по умолчанию 3–6 ночи по серверному времени).
+MAINT_BATCH = int(os.environ.get("MAINT_BATCH", "200"))
+MAINT_MAX_BATCHES = 50
+MAINT_MAX_UPM = float(os.environ.get("MAINT_MAX_UPM", "120"))
+MAINT_HOURS = tuple(int(h) for h in os.environ.get("MAINT_HOURS", "3-6").split("-"))
+WITHDRAW_EXPIRE_DAYS = 7
+INVOICE_EXPIRE_HOURS = 24
+ANALYSIS_LIMIT = 1000
+VACUUM_PAGES = 256
+ARCHIVE_BATCH = MAINT_BATCH
+ARCHIVE_MAX_BATCHES = 500
+SNAPSHOT_BATCH = 5000  # проводок ledger на одну транзакцию снимка
+
+MAINT_DURATION = Histogram("bot_maintenance_seconds", "Длительность задач обслуживания", ("job",))
+MAINT_BATCH_SECONDS = Histogram("bot_maintenance_batch_seconds", "Одна пачка обслуживания — время удержания записи",
+                                ("job",))
+MAINT_ROWS = Counter("bot_maintenance_rows_total", "Строки, обработанные обслуживанием", ("job",))
+MAINT_SKIPPED = Counter("bot_maintenance_skipped_total", "Пропуски задач обслуживания", ("job", "reason"))
+
+class TrafficMeter:
+    """Обновления по секундам за последние window секунд"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self.buckets = deque()  # [секунда, обновлений]
+
+    def hit(self):
+        now = int(time.monotonic())
+        if self.buckets and self.buckets[-1][0] == now:
+            self.buckets[-1][1] += 1
+        else:
+            self.buckets.append([now, 1])
+        while self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+
+    def per_minute(self):
+        cutoff = time.monotonic() - self.window
+        return sum(n for second, n in self.buckets if second > cutoff) * 60 / self.window
+
+traffic = TrafficMeter()
+
+def maintenance_blocked(heavy):
+    """Причина отложить задачу или None"""
+    if traffic.per_minute() > MAINT_MAX_UPM:
+        return 'traffic'
+    if heavy and not MAINT_HOURS[0] <= datetime.now().hour < MAINT_HOURS[1]:
+        return 'window'
+    return None
+
+async def in_batches(job, step, batch=MAINT_BATCH, max_batches=MAINT_MAX_BATCHES):
+    """step() обрабатывает одну пачку в своей транзакции и возвращает число строк"""
+    total = 0
+    for _ in range(max_batches):
+        with MAINT_BATCH_SECONDS.labels(job).time():
+            n = step()
+        total += n
+        if n < batch or maintenance_blocked(False):
+            break
+        await asyncio.sleep(0)
+    MAINT_ROWS.labels(job).inc(total)
+    return total
+
+MAINTENANCE_JOBS = []  # (имя, задача JobQueue, интервал в секундах)
+
+def maintenance_job(name, interval, heavy=False):
+    def decorator(fn):
+        async def run(context: ContextTypes.DEFAULT_TYPE):
+            reason = maintenance_blocked(heavy)
+            if reason:
+                MAINT_SKIPPED.labels(name, reason).inc()
+                return
+            started = time.perf_counter()
+            try:
+                with MAINT_DURATION.labels(name).time():
+                    result = await fn()
+            except sqlite3.Error as e:
+                logger.warning("Обслуживание %s не удалось: %s", name, e)
+                return
+            logger.debug("🧹 Обслуживание %s: %s за %.1f мс", name, result, (time.perf_counter() - started) * 1000)
+        MAINTENANCE_JOBS.append((name, run, interval))
+        return fn
+    return decorator
+
+@maintenance_job('expire_withdrawals', 600)
+async def expire_withdrawals():
+    # created_at пишется CURRENT_TIMESTAMP, то есть в UTC
+    before = (datetime.utcnow() - timedelta(days=WITHDRAW_EXPIRE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def step():
+        rows = db.expire_withdrawals(before, MAINT_BATCH)
+        enqueue_messages((uid, f"⌛ Заявка на вывод #{wid} (${amt:.2f}) истекла без обработки. Создайте новую.")
+                         for wid, uid, amt in rows)
+        return len(rows)
+    return await in_batches('expire_withdrawals', step)
+
+@maintenance_job('expire_invoices', 600)
+async def expire_invoices():
+    before = (datetime.utcnow() - timedelta(hours=INVOICE_EXPIRE_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+    return await in_batches('expire_invoices', lambda: db.expire_invoices(before, MAINT_BATCH))
+
+@maintenance_job('purge_promocodes', 3600)
+async def purge_promocodes():
+    today = datetime.now().date().isoformat()
+    return await in_batches('purge_promocodes', lambda: db.purge_expired_promocodes(today, MAINT_BATCH))
+
+@maintenance_job('ledger_snapshots', 600)
+async def ledger_snapshots():
+    return await in_batches('ledger_snapshots', lambda: db.snapshot_balances(SNAPSHOT_BATCH), SNAPSHOT_BATCH)
+
+@maintenance_job('integrity', INTEGRITY_POLL, heavy=True)
+async def integrity():
+    # Раз в сутки, но внутри окна: интервал от запуска бота мог бы в окно не попадать никогда.
+    # Запас в один опрос не даёт времени сверки уползать к концу окна день за днём
+    if time.time() - db.integrity_checked_at() < INTEGRITY_INTERVAL - INTEGRITY_POLL:
+        return 'fresh'
+    report = await run_integrity_check()
+    db.save_integrity_checked(time.time())
+    if report['mismatches']:
+        notify_admins(integrity_text(report))
+    return report['mismatches'] or 'ok'
+
+@maintenance_job('archive_games', 600, heavy=True)
+async def archive_games():
+    # created_at пишется CURRENT_TIMESTAMP, то есть в UTC
+    before = (datetime.utcnow() - timedelta(days=GAMES_HOT_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    return await in_batches('archive_games', lambda: db.archive_games(before, ARCHIVE_BATCH), ARCHIVE_BATCH,
+                            ARCHIVE_MAX_BATCHES)
+
+@maintenance_job('wal_checkpoint', 60)
+async def wal_checkpoint():
+    # PASSIVE не ждёт читателей и писателей: что не успело, перенесётся в следующий раз
+    return db.wal_checkpoint('PASSIVE')
+
+@maintenance_job('optimize', 3600, heavy=True)
+async def optimize():
+    db.optimize(ANALYSIS_LIMIT)
+    return 'ok'
+
+@maintenance_job('incremental_vacuum', 600, heavy=True)
+async def incremental_vacuum():
+    remaining = None
+    for _ in range(MAINT_MAX_BATCHES):
+        with MAINT_BATCH_SECONDS.labels('incremental_vacuum').time():
+            remaining = db.incremental_vacuum(VACUUM_PAGES)
+        if not remaining or maintenance_blocked(False):
+            break
+        await asyncio.sleep(0)
+    return remaining
+
 # ======================== ОБРАБОТКА СООБЩЕНИЙ ========================
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_ban(update, context):
@@ -2397,10 +5247,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state == 'bet_amount' or state == 'dice_bet':
         try:
             bet = float(text.replace(',', '.'))
-            validated = await validate_bet(update, context, user_id, bet)
-            if validated is None:
-                return
-            bet = validated
             await handle_bet(update, context, user_id, bet)
         except ValueError:
             await update.message.reply_text("❌ Введите число (например, 0.5, 1.25)")
@@ -2414,10 +5260,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             bet = validated
             mines = context.user_data.get('mines_count', 5)
-            db.update_balance(user_id, -bet)
-            game = MinesGame(bet, mines)
+            previous = context.user_data.get('mines_game')
+            if previous is not None:
+                # Старая игра не должна пропасть вместе со ставкой
+                settle_mines_game(user_id, previous)
+            db.update_balance(user_id, -bet, 'bet')
+            round_id, rnd = outcomes.draw(user_id, 'mines', {'mines': mines})
+            game = MinesGame(bet, mines, rnd, round_id)
             context.user_data['mines_game'] = game
-            context.user_data['game_start_time'] = time.time()
             await show_mines_field(update, context, game)
             context.user_data.pop('awaiting')
             context.user_data.pop('mines_count')
@@ -2440,21 +5290,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if amt < 2.0:
                 await update.message.reply_text("❌ Минимум $2.00")
                 return
-            if amt > user[3]:
+            wid = db.create_withdrawal(user_id, amt, 'crypto', user[8]) if amt <= available(user) else None
+            if wid is None:
                 await update.message.reply_text("❌ Недостаточно")
                 return
-            wid = db.create_withdrawal(user_id, amt, 'crypto', user[8])
-            await update.message.reply_text(f"✅ Заявка #{wid} создана")
-            for aid in ADMIN_IDS:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton(f"✅ Принять #{wid}", callback_data=f"approve_withdrawal_{wid}", style="success"),
-                     InlineKeyboardButton(f"❌ Отклонить #{wid}", callback_data=f"reject_withdrawal_{wid}", style="danger")]
-                ])
-                await context.bot.send_message(
-                    aid,
-                    f"⏳ Новая заявка\n👤 @{update.effective_user.username or user_id}\n💰 ${amt:.2f}\n💳 CryptoBot\n🆔 #{wid}",
-                    reply_markup=kb
-                )
+            auto = auto_payout_eligible(amt)
+            notify_admins(f"⏳ Новая заявка\n👤 @{update.effective_user.username or user_id}\n💰 ${amt:.2f}\n💳 CryptoBot\n🆔 #{wid}"
+                          + ("\n🤖 Будет выплачена автоматически" if auto else ""), 'withdrawal', wid)
+            await update.message.reply_text(f"✅ Заявка #{wid} создана" +
+                                            (", выплата придёт автоматически" if auto else ""))
             context.user_data.pop('awaiting')
         except:
             await update.message.reply_text("❌ Введите число")
@@ -2468,20 +5312,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"✅ Заявка #{wid} отклонена")
             db.cursor.execute('SELECT user_id, amount FROM withdrawals WHERE id = ?', (wid,))
             uid, amt = db.cursor.fetchone()
-            await context.bot.send_message(uid, f"❌ Заявка на вывод отклонена\n💰 ${amt:.2f}\n📝 Причина: {reason}")
+            enqueue_notifications([uid], f"❌ Заявка на вывод отклонена\n💰 ${amt:.2f}\n📝 Причина: {reason}")
         else:
             await update.message.reply_text("❌ Ошибка")
         context.user_data.pop('awaiting')
         context.user_data.pop('reject_id')
 
     elif state == 'promocode':
-        res = db.activate_promocode(user_id, text.upper().strip())
-        if res['success']:
-            msg = f"✅ Промокод активирован!\n💰 +${res['amount']:.2f}"
-        else:
-            msg = res['reason']
-        await update.message.reply_text(msg, reply_markup=home_button())
         context.user_data.pop('awaiting')
+        # Не ждём фиксации здесь: пока задача ждёт пачку, обрабатываются следующие обновления
+        context.application.create_task(redeem_promocode(update, user_id, text.upper().strip()), update=update)
 
     elif state == 'promo_amount':
         if user_id not in ADMIN_IDS:
@@ -2500,8 +5340,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             days = int(text)
             context.user_data['promo_days'] = days
-            context.user_data['awaiting'] = 'promo_uses'
-            await update.message.reply_text("🔄 Макс. использований (0 = безлимит):")
+            if context.user_data.get('promo_bulk'):
+                context.user_data['awaiting'] = 'promo_count'
+                await update.message.reply_text(f"📦 Сколько кодов (до {PROMO_BULK_MAX})?")
+            else:
+                context.user_data['awaiting'] = 'promo_uses'
+                await update.message.reply_text("🔄 Макс. использований (0 = безлимит):")
         except:
             await update.message.reply_text("❌ Введите число")
 
@@ -2513,38 +5357,45 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             amt = context.user_data['promo_amount']
             days = context.user_data['promo_days']
             code = db.generate_promocode(amt, days, max_uses, user_id)
+            promo_redeemer.forget(code)
             await update.message.reply_text(f"✅ Код: `{code}`", parse_mode=ParseMode.MARKDOWN)
             context.user_data.clear()
         except:
             await update.message.reply_text("❌ Введите число")
 
+    elif state == 'promo_count':
+        if user_id not in ADMIN_IDS:
+            return
+        try:
+            count = int(text)
+        except ValueError:
+            await update.message.reply_text("❌ Введите число")
+            return
+        if not 1 <= count <= PROMO_BULK_MAX:
+            await update.message.reply_text(f"❌ От 1 до {PROMO_BULK_MAX}")
+            return
+        amt = context.user_data['promo_amount']
+        days = context.user_data['promo_days']
+        context.user_data.clear()
+        await update.message.reply_text(f"⏳ Создаю {count} кодов, CSV придёт файлом")
+        # В фоне: генерация и вставка 10^5 кодов не должны держать остальные обновления
+        context.application.create_task(send_bulk_promocodes(context.bot, user_id, count, amt, days), update=update)
+
     elif state == 'broadcast':
         if user_id not in ADMIN_IDS:
             return
         context.user_data.pop('awaiting')
         users = db.get_all_users()
-        sent = 0
-        failed = 0
         await update.message.reply_text(f"📢 Рассылка {len(users)} пользователям...")
         if update.message.photo:
             photo = update.message.photo[-1].file_id
             caption = update.message.caption or ""
-            for u in users:
-                try:
-                    await context.bot.send_photo(chat_id=u[0], photo=photo, caption=caption)
-                    sent += 1
-                    await asyncio.sleep(0.05)
-                except:
-                    failed += 1
+            send = lambda chat_id: context.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption,
+                                                          rate_limit_args=PRIORITY_BULK)
         else:
-            for u in users:
-                try:
-                    await context.bot.send_message(chat_id=u[0], text=text)
-                    sent += 1
-                    await asyncio.sleep(0.05)
-                except:
-                    failed += 1
-        await update.message.reply_text(f"✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
+            send = lambda chat_id: context.bot.send_message(chat_id=chat_id, text=text, rate_limit_args=PRIORITY_BULK)
+        # В фоне: рассылка не должна держать обработку остальных обновлений
+        context.application.create_task(run_broadcast(context.bot, user_id, [u[0] for u in users], send))
 
     elif state == 'game_setting_value':
         if user_id not in ADMIN_IDS:
@@ -2557,22 +5408,530 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             game = context.user_data.get('setting_game')
             key = context.user_data.get('setting_key')
             if game and key:
-                if game == 'slots':
-                    GAME_SETTINGS[game][key] = new_value
-                elif game in ['flip', 'dice_number', 'dice_even_odd']:
-                    GAME_SETTINGS[game][key] = new_value
-                else:
-                    GAME_SETTINGS[game][key] = new_value
-                db.save_game_settings()
-                await update.message.reply_text(f"✅ Коэффициент для {game} - {key} изменён на x{new_value}")
-                context.user_data.pop('setting_game')
-                context.user_data.pop('setting_key')
+                # Новое значение не применяется сразу: админ сначала видит RTP
+                proposed = json.loads(json.dumps(GAME_SETTINGS))
+                proposed[game][key] = new_value
+                context.user_data['setting_value'] = new_value
                 context.user_data.pop('awaiting')
+                text = (f"📈 {GAME_TITLES.get(game, game)}: {key} x{GAME_SETTINGS[game][key]} → x{new_value}\n\n"
+                        f"{format_rtp_change(game, GAME_SETTINGS, proposed)}\n\n"
+                        f"Применить изменение?")
+                kb = InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✅ Применить", callback_data="game_setting_apply", style="success"),
+                     InlineKeyboardButton("❌ Отмена", callback_data="game_setting_cancel", style="danger")]
+                ])
+                await update.message.reply_text(text, reply_markup=kb)
             else:
                 await update.message.reply_text("❌ Ошибка: игра не найдена")
         except ValueError:
             await update.message.reply_text("❌ Введите число (например: 1.5, 2.0, 3.7)")
 
+# ======================== ПРОВЕРКА ЧЕСТНОСТИ ========================
+async def seed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_ban(update, context):
+        return
+    user_id = update.effective_user.id
+    outcomes.flush()
+    seed = db.get_fair_seed(user_id)
+    text = (f"🔐 *Честная игра*\n\n"
+            f"Хэш сида сервера (sha256):\n`{seed_hash(seed['server_seed'])}`\n"
+            f"Сид клиента: `{seed['client_seed']}`\n"
+            f"Следующий раунд (nonce): {seed['nonce']}\n\n"
+            f"Результат раунда = HMAC-SHA256(сид сервера, \"сид клиента:nonce\"), "
+            f"каждые 4 байта — число от 0 до 1.\n\n"
+            f"/rotate `[сид клиента]` — раскрыть сид сервера и получить новый\n"
+            f"/verify `<номер раунда>` — пересчитать раунд")
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+
+async def rotate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_ban(update, context):
+        return
+    user_id = update.effective_user.id
+    client_seed = ''.join(ch for ch in context.args[0] if ch.isalnum())[:64] if context.args else None
+    # Раунды старого сида должны лечь в базу до раскрытия, а движок — забыть его
+    outcomes.forget(user_id)
+    old_seed = db.rotate_fair_seed(user_id, client_seed)
+    seed = db.get_fair_seed(user_id)
+    text = (f"🔄 Сид сервера сменён\n\n"
+            f"Раскрытый сид: `{old_seed}`\n"
+            f"Его хэш: `{seed_hash(old_seed)}`\n\n"
+            f"Новый хэш: `{seed_hash(seed['server_seed'])}`\n"
+            f"Новый сид клиента: `{seed['client_seed']}`")
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+
+async def verify_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await check_ban(update, context):
+        return
+    user_id = update.effective_user.id
+    try:
+        round_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("❌ Использование: /verify <номер раунда>")
+        return
+    outcomes.flush()
+    rnd = db.get_fair_round(round_id)
+    if not rnd or (rnd['user_id'] != user_id and user_id not in ADMIN_IDS):
+        await update.message.reply_text("❌ Раунд не найден")
+        return
+    server_seed = db.get_revealed_seed(rnd['server_seed_hash'])
+    if not server_seed:
+        await update.message.reply_text(
+            f"⏳ Раунд #{round_id} сыгран на текущем сиде сервера.\n"
+            f"Смените сид командой /rotate, чтобы раскрыть его и проверить раунд."
+        )
+        return
+    floats = digest_floats(fair_digest(server_seed, rnd['client_seed'], rnd['nonce']))
+    try:
+        params = json.loads(rnd['params'] or '{}')
+    except ValueError:
+        params = {}
+    text = (f"🔐 *Раунд #{round_id}* ({rnd['game_type']})\n\n"
+            f"Сид сервера: `{server_seed}`\n"
+            f"sha256: `{seed_hash(server_seed)}` "
+            f"{'✅' if seed_hash(server_seed) == rnd['server_seed_hash'] else '❌'}\n"
+            f"Сид клиента: `{rnd['client_seed']}`\n"
+            f"Nonce: {rnd['nonce']}\n\n"
+            f"Числа: {', '.join(f'{f:.6f}' for f in floats[:3])}…\n"
+            f"Исход: {describe_round(rnd['game_type'], params, floats)}")
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+
+# ======================== СТОРОЖ ЦИКЛА СОБЫТИЙ ========================
+# Задача в цикле отмечает пульс каждые LOOP_WATCHDOG_INTERVAL секунд и меряет
+# опоздание. Поток-наблюдатель видит, что пульса нет дольше LOOP_STALL_MS, и
+# снимает стек потока цикла: то, что в этот момент выполняется, и блокирует.
+LOOP_WATCHDOG_INTERVAL = float(os.environ.get("LOOP_WATCHDOG_INTERVAL", "0.05"))
+LOOP_STALL_MS = float(os.environ.get("LOOP_STALL_MS", "100"))
+
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Опоздание пульса цикла событий")
+LOOP_STALLS = Counter("bot_event_loop_stalls_total", "Блокировки цикла событий дольше LOOP_STALL_MS")
+
+BOT_FILE = os.path.abspath(__file__)
+
+def stall_site(frame):
+    """Ключ блокировки: ближайшая к листу строка бота и сам лист стека"""
+    stack = traceback.extract_stack(frame)
+    leaf = stack[-1]
+    own = next((f for f in reversed(stack) if os.path.abspath(f.filename) == BOT_FILE), None)
+    leaf_text = f"{os.path.basename(leaf.filename)}:{leaf.lineno} {leaf.name}"
+    if own is None or own is leaf:
+        return leaf_text, stack
+    return f"{os.path.basename(own.filename)}:{own.lineno} {own.name} → {leaf_text}", stack
+
+class LoopWatchdog:
+    def __init__(self, interval=LOOP_WATCHDOG_INTERVAL, threshold_ms=LOOP_STALL_MS):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.sites = {}
+        self._beat = 0
+        self._beat_at = time.monotonic()
+        self._captured = None
+        self._loop_thread = None
+        self._task = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat_at = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self._beat_at - self.interval)
+            LOOP_LAG.observe(lag)
+            with self._lock:
+                captured, self._captured = self._captured, None
+                self._beat += 1
+                self._beat_at = now
+            if captured and lag >= self.threshold:
+                self._record(captured, lag)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            with self._lock:
+                beat, beat_at, captured = self._beat, self._beat_at, self._captured
+            if captured or time.monotonic() - beat_at - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            site, stack = stall_site(frame)
+            with self._lock:
+                # Пульс мог прийти, пока снимали стек: тогда это уже не та блокировка
+                if self._beat == beat:
+                    self._captured = (site, stack)
+
+    def _record(self, captured, lag):
+        site, stack = captured
+        LOOP_STALLS.inc()
+        with self._lock:
+            entry = self.sites.setdefault(site, {'site': site, 'count': 0, 'total': 0.0, 'max': 0.0, 'stack': None})
+            entry['count'] += 1
+            entry['total'] += lag
+            entry['max'] = max(entry['max'], lag)
+            entry['stack'] = ''.join(traceback.format_list(stack[-8:]))
+        logger.warning("⏱ Цикл событий заблокирован на %.0f мс: %s", lag * 1000, site)
+
+    def top(self, n=10):
+        with self._lock:
+            entries = [dict(e) for e in self.sites.values()]
+        return sorted(entries, key=lambda e: e['total'], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self.sites.clear()
+
+loop_watchdog = LoopWatchdog()
+
+# ======================== ПРОФИЛИРОВАНИЕ ========================
+# По команде админа: cProfile на следующие N обновлений, выборочный профиль
+# потока цикла на N секунд и разница снимков tracemalloc между вызовами.
+PROFILE_MAX_UPDATES = 1000
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP = 40
+MEMSNAP_FRAMES = 10
+MEMSNAP_TOP = 30
+
+class UpdateProfiler:
+    """cProfile, включённый до конца N-го обновления после команды"""
+
+    def __init__(self):
+        self.session = None
+
+    def start(self, chat_id, updates):
+        profiler = cProfile.Profile()
+        self.session = {'profiler': profiler, 'chat_id': chat_id, 'updates': updates,
+                        'remaining': updates, 'started': time.perf_counter()}
+        profiler.enable()
+
+    def update_done(self, session):
+        """Отмечает обработанное обновление; возвращает сессию, если она закончилась"""
+        if session is not self.session:
+            return None
+        session['remaining'] -= 1
+        if session['remaining'] > 0:
+            return None
+        session['profiler'].disable()
+        session['elapsed'] = time.perf_counter() - session['started']
+        self.session = None
+        return session
+
+def profile_report(session):
+    out = io.StringIO()
+    out.write(f"cProfile: {session['updates']} обновлений за {session['elapsed']:.2f} c\n\n")
+    stats = pstats.Stats(session['profiler'], stream=out)
+    for key in ('cumulative', 'tottime'):
+        out.write(f"===== по {key} =====\n")
+        stats.sort_stats(key).print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+def sample_stacks(thread_id, seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """Выборочный профиль потока: собственное и полное время функций в выборках"""
+    own, total = {}, {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            code = frame.f_code
+            leaf = (code.co_filename, code.co_firstlineno, code.co_name)
+            own[leaf] = own.get(leaf, 0) + 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if key not in seen:
+                    seen.add(key)
+                    total[key] = total.get(key, 0) + 1
+                frame = frame.f_back
+        time.sleep(interval)
+    lines = [f"Выборочный профиль: {samples} выборок за {seconds} c, шаг {interval * 1000:g} мс",
+             "Простой цикла виден как select/_run_once в собственном времени.", ""]
+    for title, counts in (("собственное время", own), ("полное время", total)):
+        lines.append(f"===== {title} =====")
+        lines.append(f"{'%':>6} {'выборок':>8}  функция")
+        for (filename, lineno, name), n in sorted(counts.items(), key=lambda kv: -kv[1])[:PROFILE_TOP]:
+            lines.append(f"{100 * n / max(samples, 1):>6.1f} {n:>8}  {name} ({os.path.basename(filename)}:{lineno})")
+        lines.append("")
+    return "\n".join(lines)
+
+class MemorySnapshots:
+    """Разница снимков tracemalloc и числа объектов по типам между вызовами"""
+
+    def __init__(self):
+        self.snapshot = None
+        self.type_counts = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshot = None
+        self.type_counts = None
+
+    @staticmethod
+    def count_types():
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def take(self, user_data):
+        """None при первом вызове (снят базовый снимок), иначе текст отчёта"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMSNAP_FRAMES)
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        type_counts = self.count_types()
+        previous, previous_types = self.snapshot, self.type_counts
+        self.snapshot, self.type_counts = snapshot, type_counts
+        if previous is None:
+            return None
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"tracemalloc: сейчас {current / 2 ** 20:.1f} МБ, пик {peak / 2 ** 20:.1f} МБ", ""]
+
+        keys = {}
+        for data in user_data.values():
+            for key in data:
+                keys[key] = keys.get(key, 0) + 1
+        mines_in_sessions = sum(1 for data in user_data.values() if 'mines_game' in data)
+        lines.append(f"user_data: {len(user_data)} пользователей, {sum(keys.values())} ключей")
+        lines.extend(f"  {key}: {n}" for key, n in sorted(keys.items(), key=lambda kv: -kv[1]))
+        lines.append(f"MinesGame: {type_counts.get('MinesGame', 0)} объектов, {mines_in_sessions} в user_data")
+        lines.append("")
+
+        lines.append("===== рост числа объектов по типам =====")
+        growth = sorted(((n - previous_types.get(name, 0), name, n) for name, n in type_counts.items()), reverse=True)
+        lines.extend(f"{diff:>+9} {n:>10}  {name}" for diff, name, n in growth[:MEMSNAP_TOP] if diff > 0)
+        lines.append("")
+
+        lines.append("===== рост памяти по строкам =====")
+        for stat in snapshot.compare_to(previous, 'lineno')[:MEMSNAP_TOP]:
+            lines.append(str(stat))
+        return "\n".join(lines)
+
+update_profiler = UpdateProfiler()
+memory_snapshots = MemorySnapshots()
+
+# ======================== ДИАГНОСТИКА ========================
+async def slowqueries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if context.args and context.args[0] == 'reset':
+        slow_queries.reset()
+        await update.message.reply_text("✅ Журнал медленных запросов очищен")
+        return
+    top = slow_queries.top(10, db.conn)
+    if not top:
+        await update.message.reply_text(f"🐢 Запросов дольше {SLOW_QUERY_MS:g} мс не было")
+        return
+    # Без Markdown: в SQL хватает * и _
+    blocks = [f"🐢 Медленные запросы (> {SLOW_QUERY_MS:g} мс), по суммарному времени:"]
+    for i, e in enumerate(top, 1):
+        sql = e['sql'] if len(e['sql']) <= 300 else e['sql'][:300] + '…'
+        plan = "\n".join(f"   · {line}" for line in e['plan'] or []) or "   · —"
+        blocks.append(f"{i}. {e['count']}× всего {e['total'] * 1000:.0f} мс, "
+                      f"макс {e['max'] * 1000:.0f} мс, параметры {e['params']}\n"
+                      f"{sql}\n{plan}")
+    text = "\n\n".join(blocks)
+    await update.message.reply_text(text[:4000])
+
+async def stalls_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if context.args and context.args[0] == 'reset':
+        loop_watchdog.reset()
+        await update.message.reply_text("✅ Статистика блокировок очищена")
+        return
+    top = loop_watchdog.top(10)
+    if not top:
+        await update.message.reply_text(f"⏱ Блокировок цикла дольше {LOOP_STALL_MS:g} мс не было")
+        return
+    blocks = [f"⏱ Блокировки цикла событий (> {LOOP_STALL_MS:g} мс), по суммарному времени:"]
+    for i, e in enumerate(top, 1):
+        blocks.append(f"{i}. {e['site']}\n   {e['count']}× всего {e['total'] * 1000:.0f} мс, "
+                      f"макс {e['max'] * 1000:.0f} мс")
+    # Полный стек самой дорогой точки — для случаев, когда строки бота мало
+    blocks.append(f"Стек №1:\n{top[0]['stack']}")
+    text = "\n\n".join(blocks)
+    await update.message.reply_text(text[:4000])
+
+async def send_report(bot, chat_id, text, filename, caption):
+    await bot.send_document(
+        chat_id=chat_id,
+        document=io.BytesIO(text.encode('utf-8')),
+        filename=f"{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+        caption=caption
+    )
+
+async def send_profile_report(bot, session):
+    text = await asyncio.to_thread(profile_report, session)
+    await send_report(bot, session['chat_id'], text, "profile", f"🔬 cProfile, {session['updates']} обновлений")
+
+async def send_sample_report(bot, chat_id, thread_id, seconds):
+    text = await asyncio.to_thread(sample_stacks, thread_id, seconds)
+    await send_report(bot, chat_id, text, "sample", f"🔬 Выборочный профиль, {seconds} c")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        return
+    usage = ("Использование:\n"
+             f"/profile updates N — cProfile на следующие N обновлений (до {PROFILE_MAX_UPDATES})\n"
+             f"/profile sample N — выборочный профиль цикла на N секунд (до {PROFILE_MAX_SECONDS})")
+    if len(context.args) != 2 or not context.args[1].isdigit() or context.args[0] not in ('updates', 'sample'):
+        await update.message.reply_text(usage)
+        return
+    mode, count = context.args[0], int(context.args[1])
+    if mode == 'updates':
+        if update_profiler.session:
+            await update.message.reply_text("⏳ Профилирование уже идёт")
+            return
+        count = max(1, min(count, PROFILE_MAX_UPDATES))
+        update_profiler.start(update.effective_chat.id, count)
+        await update.message.reply_text(f"🔬 cProfile включён на {count} обновлений, отчёт придёт файлом")
+    else:
+        seconds = max(1, min(count, PROFILE_MAX_SECONDS))
+        await update.message.reply_text(f"🔬 Снимаю стеки цикла {seconds} c, отчёт придёт файлом")
+        # Не ждём здесь: пока идёт выборка, цикл обрабатывает обновления — их и видно в профиле
+        context.application.create_task(
+            send_sample_report(context.bot, update.effective_chat.id, threading.get_ident(), seconds), update=update)
+
+async def memsnap_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if context.args and context.args[0] == 'stop':
+        memory_snapshots.stop()
+        await update.message.reply_text("✅ tracemalloc выключен")
+        return
+    text = memory_snapshots.take(context.application.user_data)
+    if text is None:
+        await update.message.reply_text("📸 Базовый снимок памяти снят. Повторите /memsnap позже, "
+                                        "чтобы увидеть, что выросло; /memsnap stop — выключить трассировку")
+        return
+    await send_report(context.bot, update.effective_chat.id, text, "memsnap", "📸 Рост памяти с прошлого снимка")
+
+async def send_integrity_report(update):
+    report = await run_integrity_check()
+    await update.message.reply_text(integrity_text(report)[:4000])
+
+async def integrity_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text("🧮 Сверка запущена, игра не останавливается, отчёт придёт сообщением")
+    # Обновления обрабатываются по одному: ждать сверку здесь значит остановить всех
+    context.application.create_task(send_integrity_report(update), update=update)
+
+# ======================== ЭКСПОРТ МЕТРИК ========================
+ROUTE_IDS = re.compile(r'\d+')
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером времени каждого метода Bot API"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            TELEGRAM_ERRORS.labels(api_method).inc()
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(api_method).observe(time.perf_counter() - start)
+        if code != 200:
+            TELEGRAM_ERRORS.labels(api_method).inc()
+        return code, payload
+
+def update_route(update, context):
+    """Маршрут для метрик: callback_data без id или состояние ожидания ввода"""
+    if update.callback_query:
+        return ROUTE_IDS.sub('#', update.callback_query.data or '')
+    awaiting = context.user_data.get('awaiting') if context.user_data is not None else None
+    return f"msg:{awaiting}" if awaiting else "msg"
+
+def instrument_handler(handler, route=None):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        # Маршрут берётся до вызова: обработчик может сбросить awaiting
+        name = route or update_route(update, context)
+        session = update_profiler.session
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            HANDLER_LATENCY.labels(name).observe(latency)
+            if LOG_ACCESS:
+                access_logger.info("%s", name, extra={
+                    'route': name, 'latency_ms': round(latency * 1000, 1),
+                    'user_id': update.effective_user.id if update.effective_user else None,
+                })
+            # Считаются только обновления, начатые после включения профиля
+            finished = update_profiler.update_done(session) if session else None
+            if finished:
+                context.application.create_task(send_profile_report(context.bot, finished))
+    return wrapper
+
+async def serve_metrics(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics(application):
+    SESSIONS_ACTIVE.collect = lambda: len(application.user_data)
+    MINES_ACTIVE.collect = lambda: sum(1 for data in application.user_data.values() if 'mines_game' in data)
+    WITHDRAWALS_PENDING.collect = db.count_pending_withdrawals
+    NOTIFICATIONS_QUEUED.collect = db.count_queued_notifications
+    UPDATES_QUEUED.collect = application.update_queue.qsize
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logger.info("📈 Метрики: http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+async def stop_metrics(application):
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+async def on_startup(application):
+    await start_metrics(application)
+    loop_watchdog.start()
+
+async def on_shutdown(application):
+    outcomes.flush()
+    await loop_watchdog.stop()
+    await stop_metrics(application)
+
 # ======================== ЗАПУСК ========================
 def main():
     print("=" * 60)
@@ -2586,20 +5945,65 @@ def main():
     print("=" * 60)
 
     try:
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .base_url(TELEGRAM_API_URL)
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .get_updates_request(InstrumentedRequest(connection_pool_size=1))
+            .rate_limiter(OutboundScheduler())
+            .context_types(ContextTypes(user_data=SessionData))
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
         
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-        application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, handle_message))
+        application.add_handler(TypeHandler(Update, touch_session), group=-1)
+        application.add_handler(CommandHandler("start", instrument_handler(start, "/start")))
+        application.add_handler(CommandHandler("seed", instrument_handler(seed_command, "/seed")))
+        application.add_handler(CommandHandler("rotate", instrument_handler(rotate_command, "/rotate")))
+        application.add_handler(CommandHandler("verify", instrument_handler(verify_command, "/verify")))
+        application.add_handler(CommandHandler("slowqueries", instrument_handler(slowqueries_command, "/slowqueries")))
+        application.add_handler(CommandHandler("stalls", instrument_handler(stalls_command, "/stalls")))
+        application.add_handler(CommandHandler("profile", instrument_handler(profile_command, "/profile")))
+        application.add_handler(CommandHandler("memsnap", instrument_handler(memsnap_command, "/memsnap")))
+        application.add_handler(CommandHandler("integrity", instrument_handler(integrity_command, "/integrity")))
+        application.add_handler(CallbackQueryHandler(instrument_handler(button_handler)))
+        application.add_handler(PreCheckoutQueryHandler(instrument_handler(precheckout_callback, "precheckout")))
+        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT,
+                                               instrument_handler(successful_payment_callback, "successful_payment")))
+        application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, instrument_handler(handle_message)))
         application.add_error_handler(error_handler)
+        application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+        application.job_queue.run_repeating(auto_payout_job, interval=AUTO_PAYOUT_INTERVAL, first=5)
+        application.job_queue.run_repeating(dispatch_notifications, interval=NOTIFY_INTERVAL, first=1)
+        for name, job, interval in MAINTENANCE_JOBS:
+            application.job_queue.run_repeating(job, interval=interval, first=60, name=f"maintenance:{name}")
         
-        print("🤖 Бот запущен!")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WEBHOOK_URL:
+            print(f"🤖 Бот запущен (вебхук {WEBHOOK_URL}/{WEBHOOK_PATH}, порт {WEBHOOK_PORT})!")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+                secret_token=get_webhook_secret(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            )
+        else:
+            print("🤖 Бот запущен (polling)!")
+            # run_polling снимает вебхук, но оставляет очередь обновлений
+            application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=False)
     except Exception as e:
-        logger.error(f"Ошибка запуска: {e}")
+        logger.exception("Ошибка запуска: %s", e)
         print(f"❌ Ошибка: {e}")
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--check-integrity"]:
+        # Офлайн: python bot.py --check-integrity [путь к копии базы]; код 1 — есть расхождения
+        result = check_integrity(sys.argv[2] if len(sys.argv) > 2 else db.path)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        sys.exit(1 if result['mismatches'] else 0)
     main()
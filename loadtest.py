@@ -0,0 +1,534 @@
+"""Нагрузочный тест Sakura Game на локальном фейковом Telegram Bot API.
+
+Запуск:
+    python loadtest.py --users 200 --iterations 3
+    python loadtest.py --users 500 --scenario start --json report.json
+
+Скрипт поднимает заглушки api.telegram.org и pay.crypt.bot, запускает bot.py
+в режиме вебхука (TELEGRAM_API_URL и CRYPTOBOT_API_URL указывают на заглушки)
+и гоняет N виртуальных пользователей по сценариям: игра в орёл/решку,
+пополнение, минное поле, статистика админа. Задержка шага считается от
+отправки обновления до первого ответа бота в тот же чат; отчёт содержит
+пропускную способность и p50/p95/p99 по каждому маршруту.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sqlite3
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_TOKEN = "123456:LOADTEST"
+WEBHOOK_SECRET = "loadtest-secret"
+
+# Методы, которыми бот отвечает пользователю
+REPLY_METHODS = {
+    "sendMessage", "editMessageText", "editMessageCaption", "editMessageMedia",
+    "editMessageReplyMarkup", "sendPhoto", "sendDocument", "sendDice"
+}
+
+DICE_FACES = {"🎲": 6, "🎯": 6, "🎳": 6, "🏀": 5, "⚽": 5, "🎰": 64}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+# ======================== ФЕЙКОВЫЙ TELEGRAM BOT API И CRYPTOBOT ========================
+class FakeTelegramAPI:
+    """Отвечает на вызовы Bot API (/bot<token>/...) и Crypto Pay API (/api/...)
+    правдоподобными JSON и сообщает о них харнессу"""
+
+    def __init__(self, port=0):
+        self.on_call = None
+        self.calls = {}
+        self.transfers = {}
+        self.webhook_set = threading.Event()
+        self._message_id = 0
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                method = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+                params = api.parse_params(self.headers.get("Content-Type", ""), body)
+                for key, values in parse_qs(self.path.partition("?")[2]).items():
+                    params[key] = values[0]
+                if self.path.startswith("/api/"):
+                    result = api.handle_cryptobot(method, params)
+                else:
+                    result = api.handle(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    @staticmethod
+    def parse_params(content_type, body):
+        params = {}
+        if content_type.startswith("application/json"):
+            try:
+                return json.loads(body or b"{}")
+            except ValueError:
+                return {}
+        if content_type.startswith("multipart/form-data"):
+            # Файлы не нужны, достаточно простых полей формы
+            for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+                params[name.decode()] = value.decode(errors="replace")
+        else:
+            for key, values in parse_qs(body.decode(errors="replace")).items():
+                params[key] = values[0]
+        for key, value in list(params.items()):
+            if isinstance(value, str):
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    pass
+        return params
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def message(self, chat_id, **extra):
+        msg = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        msg.update(extra)
+        return msg
+
+    def handle(self, method, params):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Sakura", "username": "Sakura_Gamerobot"}
+        elif method == "setWebhook":
+            self.webhook_set.set()
+            result = True
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "sendDice":
+            emoji = params.get("emoji", "🎲")
+            value = (self._message_id % DICE_FACES.get(emoji, 6)) + 1
+            result = self.message(chat_id, dice={"emoji": emoji, "value": value})
+        elif method.startswith("send") or method.startswith("edit"):
+            result = self.message(chat_id, text=str(params.get("text", "")))
+        else:
+            result = True
+        if self.on_call and chat_id is not None:
+            self.on_call(method, params)
+        return result
+
+    def handle_cryptobot(self, method, params):
+        with self._lock:
+            self.calls[f"crypto:{method}"] = self.calls.get(f"crypto:{method}", 0) + 1
+        if method == "createInvoice":
+            invoice_id = self.next_message_id()
+            return {
+                "invoice_id": invoice_id,
+                "status": "active",
+                "asset": params.get("asset", "TON"),
+                "amount": str(params.get("amount", "0")),
+                "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            }
+        if method == "transfer":
+            # Как в CryptoBot: повтор spend_id не создаёт второй перевод
+            spend_id = params.get("spend_id")
+            transfer = {"transfer_id": self.next_message_id(), "status": "completed",
+                        "spend_id": spend_id, "amount": str(params.get("amount", "0"))}
+            with self._lock:
+                return self.transfers.setdefault(spend_id, transfer)
+        if method == "getTransfers":
+            with self._lock:
+                spend_id = params.get("spend_id")
+                return {"items": [t for t in self.transfers.values() if spend_id in (None, t["spend_id"])]}
+        return True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# ======================== ЗАПУСК БОТА ========================
+def start_bot(api_port, webhook_port, db_path, admin_ids="1", extra_env=None):
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api_port}/bot",
+        "CRYPTOBOT_API_URL": f"http://127.0.0.1:{api_port}/api",
+        "CRYPTOBOT_API_KEY": "loadtest",
+        "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(webhook_port),
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "DB_PATH": db_path,
+        "ADMIN_IDS": admin_ids,
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.update(extra_env or {})
+    return subprocess.Popen(
+        [sys.executable, os.path.join(BOT_DIR, "bot.py")],
+        env=env, cwd=BOT_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def wait_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+# ======================== ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ ========================
+class WebhookClient:
+    """Шлёт обновления на вебхук и ждёт ответа бота в нужный чат"""
+
+    def __init__(self, api, webhook_port, timeout=10.0):
+        self.url = f"http://127.0.0.1:{webhook_port}/telegram"
+        self.timeout = timeout
+        self.http = httpx.AsyncClient(
+            headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+            limits=httpx.Limits(max_connections=100),
+            timeout=timeout
+        )
+        self.loop = asyncio.get_running_loop()
+        self.waiters = {}
+        self._update_id = 0
+        api.on_call = self._on_call
+
+    def _on_call(self, method, params):
+        if method not in REPLY_METHODS:
+            return
+        try:
+            chat_id = int(params["chat_id"])
+        except (KeyError, TypeError, ValueError):
+            return
+        self.loop.call_soon_threadsafe(self._resolve, chat_id, method, params)
+
+    def _resolve(self, chat_id, method, params):
+        fut = self.waiters.pop(chat_id, None)
+        if fut and not fut.done():
+            fut.set_result((method, params))
+
+    def next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    async def send(self, chat_id, update):
+        """Отправляет обновление; возвращает (задержка, ответ) или (None, None) по таймауту"""
+        fut = self.loop.create_future()
+        self.waiters[chat_id] = fut
+        t0 = time.perf_counter()
+        response = await self.http.post(self.url, json=update)
+        if response.status_code != 200:
+            self.waiters.pop(chat_id, None)
+            raise RuntimeError(f"webhook HTTP {response.status_code}")
+        try:
+            reply = await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self.waiters.pop(chat_id, None)
+            return None, None
+        return time.perf_counter() - t0, reply
+
+    async def close(self):
+        await self.http.aclose()
+
+
+def user_payload(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def message_update(update_id, user_id, text):
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user_payload(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": msg}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+# ======================== СЦЕНАРИИ ========================
+# Шаг: (тип, данные, маршрут). Маршрут — имя строки в отчёте: данные кнопки
+# без номеров или состояние awaiting, в котором бот ждёт текст.
+SCENARIOS = {
+    "start": [
+        ("command", "/start", "/start"),
+    ],
+    "flip": [
+        ("command", "/start", "/start"),
+        ("callback", "casino_menu", "casino_menu"),
+        ("callback", "game_flip", "game_flip"),
+        ("callback", "flip_choice_1", "flip_choice_*"),
+        ("text", "0.5", "bet_amount"),
+        ("callback", "game_confirm", "game_confirm"),
+    ],
+    "deposit": [
+        ("command", "/start", "/start"),
+        ("callback", "deposit_menu", "deposit_menu"),
+        ("callback", "deposit_crypto", "deposit_crypto"),
+        ("text", "5", "deposit_amount_crypto"),
+    ],
+    "mines": [
+        ("command", "/start", "/start"),
+        ("callback", "casino_menu", "casino_menu"),
+        ("callback", "game_mines", "game_mines"),
+        ("callback", "mines_set_3", "mines_set_*"),
+        ("text", "0.5", "mines_bet"),
+        ("callback", "mines_open_0", "mines_open_*"),
+        ("callback", "mines_open_7", "mines_open_*"),
+        ("callback", "mines_cashout", "mines_cashout"),
+    ],
+    "admin": [
+        ("command", "/start", "/start"),
+        ("callback", "admin_panel", "admin_panel"),
+        ("callback", "admin_stats_daily", "admin_stats_daily"),
+        ("callback", "admin_stats_weekly", "admin_stats_weekly"),
+        ("callback", "admin_withdrawals", "admin_withdrawals"),
+    ],
+}
+
+# Доли сценариев в смешанной нагрузке; "admin" достаётся только админам
+SCENARIO_MIX = {"flip": 0.5, "mines": 0.25, "deposit": 0.25}
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = {}
+        self.timeouts = {}
+        self.errors = {}
+
+    def add(self, route, latency):
+        self.latencies.setdefault(route, []).append(latency)
+
+    def timeout(self, route):
+        self.timeouts[route] = self.timeouts.get(route, 0) + 1
+
+    def error(self, route):
+        self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        routes = {}
+        for route in sorted(set(self.latencies) | set(self.timeouts) | set(self.errors)):
+            values = self.latencies.get(route, [])
+            routes[route] = {
+                "count": len(values),
+                "timeouts": self.timeouts.get(route, 0),
+                "errors": self.errors.get(route, 0),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+            }
+        total = sum(r["count"] for r in routes.values())
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "steps": total,
+            "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "routes": routes,
+        }
+
+
+async def run_user(client, stats, user_id, scenario, iterations, think):
+    for _ in range(iterations):
+        for kind, payload, route in SCENARIOS[scenario]:
+            update_id = client.next_update_id()
+            if kind == "callback":
+                update = callback_update(update_id, user_id, payload)
+            else:
+                update = message_update(update_id, user_id, payload)
+            try:
+                latency, _ = await client.send(user_id, update)
+            except Exception:
+                stats.error(route)
+                continue
+            if latency is None:
+                stats.timeout(route)
+            else:
+                stats.add(route, latency)
+            if think:
+                await asyncio.sleep(random.uniform(0, think))
+
+
+def assign_scenarios(users, admins, scenario):
+    """Сценарий для каждого пользователя: первые admins — админы"""
+    if scenario != "mix":
+        return [scenario] * users
+    names = list(SCENARIO_MIX)
+    weights = [SCENARIO_MIX[n] for n in names]
+    plan = ["admin"] * min(admins, users)
+    rnd = random.Random(42)
+    plan += rnd.choices(names, weights, k=users - len(plan))
+    return plan
+
+
+def seed_balances(db_path, user_ids, balance):
+    """Создаёт пользователей с балансом до начала нагрузки"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+        [(uid, f"user{uid}", f"User{uid}") for uid in user_ids]
+    )
+    # Через журнал, как зачисления бота: кэш баланса и ledger должны сходиться
+    cents = int(round(balance * 100))
+    conn.executemany(
+        "INSERT INTO ledger (user_id, amount_cents, reason) "
+        "SELECT user_id, ? - balance_cents, 'adjustment' FROM users WHERE user_id = ? AND balance_cents != ?",
+        [(cents, uid, cents) for uid in user_ids]
+    )
+    conn.executemany("UPDATE users SET balance_cents = ?, balance = ?, available_cents = ? - held_cents WHERE user_id = ?",
+                     [(cents, cents / 100, cents, uid) for uid in user_ids])
+    conn.commit()
+    conn.close()
+
+
+def print_report(report):
+    print(f"Шагов: {report['steps']} за {report['elapsed_s']:.2f} c — {report['throughput_rps']:.1f} upd/s")
+    print(f"{'маршрут':<24}{'n':>7}{'таймаут':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for route, r in report["routes"].items():
+        print(f"{route:<24}{r['count']:>7}{r['timeouts'] + r['errors']:>9}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+
+
+async def main_async(args):
+    api = FakeTelegramAPI()
+    api.start()
+    webhook_port = args.port or free_port()
+    tmpdir = tempfile.mkdtemp(prefix="sakura_loadtest_")
+    db_path = os.path.join(tmpdir, "loadtest.db")
+    first_user_id = 100000
+    user_ids = [first_user_id + i for i in range(args.users)]
+    admin_ids = user_ids[:args.admins] or [1]
+    metrics_port = free_port()
+    proc = start_bot(api.port, webhook_port, db_path, ",".join(map(str, admin_ids)),
+                     {"METRICS_PORT": str(metrics_port)})
+    try:
+        if not await asyncio.to_thread(api.webhook_set.wait, 30) or not await asyncio.to_thread(wait_port, webhook_port):
+            print("❌ Бот не поднял вебхук")
+            return 1
+        await asyncio.to_thread(seed_balances, db_path, user_ids, args.balance)
+        client = WebhookClient(api, webhook_port, timeout=args.timeout)
+        stats = RouteStats()
+        plan = assign_scenarios(args.users, args.admins, args.scenario)
+        try:
+            t0 = time.perf_counter()
+            await asyncio.gather(*(
+                run_user(client, stats, uid, scenario, args.iterations, args.think)
+                for uid, scenario in zip(user_ids, plan)
+            ))
+            elapsed = time.perf_counter() - t0
+        finally:
+            await client.close()
+        report = stats.report(elapsed)
+        report["users"] = args.users
+        report["scenarios"] = {name: plan.count(name) for name in set(plan)}
+        report["api_calls"] = dict(api.calls)
+        print_report(report)
+        print(f"Вызовы API: {json.dumps(api.calls, ensure_ascii=False)}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if args.metrics:
+            # Снимок /metrics бота после прогона: латентность по маршрутам, БД и Bot API изнутри
+            with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=10) as resp:
+                with open(args.metrics, "wb") as f:
+                    f.write(resp.read())
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        api.stop()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Sakura Game")
+    parser.add_argument("--users", type=int, default=100, help="число виртуальных пользователей")
+    parser.add_argument("--scenario", default="mix", choices=["mix"] + list(SCENARIOS),
+                        help="сценарий для всех пользователей или смешанная нагрузка")
+    parser.add_argument("--iterations", type=int, default=1, help="повторов сценария на пользователя")
+    parser.add_argument("--admins", type=int, default=2, help="сколько первых пользователей — админы")
+    parser.add_argument("--balance", type=float, default=100.0, help="стартовый баланс пользователей, $")
+    parser.add_argument("--think", type=float, default=0.0, help="макс. пауза между шагами, c")
+    parser.add_argument("--json", help="сохранить отчёт в JSON")
+    parser.add_argument("--metrics", help="сохранить снимок /metrics бота после прогона")
+    parser.add_argument("--port", type=int, default=0, help="порт вебхука бота (по умолчанию свободный)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="таймаут ответа, c")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()